@@ -1,27 +1,42 @@
 from aiohttp import web
 
+import aiohttp
 import asyncio
+import base64
 import logging
 import os
 import random
 import re
+import sys
 import json
-from datetime import datetime, timedelta
-from contextlib import asynccontextmanager
-from typing import Optional, List, Tuple, Dict
+import copy
+import hashlib
+import hmac
+import secrets
+import heapq
+import itertools
+import contextvars
+import shutil
+import subprocess
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional, List, Tuple, Dict, Sequence
 
 import aiosqlite
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import (
-    Message, CallbackQuery,
+    Message, CallbackQuery, ChatMemberUpdated,
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton,
-    FSInputFile,
+    FSInputFile, InputMediaPhoto, InputMediaVideo, InputMediaAnimation,
 )
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 
 # =========================
 # НАСТРОЙКИ (через ENV — безопасно для GitHub/Render)
@@ -32,6 +47,7 @@ ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 # ЮКасса — API через REST (shop_id + secret_key из личного кабинета yukassa.ru)
 YUKASSA_SHOP_ID  = os.getenv("YUKASSA_SHOP_ID", "")
 YUKASSA_SECRET   = os.getenv("YUKASSA_SECRET", "")
+YUKASSA_API_URL  = os.getenv("YUKASSA_API_URL", "https://api.yookassa.ru/v3")
 
 # Публичный URL бота (Render/ngrok) для return_url после оплаты
 BOT_PUBLIC_URL = os.getenv("BOT_PUBLIC_URL", "https://t.me/")  # https://t.me/your_bot
@@ -57,6 +73,9 @@ IMAGE_PATHS = {
     "faq":          "media2/tech/faq.jpg",
 }
 
+# Видео после заполнения профиля
+PROFILE_SUCCESS_VIDEO = "media2/tech/profile_success.mp4"
+
 # Словарь JPG/PNG картинок для техник упражнений.
 # Приоритет над GIF: если здесь есть путь и файл существует — отправляем картинку.
 # Чтобы добавить картинку: создай файл и пропиши путь ниже — хендлеры менять не нужно.
@@ -534,20 +553,21 @@ def get_alternatives(tech_key: str, place: str) -> List[Tuple[str, str]]:
     return result
 
 
-def build_workout_keyboard(day: int, exercises: List[str], done: List[int]) -> InlineKeyboardMarkup:
+def build_workout_keyboard(day: int, exercises: List[dict], done: List[int]) -> InlineKeyboardMarkup:
     """Компактная клавиатура тренировки — один ряд на упражнение:
        [⬜/✅ Название]  [📚]  [🔄]
     Название усечено через safe_btn, поэтому ряд не вылезает за границы.
     📚 — техника, 🔄 — заменить (если есть альтернативы).
+    exercises — записи плана v2 (tech_key уже посчитан).
     """
     rows = []
-    for idx, name in enumerate(exercises):
+    for idx, ex in enumerate(exercises):
         mark = "✅" if idx in done else "⬜️"
         row = [InlineKeyboardButton(
-            text=f"{mark} {safe_btn(name, 20)}",
+            text=f"{mark} {safe_btn(ex['name'], 20)}",
             callback_data=f"wex:done:{day}:{idx}"
         )]
-        tech_key = get_tech_key_for_exercise(name)
+        tech_key = ex.get("tech_key")
         if tech_key:
             row.append(InlineKeyboardButton(
                 text="📚",
@@ -630,47 +650,357 @@ from aiogram.types import TelegramObject, Update as TgUpdate
 
 # Семафор: не более 50 апдейтов обрабатываются одновременно.
 _CONCURRENCY_LIMIT = 50
-_THROTTLE_SECONDS = 1.0  # минимальный интервал между запросами одного пользователя
-_user_last_request: Dict[int, float] = {}
+# Троттлинг пользователя — token bucket: в среднем THROTTLE_RATE апдейтов/с,
+# подряд без ожидания — до THROTTLE_BURST (быстро отметить пару упражнений — норма).
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "2"))
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "4"))
+# Сколько апдейтов одного пользователя может ждать своей очереди; сверх — отбрасываем
+THROTTLE_QUEUE = int(os.getenv("THROTTLE_QUEUE", "8"))
+_THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "50000"))  # потолок записей
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.stamp = _time.monotonic()
+        self.paused_until = 0.0
+
+    def take(self, now: float) -> float:
+        """Берёт токен. 0 — взят; иначе через сколько секунд пробовать снова."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def idle(self, now: float) -> bool:
+        """Bucket полон и не на паузе — его можно выбросить без потерь."""
+        return now >= self.paused_until and (
+            self.tokens + (now - self.stamp) * self.rate >= self.burst
+        )
+
+
+class UserLane:
+    """Очередь апдейтов одного пользователя: bucket, lock (обработка строго
+    по одному, в порядке прихода) и сколько нажатий ждёт на каждом сообщении."""
+    __slots__ = ("bucket", "lock", "waiting", "pending")
+
+    def __init__(self):
+        self.bucket = TokenBucket(THROTTLE_RATE, THROTTLE_BURST)
+        self.lock = asyncio.Lock()
+        self.waiting = 0  # апдейтов в middleware (ждут + в работе)
+        self.pending: Dict[Tuple[int, int], int] = {}  # (chat_id, message_id) → ждут
+
+    def idle(self, now: float) -> bool:
+        """Ничего не ждёт и bucket полон — полосу можно выбросить без потерь."""
+        return not self.waiting and self.bucket.idle(now)
+
+
+class ThrottleState:
+    """
+    Полосы пользователей (UserLane) — только пока они что-то значат.
+    OrderedDict в порядке обращений: давно не писавшие в голове,
+    при каждом обращении срезаем из головы простаивающие полосы
+    с полным bucket (их выброс ничего не меняет). Плюс потолок max_size —
+    память не растёт с числом пользователей, которых бот когда-либо видел.
+    Занятые полосы не выбрасываются, поэтому сверх потолка может быть
+    не больше полос, чем апдейтов в работе.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lanes: "OrderedDict[int, UserLane]" = OrderedDict()
+        self.throttled = 0  # отброшено апдейтов
+        self.delayed = 0    # нажатий ждали токен
+        self.expired = 0    # выброшено простаивающих
+        self.evicted = 0    # выброшено по потолку (bucket ещё не полон)
+
+    def _expire(self, now: float):
+        while self._lanes:
+            if not next(iter(self._lanes.values())).idle(now):
+                break
+            self._lanes.popitem(last=False)
+            self.expired += 1
+
+    def lane(self, user_id: int, now: float) -> UserLane:
+        self._expire(now)
+        lane = self._lanes.get(user_id)
+        if lane is None:
+            lane = self._lanes[user_id] = UserLane()
+        else:
+            self._lanes.move_to_end(user_id)
+        while len(self._lanes) > self.max_size:
+            if next(iter(self._lanes.values())).waiting:
+                break
+            self._lanes.popitem(last=False)
+            self.evicted += 1
+        return lane
+
+    def stats(self) -> dict:
+        self._expire(_time.monotonic())
+        return {
+            "size": len(self._lanes),
+            "max_size": self.max_size,
+            "queued": sum(lane.waiting for lane in self._lanes.values()),
+            "throttled": self.throttled,
+            "delayed": self.delayed,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+_throttle = ThrottleState(_THROTTLE_MAX_USERS)
+
+# Нажатие, которое сейчас обрабатывается: (полоса пользователя, (chat_id, message_id))
+_current_press: contextvars.ContextVar[Optional[Tuple[UserLane, Tuple[int, int]]]] = (
+    contextvars.ContextVar("current_press", default=None)
+)
+
+
+def render_superseded(chat_id: int, message_id: int) -> bool:
+    """За текущим нажатием на этом же сообщении уже ждёт следующее —
+    перерисовывать сообщение незачем, итог покажет последнее нажатие."""
+    press = _current_press.get()
+    if press is None:
+        return False
+    lane, key = press
+    return key == (chat_id, message_id) and key in lane.pending
+
+
+def _event_user_id(event: TelegramObject) -> Optional[int]:
+    """user_id автора апдейта (сообщение, callback, смена статуса в чате)."""
+    for attr in ("message", "callback_query", "my_chat_member", "chat_member"):
+        sub = getattr(event, attr, None)
+        if sub and hasattr(sub, "from_user") and sub.from_user:
+            return sub.from_user.id
+    return None
 
 
 class LoadProtectionMiddleware(BaseMiddleware):
     """
     Middleware защиты от перегрузки:
     1. Семафор на 50 одновременных обработок.
-    2. Троттлинг: если пользователь шлёт чаще 1 раза в секунду —
-       тихо игнорируем (на callback отвечаем answer()).
+    2. Апдейты одного пользователя обрабатываются по одному, по порядку.
+    3. Троттлинг — token bucket на пользователя (THROTTLE_RATE/с, всплеск
+       THROTTLE_BURST). Сообщения сверх лимита тихо игнорируем, нажатия
+       кнопок ждут токена в очереди (до THROTTLE_QUEUE, дальше — answer()
+       «Не так быстро»). Каждое нажатие обрабатывается (состояние не теряется),
+       но экран на сообщении перерисовывает только последнее из ожидающих
+       (render_superseded) — число правок ограничено лимитом.
     """
     def __init__(self):
         super().__init__()
         self._sem = asyncio.Semaphore(_CONCURRENCY_LIMIT)
 
     async def __call__(self, handler, event: TelegramObject, data: dict):
-        # Получаем user_id
-        user_id: Optional[int] = None
-        for attr in ("message", "callback_query", "my_chat_member", "chat_member"):
-            sub = getattr(event, attr, None)
-            if sub and hasattr(sub, "from_user") and sub.from_user:
-                user_id = sub.from_user.id
-                break
+        user_id = _event_user_id(event)
+        cb = getattr(event, "callback_query", None)
+        if user_id is None or not (cb or getattr(event, "message", None)):
+            async with self._sem:
+                return await handler(event, data)
 
         # --- Троттлинг ---
-        if user_id is not None:
-            now = _time.monotonic()
-            last = _user_last_request.get(user_id, 0.0)
-            if now - last < _THROTTLE_SECONDS:
-                cb = getattr(event, "callback_query", None)
-                if cb:
-                    try:
-                        await cb.answer("\u23f3 Не так быстро!", show_alert=False)
-                    except Exception:
-                        pass
+        lane = _throttle.lane(user_id, _time.monotonic())
+        if cb is None:
+            if lane.bucket.take(_time.monotonic()):
+                _throttle.throttled += 1
                 return
-            _user_last_request[user_id] = now
+        elif lane.waiting >= THROTTLE_QUEUE:
+            _throttle.throttled += 1
+            try:
+                await cb.answer("\u23f3 Не так быстро!", show_alert=False)
+            except Exception:
+                pass
+            return
 
-        # --- Семафор параллельности ---
-        async with self._sem:
-            return await handler(event, data)
+        key = (cb.message.chat.id, cb.message.message_id) if cb and cb.message else None
+        lane.waiting += 1
+        if key:
+            lane.pending[key] = lane.pending.get(key, 0) + 1
+        try:
+            async with lane.lock:
+                if cb is not None:
+                    delay = lane.bucket.take(_time.monotonic())
+                    if delay:
+                        _throttle.delayed += 1
+                    while delay:
+                        await asyncio.sleep(delay)
+                        delay = lane.bucket.take(_time.monotonic())
+                if key:
+                    self._unpend(lane, key)
+                token = _current_press.set((lane, key) if key else None)
+                key = None
+                try:
+                    # --- Семафор параллельности ---
+                    async with self._sem:
+                        return await handler(event, data)
+                finally:
+                    _current_press.reset(token)
+        finally:
+            lane.waiting -= 1
+            if key:  # отменили, пока ждали
+                self._unpend(lane, key)
+
+    @staticmethod
+    def _unpend(lane: UserLane, key: Tuple[int, int]):
+        left = lane.pending[key] - 1
+        if left:
+            lane.pending[key] = left
+        else:
+            del lane.pending[key]
+
+
+# =========================
+# ИСХОДЯЩИЕ: планировщик отправки в Telegram
+# =========================
+# Все запросы, которые шлют или правят сообщения, проходят через
+# OutboundScheduler (request-middleware сессии aiogram):
+# 1. Token bucket на бота (~30 сообщений/с) и на каждый чат.
+# 2. Очередь к общему bucket упорядочена по приоритету:
+#    интерактив > платежи > напоминания > рассылки —
+#    рассылка не задерживает ответы на кнопки.
+# 3. 429 (retry_after): чат ставится на паузу, запрос повторяется.
+# Приоритет берётся из contextvar: в хендлерах — интерактив по умолчанию,
+# фоновые задачи оборачивают отправку в `with outbound_priority(...)`
+# или отдают её в submit_outbound(...) без ожидания.
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+PRIO_INTERACTIVE, PRIO_PAYMENT, PRIO_REMINDER, PRIO_BROADCAST = range(4)
+_PRIO_NAMES = ("интерактив", "платежи", "напоминания", "рассылки")
+
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))  # сообщений/с на бота
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))       # сообщений/с в один чат
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))     # всплеск в один чат
+OUTBOUND_MAX_RETRIES = 3
+_OUTBOUND_CHATS_MAX = 10000
+# Методы, на которые действуют лимиты Telegram (удаление и ответы на callback — нет)
+_OUTBOUND_LIMITED = ("Send", "Edit", "Copy", "Forward")
+
+_outbound_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "outbound_priority", default=PRIO_INTERACTIVE
+)
+
+
+@contextmanager
+def outbound_priority(prio: int):
+    """Отправки внутри блока идут с приоритетом prio."""
+    token = _outbound_priority.set(prio)
+    try:
+        yield
+    finally:
+        _outbound_priority.reset(token)
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(self):
+        self._global = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+        self._chats: Dict[object, TokenBucket] = {}
+        self._waiters: list = []  # heap: (приоритет, порядок, future)
+        self._seq = itertools.count()
+        self._pump_task: Optional[asyncio.Task] = None
+        self.sent = [0] * len(_PRIO_NAMES)
+        self.waited = [0.0] * len(_PRIO_NAMES)
+        self.retry_after = 0
+
+    def _chat(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _OUTBOUND_CHATS_MAX:
+                now = _time.monotonic()
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+        return bucket
+
+    async def _acquire(self, chat_id, prio: int):
+        bucket = self._chat(chat_id)
+        while True:
+            delay = bucket.take(_time.monotonic())
+            if not delay:
+                break
+            await asyncio.sleep(delay)
+        # Общий bucket: без очереди — сразу, иначе в очередь по приоритету
+        if not self._waiters and not self._global.take(_time.monotonic()):
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (prio, next(self._seq), fut))
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump(), context=contextvars.Context())
+        await fut
+
+    async def _pump(self):
+        try:
+            while self._waiters:
+                delay = self._global.take(_time.monotonic())
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+                _, _, fut = heapq.heappop(self._waiters)
+                if fut.done():
+                    self._global.tokens += 1  # ожидавший ушёл (отмена) — токен не тратим
+                else:
+                    fut.set_result(None)
+        finally:
+            self._pump_task = None
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(_OUTBOUND_LIMITED):
+            return await make_request(bot, method)
+        prio = _outbound_priority.get()
+        attempt = 0
+        while True:
+            t0 = _time.monotonic()
+            await self._acquire(chat_id, prio)
+            self.waited[prio] += _time.monotonic() - t0
+            try:
+                result = await make_request(bot, method)
+                self.sent[prio] += 1
+                return result
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                attempt += 1
+                if attempt > OUTBOUND_MAX_RETRIES:
+                    raise
+                logger.warning(
+                    f"Telegram 429 ({type(method).__name__}, chat {chat_id}, "
+                    f"{_PRIO_NAMES[prio]}): пауза {e.retry_after} с"
+                )
+                self._chat(chat_id).paused_until = _time.monotonic() + e.retry_after
+                self._global.tokens = 0  # притормаживаем и общий поток
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._waiters),
+            "chats": len(self._chats),
+            "sent": list(self.sent),
+            "avg_wait_ms": [
+                round(w / n * 1000) if n else 0 for w, n in zip(self.waited, self.sent)
+            ],
+            "retry_after": self.retry_after,
+        }
+
+
+_outbound = OutboundScheduler()
+_outbound_tasks: set = set()
+
+
+def submit_outbound(coro, prio: int = PRIO_INTERACTIVE) -> asyncio.Task:
+    """Отправка «выстрелил и забыл»: не ждём доставки, ошибки — только в лог."""
+    async def run():
+        _outbound_priority.set(prio)
+        try:
+            return await coro
+        except Exception as e:
+            logger.warning(f"submit_outbound ({_PRIO_NAMES[prio]}): {e}")
+
+    task = asyncio.create_task(run())
+    _outbound_tasks.add(task)
+    task.add_done_callback(_outbound_tasks.discard)
+    return task
 
 
 # =========================
@@ -2916,358 +3246,1170 @@ async def try_delete_user_message(bot: Bot, message: Message):
 # =========================
 # АНТИ-ЗАСОРЕНИЕ ЧАТА
 # =========================
-async def get_last_bot_msg_id(user_id: int) -> Optional[int]:
-    async with db() as conn:
-        async with conn.execute("SELECT last_bot_msg_id FROM bot_state WHERE user_id=?", (user_id,)) as cur:
-            row = await cur.fetchone()
-    if not row:
-        return None
+BOT_STATE_FLUSH_SECONDS = float(os.getenv("BOT_STATE_FLUSH_SECONDS", "2"))
+BOT_STATE_CACHE_SIZE = int(os.getenv("BOT_STATE_CACHE_SIZE", "20000"))
+_BOT_STATE_FIELDS = ("last_bot_msg_id", "diary_prompt_msg_id")
+
+
+class BotStateCache:
+    """
+    id последних сообщений бота в памяти с отложенной записью (write-behind):
+    1. Чтение — из памяти; промах читается из снимка/БД и кэшируется.
+    2. Запись — только в память, пользователь помечается «грязным».
+    3. Раз в BOT_STATE_FLUSH_SECONDS все грязные строки уходят одним заданием
+       group commit: серия смен экрана даёт одну запись на пользователя.
+    4. LRU-вытеснение трогает только чистые записи; при остановке — финальный flush.
+    """
+    def __init__(self, flush_seconds: float, max_size: int):
+        self.flush_seconds = flush_seconds
+        self.max_size = max_size
+        self._data: "OrderedDict[int, Dict[str, Optional[int]]]" = OrderedDict()
+        self._dirty: Dict[int, set] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.evicted = 0
+
+    def get(self, user_id: int, field: str):
+        """(True, значение) если пользователь в кэше, иначе (False, None)."""
+        entry = self._data.get(user_id)
+        if entry is None or field not in entry:
+            return False, None
+        self._data.move_to_end(user_id)
+        return True, entry[field]
+
+    def fill(self, user_id: int, field: str, value: Optional[int]):
+        """Значение, прочитанное из БД. Не перетирает то, что уже в памяти."""
+        entry = self._data.setdefault(user_id, {})
+        entry.setdefault(field, value)
+        self._evict()
+
+    def set(self, user_id: int, field: str, value: Optional[int]):
+        entry = self._data.setdefault(user_id, {})
+        entry[field] = value
+        self._data.move_to_end(user_id)
+        self._dirty.setdefault(user_id, set()).add(field)
+        self.writes += 1
+        self._evict()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later(), context=contextvars.Context())
+
+    def _evict(self):
+        if len(self._data) <= self.max_size:
+            return
+        for user_id in list(self._data):
+            if len(self._data) <= self.max_size:
+                break
+            if user_id not in self._dirty:
+                del self._data[user_id]
+                self.evicted += 1
+
+    async def _flush_later(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        pending, self._dirty = self._dirty, {}
+        statements: List[SqlStatement] = []
+        for user_id, fields in pending.items():
+            cols = [f for f in _BOT_STATE_FIELDS if f in fields]
+            entry = self._data.get(user_id, {})
+            statements.append((
+                f"INSERT INTO bot_state (user_id, {', '.join(cols)}) "
+                f"VALUES (?{', ?' * len(cols)}) "
+                f"ON CONFLICT(user_id) DO UPDATE SET "
+                + ", ".join(f"{c}=excluded.{c}" for c in cols),
+                (user_id, *[entry.get(c) for c in cols]),
+            ))
+        try:
+            await db_write(*statements)
+        except Exception as e:
+            logger.warning(f"bot_state flush failed ({len(pending)} rows): {e}")
+            for user_id, fields in pending.items():
+                self._dirty.setdefault(user_id, set()).update(fields)
+            return
+        self.flushes += 1
+        self.flushed_rows += len(pending)
+        self._evict()
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "dirty": len(self._dirty),
+            "writes": self.writes,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "evicted": self.evicted,
+        }
+
+
+_bot_state_cache = BotStateCache(BOT_STATE_FLUSH_SECONDS, BOT_STATE_CACHE_SIZE)
+
+
+async def _get_bot_state_field(user_id: int, field: str) -> Optional[int]:
+    found, value = _bot_state_cache.get(user_id, field)
+    if not found:
+        snap = await current_snapshot(user_id)
+        if snap is not None:
+            value = (snap.bot_state or {}).get(field)
+        else:
+            async with db(readonly=True) as conn:
+                async with conn.execute(f"SELECT {field} FROM bot_state WHERE user_id=?", (user_id,)) as cur:
+                    row = await cur.fetchone()
+            value = row[0] if row else None
+        _bot_state_cache.fill(user_id, field, value)
     try:
-        return int(row[0]) if row[0] is not None else None
+        return int(value) if value is not None else None
     except Exception:
         return None
 
 
+def _remember_bot_state_field(user_id: int, field: str, value: Optional[int]):
+    """Запись в bot_state не требует перечитывать снимок — правим его на месте."""
+    snap = _user_snapshot.get()
+    if snap is not None and snap.user_id == user_id and not snap.stale:
+        if snap.bot_state is None:
+            snap.bot_state = {"last_bot_msg_id": None, "diary_prompt_msg_id": None}
+        snap.bot_state[field] = value
+
+
+async def get_last_bot_msg_id(user_id: int) -> Optional[int]:
+    return await _get_bot_state_field(user_id, "last_bot_msg_id")
+
+
 async def set_last_bot_msg_id(user_id: int, msg_id: int):
-    async with db() as conn:
-        await conn.execute("""
-            INSERT INTO bot_state (user_id, last_bot_msg_id)
-            VALUES (?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET last_bot_msg_id=excluded.last_bot_msg_id
-        """, (user_id, int(msg_id)))
-        await conn.commit()
+    _bot_state_cache.set(user_id, "last_bot_msg_id", int(msg_id))
+    _remember_bot_state_field(user_id, "last_bot_msg_id", int(msg_id))
 
 
 async def get_diary_prompt_msg_id(user_id: int) -> Optional[int]:
-    async with db() as conn:
-        async with conn.execute("SELECT diary_prompt_msg_id FROM bot_state WHERE user_id=?", (user_id,)) as cur:
-            row = await cur.fetchone()
-    if not row:
-        return None
-    try:
-        return int(row[0]) if row[0] is not None else None
-    except Exception:
-        return None
+    return await _get_bot_state_field(user_id, "diary_prompt_msg_id")
 
 
 async def set_diary_prompt_msg_id(user_id: int, msg_id: Optional[int]):
-    async with db() as conn:
-        await conn.execute("""
-            INSERT INTO bot_state (user_id, diary_prompt_msg_id)
-            VALUES (?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET diary_prompt_msg_id=excluded.diary_prompt_msg_id
-        """, (user_id, int(msg_id) if msg_id else None))
-        await conn.commit()
+    value = int(msg_id) if msg_id else None
+    _bot_state_cache.set(user_id, "diary_prompt_msg_id", value)
+    _remember_bot_state_field(user_id, "diary_prompt_msg_id", value)
 
 
 async def clean_send(bot: Bot, chat_id: int, user_id: int, text: str, reply_markup=None):
     """Удаляет предыдущее сообщение бота и отправляет новое — чат не засоряется."""
-    last_id = await get_last_bot_msg_id(user_id)
-    if last_id:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=last_id)
-        except Exception:
-            pass
-    m = await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-    await set_last_bot_msg_id(user_id, m.message_id)
-    return m.message_id
+    return await render_screen(bot, chat_id, user_id, text, reply_markup=reply_markup)
 
 
 async def clean_edit(callback: CallbackQuery, user_id: int, text: str, reply_markup=None):
     """Редактирует текущее сообщение (если не удаётся — отправляет новое)."""
-    try:
-        await callback.message.edit_text(text, reply_markup=reply_markup)
-        await set_last_bot_msg_id(user_id, callback.message.message_id)
-    except Exception:
-        await clean_send(callback.bot, callback.message.chat.id, user_id, text, reply_markup=reply_markup)
-
-
-async def _send_with_image(
-    bot: Bot, chat_id: int, user_id: int,
-    text: str, image_key: str, reply_markup=None
-):
-    """Отправляет сообщение с фото из IMAGE_PATHS[image_key].
-    Если файл не найден — отправляет обычный текст.
-    Всегда удаляет предыдущее главное сообщение бота (чистый чат)."""
-    path = IMAGE_PATHS.get(image_key, "")
-    last_id = await get_last_bot_msg_id(user_id)
-    if last_id:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=last_id)
-        except Exception:
-            pass
-    if path and os.path.exists(path):
-        try:
-            photo = FSInputFile(path)
-            caption = text[:1020] + ("…" if len(text) > 1020 else "")
-            m = await bot.send_photo(
-                chat_id=chat_id, photo=photo,
-                caption=caption, reply_markup=reply_markup
-            )
-            await set_last_bot_msg_id(user_id, m.message_id)
-            return m.message_id
-        except Exception:
-            pass  # fallback to text
-    m = await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-    await set_last_bot_msg_id(user_id, m.message_id)
-    return m.message_id
-
+    await render_screen(
+        callback.bot, callback.message.chat.id, user_id, text,
+        reply_markup=reply_markup, current=callback.message,
+    )
 
-async def send_section(
-    bot: Bot,
-    chat_id: int,
-    user_id: int,
-    image_path: str,
-    text: str,
-    reply_markup=None,
-    callback: Optional[CallbackQuery] = None,
-):
-    """Универсальная отправка раздела с картинкой из локального файла.
 
-    Логика:
-    - Если callback передан — сначала пытается edit_text (без фото, быстро).
-      При наличии файла: удаляет старое сообщение и отправляет send_photo.
-    - Если файл существует → send_photo(caption=text).
-      Если текст > 1020 символов → фото без caption + отдельное send_message.
-    - Если файла нет (или ошибка) → обычный send_message / edit_text.
-    - Бот никогда не падает: все ошибки обёрнуты в try/except + warning-лог.
+# =========================
+# МЕДИА: реестр Telegram file_id
+# =========================
+class MediaRegistry:
+    """
+    Реестр file_id для локальных медиа (таблица media_file_ids):
+    1. Первая успешная отправка файла запоминает file_id, который вернул Telegram.
+    2. Дальше файл отправляется по file_id — без повторной загрузки.
+    3. Ключ — путь + хэш содержимого: изменился файл на диске → хэш другой →
+       файл загружается заново, запись перезаписывается.
+    Хэш считается один раз и переиспользуется, пока не изменились mtime/размер.
     """
-    TG_CAPTION_LIMIT = 1020
+    def __init__(self):
+        self._ids: Dict[str, Tuple[str, str]] = {}          # path -> (hash, file_id)
+        self._digests: Dict[str, Tuple[int, int, str]] = {}  # path -> (mtime_ns, size, hash)
+        self._lock = asyncio.Lock()
+        self._loaded = False
+        self.reused = 0
+        self.uploaded = 0
+        self.stale = 0
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._lock:
+            if self._loaded:
+                return
+            async with db(readonly=True) as conn:
+                async with conn.execute("SELECT path, file_hash, file_id FROM media_file_ids") as cur:
+                    async for path, file_hash, file_id in cur:
+                        self._ids[path] = (file_hash, file_id)
+            self._loaded = True
+
+    @staticmethod
+    def _hash_file(path: str) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    async def digest(self, path: str) -> str:
+        st = os.stat(path)
+        memo = self._digests.get(path)
+        if memo and memo[0] == st.st_mtime_ns and memo[1] == st.st_size:
+            return memo[2]
+        file_hash = await asyncio.to_thread(self._hash_file, path)
+        self._digests[path] = (st.st_mtime_ns, st.st_size, file_hash)
+        return file_hash
+
+    async def lookup(self, path: str, file_hash: str) -> Optional[str]:
+        await self._ensure_loaded()
+        entry = self._ids.get(path)
+        if entry and entry[0] == file_hash:
+            return entry[1]
+        return None
 
-    # ── определяем наличие файла ────────────────────────────────────────────
-    has_image = bool(image_path and os.path.exists(image_path))
+    def remember(self, path: str, file_hash: str, kind: str, file_id: str):
+        self._ids[path] = (file_hash, file_id)
+        db_write_nowait(("""
+            INSERT INTO media_file_ids (path, file_hash, kind, file_id, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                file_hash=excluded.file_hash, kind=excluded.kind,
+                file_id=excluded.file_id, updated_at=excluded.updated_at
+        """, (path, file_hash, kind, file_id, datetime.utcnow().isoformat())))
 
-    # ── ветка callback: редактирование существующего сообщения ──────────────
-    if callback:
-        if has_image:
-            # Удаляем старое сообщение, отправляем фото
-            last_id = await get_last_bot_msg_id(user_id)
-            if last_id:
-                try:
-                    await bot.delete_message(chat_id=chat_id, message_id=last_id)
-                except Exception:
-                    pass
-            try:
-                photo = FSInputFile(image_path)
-                if len(text) <= TG_CAPTION_LIMIT:
-                    m = await bot.send_photo(
-                        chat_id=chat_id, photo=photo,
-                        caption=text, reply_markup=reply_markup
-                    )
-                    await set_last_bot_msg_id(user_id, m.message_id)
-                else:
-                    m = await bot.send_photo(chat_id=chat_id, photo=photo)
-                    m2 = await bot.send_message(
-                        chat_id=chat_id, text=text, reply_markup=reply_markup
-                    )
-                    await set_last_bot_msg_id(user_id, m2.message_id)
-                return
-            except Exception as e:
-                logger.warning(f"send_section: не удалось отправить фото {image_path}: {e}")
-        # fallback — просто редактируем текст
-        await clean_edit(callback, user_id, text, reply_markup=reply_markup)
-        return
+    def forget(self, path: str):
+        if self._ids.pop(path, None) is not None:
+            db_write_nowait(("DELETE FROM media_file_ids WHERE path=?", (path,)))
 
-    # ── ветка без callback: отправка нового сообщения ───────────────────────
-    last_id = await get_last_bot_msg_id(user_id)
-    if last_id:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=last_id)
-        except Exception:
-            pass
+    def stats(self) -> dict:
+        return {
+            "known": len(self._ids),
+            "reused": self.reused,
+            "uploaded": self.uploaded,
+            "stale": self.stale,
+        }
 
-    if has_image:
-        try:
-            photo = FSInputFile(image_path)
-            if len(text) <= TG_CAPTION_LIMIT:
-                m = await bot.send_photo(
-                    chat_id=chat_id, photo=photo,
-                    caption=text, reply_markup=reply_markup
-                )
-                await set_last_bot_msg_id(user_id, m.message_id)
-            else:
-                m = await bot.send_photo(chat_id=chat_id, photo=photo)
-                m2 = await bot.send_message(
-                    chat_id=chat_id, text=text, reply_markup=reply_markup
-                )
-                await set_last_bot_msg_id(user_id, m2.message_id)
-            return
-        except Exception as e:
-            logger.warning(f"send_section: не удалось отправить фото {image_path}: {e}")
 
-    # финальный fallback — только текст
-    m = await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-    await set_last_bot_msg_id(user_id, m.message_id)
+_media_registry = MediaRegistry()
 
 
-async def send_screen(
-    message: Message,
-    text: str,
-    image_key: Optional[str] = None,
-    reply_markup=None,
-    edit: bool = False,
-):
-    """Универсальная функция отправки экрана с опциональным изображением.
-    Если edit=True — пытаемся редактировать текст, иначе отправляем новое.
-    Если image_key указан и файл существует — используем send_photo."""
-    bot: Bot = message.bot
-    chat_id = message.chat.id
-    user_id = message.from_user.id if message.from_user else 0
+def _message_file_id(m: Message, kind: str) -> Optional[str]:
+    if kind == "photo" and m.photo:
+        return m.photo[-1].file_id
+    obj = getattr(m, kind, None) or m.video or m.animation or m.document
+    return obj.file_id if obj else None
 
-    path = IMAGE_PATHS.get(image_key or "", "") if image_key else ""
-    has_image = bool(path and os.path.exists(path))
 
-    if edit and not has_image:
+async def _with_file_id(kind: str, path: str, call, thumbnail: Optional[str] = None,
+                        file_hash: Optional[str] = None) -> Message:
+    """Общая часть send_media / edit_media: сначала file_id из реестра, иначе загрузка.
+    call(media, thumbnail) делает сам запрос: media — file_id или FSInputFile,
+    thumbnail — FSInputFile превью (только при загрузке) или None.
+    Протухший file_id (Telegram его не принял) удаляется, файл загружается заново."""
+    file_hash = file_hash or await _media_registry.digest(path)
+    file_id = await _media_registry.lookup(path, file_hash)
+    if file_id:
         try:
-            await message.edit_text(text, reply_markup=reply_markup)
-            await set_last_bot_msg_id(user_id, message.message_id)
-            return
-        except Exception:
-            pass
+            m = await call(file_id, None)
+            _media_registry.reused += 1
+            return m
+        except TelegramBadRequest as e:
+            if "file" not in str(e).lower():
+                raise
+            logger.warning(f"send_media: file_id для {path} не принят ({e}), загружаем заново")
+            _media_registry.stale += 1
+            _media_registry.forget(path)
+    thumb = FSInputFile(thumbnail) if thumbnail and os.path.exists(thumbnail) else None
+    m = await call(FSInputFile(path), thumb)
+    _media_registry.uploaded += 1
+    new_id = _message_file_id(m, kind) if isinstance(m, Message) else None
+    if new_id:
+        _media_registry.remember(path, file_hash, kind, new_id)
+    return m
 
-    # Удаляем предыдущее главное сообщение
-    last_id = await get_last_bot_msg_id(user_id)
-    if last_id:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=last_id)
-        except Exception:
-            pass
 
-    if has_image:
-        try:
-            photo = FSInputFile(path)
-            caption = text[:1020] + ("…" if len(text) > 1020 else "")
-            m = await bot.send_photo(
-                chat_id=chat_id, photo=photo,
-                caption=caption, reply_markup=reply_markup
-            )
-            await set_last_bot_msg_id(user_id, m.message_id)
-            return
-        except Exception:
-            pass
+async def send_media(bot: Bot, kind: str, path: str, thumbnail: Optional[str] = None,
+                     file_hash: Optional[str] = None, **kwargs) -> Message:
+    """send_photo / send_video / send_animation локального файла через реестр file_id.
+    thumbnail — путь к превью; Telegram принимает его только вместе с загрузкой файла.
+    file_hash — хэш из манифеста (иначе считается по файлу)."""
+    method = getattr(bot, f"send_{kind}")
 
-    m = await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-    await set_last_bot_msg_id(user_id, m.message_id)
+    async def call(media, thumb):
+        extra = {"thumbnail": thumb} if thumb else {}
+        return await method(**{kind: media}, **extra, **kwargs)
 
+    return await _with_file_id(kind, path, call, thumbnail, file_hash)
 
-async def send_tech(
-    bot: Bot, chat_id: int, user_id: int,
-    tech_key: str, text: str, reply_markup=None
-):
-    """Универсальная отправка техники упражнения.
 
-    Приоритет медиа:
-      1. TECH_VIDEOS[key]  или  TECH[key]["mp4"]  — send_video (mp4)
-      2. TECH_IMAGES[key]  или  TECH[key]["img"]  — send_photo (jpg/png)
-      3. TECH_GIFS[key]
-           • путь .mp4  → send_video
-           • путь .gif  → send_animation
-      4. только текст — send_message (graceful fallback)
+_INPUT_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo, "animation": InputMediaAnimation}
 
-    Текст всегда в одном сообщении с медиа — caption обрезается умно по \n.
 
-    Как добавить видео к упражнению (3 способа):
-      А) Положи файл media/tech/<key>.mp4, пропиши в TECH_VIDEOS[key] — приоритет 1.
-      Б) Пропиши путь прямо в TECH[key]["mp4"] = "media/tech/..." — приоритет 1.
-      В) Пропиши в TECH_GIFS[key] = "media/tech/<key>.mp4" — приоритет 3
-         (если нет TECH_VIDEOS и нет TECH_IMAGES для данного ключа).
-      Хендлеры менять не нужно — заработает автоматически.
+async def edit_media(bot: Bot, chat_id: int, message_id: int, asset: dict,
+                     caption: str, reply_markup=None) -> Message:
+    """Заменяет медиа в сообщении (edit_message_media) файлом из манифеста —
+    тоже через реестр file_id. asset — {kind, path, hash, thumb?, send_kwargs?}."""
+    kind = asset["kind"]
+    media_cls = _INPUT_MEDIA[kind]
+    media_kwargs = asset.get("send_kwargs", {}) if kind != "photo" else {}
 
-    Удаляет предыдущее главное сообщение (чистый чат)."""
+    async def call(media, thumb):
+        extra = {"thumbnail": thumb} if thumb and kind != "photo" else {}
+        return await bot.edit_message_media(
+            chat_id=chat_id, message_id=message_id,
+            media=media_cls(media=media, caption=caption, **extra, **media_kwargs),
+            reply_markup=reply_markup,
+        )
 
-    # Удаляем предыдущее сообщение
-    last_id = await get_last_bot_msg_id(user_id)
-    if last_id:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=last_id)
-        except Exception:
-            pass
+    return await _with_file_id(kind, asset["path"], call, asset.get("thumb"), asset["hash"])
 
-    tech_item = TECH.get(tech_key, {})
 
-    # ── Умная обрезка caption ────────────────────────────────────────────────
-    # Telegram: caption для video/photo/animation — максимум 1024 символа.
-    # Обрезаем по последнему переносу строки перед лимитом.
-    LIMIT = 1020
-    def make_caption(t: str) -> str:
-        if len(t) <= LIMIT:
-            return t
-        cut = t[:LIMIT]
-        last_nl = cut.rfind("\n")
-        if last_nl > LIMIT // 2:
-            return cut[:last_nl] + "\n…"
-        return cut + "…"
+# =========================
+# МЕДИА: прогрев file_id при старте
+# =========================
+# Куда загружать медиа для получения file_id (по умолчанию — чат админа;
+# сообщения сразу удаляются). 0 — прогрев отключён.
+MEDIA_CACHE_CHAT_ID = int(os.getenv("MEDIA_CACHE_CHAT_ID", str(ADMIN_ID)))
+MEDIA_WARMUP_CONCURRENCY = max(1, int(os.getenv("MEDIA_WARMUP_CONCURRENCY", "2")))
+MEDIA_WARMUP_INTERVAL = float(os.getenv("MEDIA_WARMUP_INTERVAL", "1.0"))  # сек между загрузками
+
+
+def media_kind(path: str) -> str:
+    """Как отправлять файл: video / animation / photo — по расширению."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".mp4", ".mov", ".webm"):
+        return "video"
+    if ext == ".gif":
+        return "animation"
+    return "photo"
+
+
+def iter_media_sources():
+    """Все пути к медиа из словарей: (источник, ключ, путь)."""
+    for key, path in IMAGE_PATHS.items():
+        yield "IMAGE_PATHS", key, path
+    yield "PROFILE_SUCCESS_VIDEO", "profile_success", PROFILE_SUCCESS_VIDEO
+    for key, path in TECH_VIDEOS.items():
+        yield "TECH_VIDEOS", key, path
+    for key, item in TECH.items():
+        for field in ("mp4", "img"):
+            if item.get(field):
+                yield f"TECH.{field}", key, item[field]
+    for key, path in TECH_IMAGES.items():
+        yield "TECH_IMAGES", key, path
+    for key, path in TECH_GIFS.items():
+        yield "TECH_GIFS", key, path
+
+
+async def _warm_up_media(bot: Bot):
+    """
+    Фоновая задача при старте: загружает в служебный чат все медиа без
+    сохранённого file_id, чтобы первый пользователь после деплоя не ждал загрузку.
+    1. Не больше MEDIA_WARMUP_CONCURRENCY загрузок одновременно и не чаще
+       одной в MEDIA_WARMUP_INTERVAL секунд; RetryAfter — ждём и повторяем.
+    2. Прогресс, ошибки и отсутствующие файлы — админу одним сообщением.
+    """
+    if not MEDIA_CACHE_CHAT_ID:
+        logger.info("Media warm-up disabled (MEDIA_CACHE_CHAT_ID=0)")
+        return
 
-    caption = make_caption(text)
+    # Файлы и хэши — из манифеста (включая оптимизированные клипы, которые send_tech шлёт первыми)
+    paths = _media_manifest.files
+    missing = list(_media_manifest.missing)
+    todo: List[str] = [
+        path for path, a in paths.items()
+        if not await _media_registry.lookup(path, a["hash"])
+    ]
 
-    # ── Вспомогательная: отправить видео (mp4) ───────────────────────────────
-    async def _try_send_video(path: str) -> bool:
-        try:
-            m = await bot.send_video(
-                chat_id=chat_id,
-                video=FSInputFile(path),
-                caption=caption,
-                reply_markup=reply_markup,
-            )
-            await set_last_bot_msg_id(user_id, m.message_id)
-            return True
-        except Exception as _e:
-            logging.warning(f"[send_tech] send_video failed key={tech_key!r} path={path!r}: {_e}")
-            return False
-
-    # ── Вариант 1: MP4 из TECH_VIDEOS (внешний словарь — высший приоритет) ───
-    video_path = TECH_VIDEOS.get(tech_key, "")
-    if not video_path:
-        # Проверяем поле "mp4" прямо в словаре TECH (устаревший формат хранения)
-        video_path = tech_item.get("mp4", "")
-    if video_path and os.path.exists(video_path):
-        if await _try_send_video(video_path):
-            return
-        # fallback → картинка
+    logger.info(f"Media warm-up: {len(paths)} files, {len(todo)} to upload, {len(missing)} missing")
+    report_id: Optional[int] = None
+    done, failed = 0, []
 
-    # ── Вариант 2: JPG/PNG из TECH_IMAGES ────────────────────────────────────
-    img_path = TECH_IMAGES.get(tech_key, "")
-    if not img_path:
-        img_path = tech_item.get("img", "")
-    if img_path and os.path.exists(img_path):
-        try:
-            m = await bot.send_photo(
-                chat_id=chat_id,
-                photo=FSInputFile(img_path),
-                caption=caption,
-                reply_markup=reply_markup,
-            )
-            await set_last_bot_msg_id(user_id, m.message_id)
+    async def report(final: bool = False):
+        nonlocal report_id
+        if not ADMIN_ID:
             return
-        except Exception:
-            pass  # fallback → gif → text
-
-    # ── Вариант 3: GIF/MP4 из TECH_GIFS ──────────────────────────────────────
-    # Если путь оканчивается на .mp4 — отправляем как видео (send_video),
-    # иначе (gif) — send_animation.
-    gif_path = TECH_GIFS.get(tech_key, "")
-    if gif_path and os.path.exists(gif_path):
-        if gif_path.lower().endswith(".mp4"):
-            # mp4 в TECH_GIFS → отправляем как видео
-            if await _try_send_video(gif_path):
-                return
-        else:
-            try:
-                m = await bot.send_animation(
-                    chat_id=chat_id,
-                    animation=FSInputFile(gif_path),
-                    caption=caption,
-                    reply_markup=reply_markup,
-                )
-                await set_last_bot_msg_id(user_id, m.message_id)
+        lines = [
+            "🎞 Прогрев медиа" + (" — готово" if final else ""),
+            f"Файлов: {len(paths)} • уже загружены: {len(paths) - len(todo)}",
+            f"Загружено: {done}/{len(todo)} • ошибок: {len(failed)}",
+        ]
+        if final:
+            if failed:
+                lines += ["", "❌ Ошибки:"] + [f"• {x}" for x in failed[:20]]
+            if missing:
+                lines += ["", "⚠️ Нет файлов:"] + [f"• {x}" for x in missing[:30]]
+                if len(missing) > 30:
+                    lines.append(f"… и ещё {len(missing) - 30}")
+        text = "\n".join(lines)[:4000]
+        try:
+            if report_id is None:
+                report_id = (await bot.send_message(ADMIN_ID, text, disable_notification=True)).message_id
+            else:
+                await bot.edit_message_text(text, chat_id=ADMIN_ID, message_id=report_id)
+        except Exception as e:
+            logger.warning(f"Media warm-up report failed: {e}")
+
+    if not todo:
+        if missing:
+            await report(final=True)
+        return
+
+    await report()
+    sem = asyncio.Semaphore(MEDIA_WARMUP_CONCURRENCY)
+    pace_lock = asyncio.Lock()
+    next_at = 0.0
+
+    async def upload(path: str):
+        nonlocal done, next_at
+        async with sem:
+            for attempt in range(3):
+                async with pace_lock:
+                    delay = next_at - _time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    next_at = _time.monotonic() + MEDIA_WARMUP_INTERVAL
+                a = paths[path]
+                try:
+                    m = await send_media(
+                        bot, a["kind"], path, thumbnail=a.get("thumb"), file_hash=a["hash"],
+                        chat_id=MEDIA_CACHE_CHAT_ID, disable_notification=True,
+                    )
+                    break
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                except Exception as e:
+                    failed.append(f"{path}: {e}")
+                    logger.warning(f"Media warm-up failed for {path}: {e}")
+                    return
+            else:
+                failed.append(f"{path}: RetryAfter x3")
                 return
-            except Exception as _e:
-                logging.warning(f"[send_tech] send_animation failed key={tech_key!r}: {_e}")
-                # fallback → text
+            try:
+                await bot.delete_message(MEDIA_CACHE_CHAT_ID, m.message_id)
+            except Exception:
+                pass
+            done += 1
+            if done % 10 == 0:
+                await report()
+
+    started = _time.monotonic()
+    await asyncio.gather(*(upload(p) for p in todo))
+    logger.info(
+        f"Media warm-up done in {_time.monotonic() - started:.1f}s: "
+        f"uploaded={done} failed={len(failed)} missing={len(missing)}"
+    )
+    await report(final=True)
+
+
+async def warm_up_media(bot: Bot):
+    # Сбой прогрева не должен ронять gather() в main()
+    _outbound_priority.set(PRIO_BROADCAST)
+    try:
+        await _warm_up_media(bot)
+    except Exception:
+        logger.exception("Media warm-up crashed")
+
+
+# =========================
+# МЕДИА: оптимизация клипов техники (offline)
+# =========================
+# python bot.py optimize-media [--force]
+# Перекодирует клипы техники (mp4 и gif → mp4 H.264) под бюджет размера,
+# делает превью и пишет manifest.json — send_tech берёт клип оттуда.
+# Нужны ffmpeg и ffprobe в PATH (только на машине, где запускается команда).
+# Исходники в media/tech остаются: по ним проверяется манифест и на них
+# фолбэк, если клипа нет, — сам деплой не меньше, экономия в отправке.
+MEDIA_OPTIMIZED_DIR = os.getenv("MEDIA_OPTIMIZED_DIR", "media/optimized")
+MEDIA_MANIFEST_PATH = os.path.join(MEDIA_OPTIMIZED_DIR, "manifest.json")
+MEDIA_MAX_WIDTH = int(os.getenv("MEDIA_MAX_WIDTH", "480"))
+MEDIA_MAX_KB = int(os.getenv("MEDIA_MAX_KB", "1024"))       # бюджет размера одного клипа
+MEDIA_VIDEO_KBPS = int(os.getenv("MEDIA_VIDEO_KBPS", "600"))  # потолок битрейта
+MEDIA_MAX_FPS = int(os.getenv("MEDIA_MAX_FPS", "30"))          # чаще — прореживаем, реже — как есть
+
+_optimized_media: Dict[str, dict] = {}
+_verified_sources: Dict[str, Tuple[int, int, str]] = {}  # исходник → (mtime_ns, size, hash)
+
+
+def _optimized_source_matches(key: str, entry: dict) -> bool:
+    """Клип собран из того исходника, который сейчас показал бы send_tech,
+    и исходник с тех пор не менялся (размер, затем хэш). Хэш пересчитывается,
+    только когда у исходника новые (mtime, size)."""
+    src = entry.get("source") or ""
+    if src != tech_clip_source(key):
+        return False
+    try:
+        st = os.stat(src)
+    except OSError:
+        return False
+    if st.st_size != entry.get("source_size"):
+        return False
+    cached = _verified_sources.get(src)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        src_hash = cached[2]
+    else:
+        src_hash = MediaRegistry._hash_file(src)
+        _verified_sources[src] = (st.st_mtime_ns, st.st_size, src_hash)
+    return src_hash == entry.get("source_hash")
+
+
+def load_optimized_media():
+    """Читает manifest.json оптимизатора (если он есть) в _optimized_media.
+    Клипы, чей исходник поменяли без перезапуска optimize-media, пропускаются —
+    вместо них send_tech покажет сам исходник."""
+    global _optimized_media
+    try:
+        with open(MEDIA_MANIFEST_PATH, encoding="utf-8") as f:
+            items = json.load(f).get("items") or {}
+        _optimized_media = {k: e for k, e in items.items() if _optimized_source_matches(k, e)}
+        outdated = len(items) - len(_optimized_media)
+        if outdated:
+            logger.warning(
+                f"Optimized media: {outdated} clips outdated (source changed) — run `python bot.py optimize-media`"
+            )
+        logger.info(f"Optimized media manifest: {len(_optimized_media)} clips")
+    except FileNotFoundError:
+        _optimized_media = {}
+    except Exception as e:
+        logger.warning(f"Optimized media manifest unreadable ({MEDIA_MANIFEST_PATH}): {e}")
+        _optimized_media = {}
+
+
+def tech_clip_source(tech_key: str) -> Optional[str]:
+    """Клип, который send_tech показал бы для ключа (по его приоритетам).
+    None — для ключа показывается картинка или медиа нет."""
+    item = TECH.get(tech_key, {})
+    video = TECH_VIDEOS.get(tech_key) or item.get("mp4")
+    if video and os.path.exists(video):
+        return video
+    img = TECH_IMAGES.get(tech_key) or item.get("img")
+    if img and os.path.exists(img):
+        return None
+    gif = TECH_GIFS.get(tech_key)
+    if gif and os.path.exists(gif):
+        return gif
+    return None
+
+
+def _ffprobe(path: str) -> dict:
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "stream=width,height,avg_frame_rate:format=duration", "-of", "json", path],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    info = json.loads(out or "{}")
+    stream = (info.get("streams") or [{}])[0]
+    try:
+        duration = float((info.get("format") or {}).get("duration") or 0)
+    except ValueError:
+        duration = 0.0
+    # avg_frame_rate — дробь «25/1»; «0/0», если ffprobe не знает
+    num, _, den = str(stream.get("avg_frame_rate") or "0/0").partition("/")
+    try:
+        fps = float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        fps = 0.0
+    return {"width": int(stream.get("width") or 0), "height": int(stream.get("height") or 0),
+            "duration": round(duration, 2), "fps": round(fps, 2)}
+
+
+def _ffmpeg_encode(src: str, dst: str, kbps: int, src_fps: float):
+    vf = f"scale='trunc(min({MEDIA_MAX_WIDTH},iw)/2)*2':-2:flags=lanczos"
+    if src_fps > MEDIA_MAX_FPS:
+        # Только вниз: поднять 10–15 fps гифки до 30 = дубли кадров и лишний вес
+        vf += f",fps={MEDIA_MAX_FPS}"
+    vf += ",format=yuv420p"
+    subprocess.run(
+        ["ffmpeg", "-y", "-v", "error", "-i", src, "-an", "-vf", vf,
+         "-c:v", "libx264", "-preset", "slow", "-crf", "28",
+         "-maxrate", f"{kbps}k", "-bufsize", f"{kbps * 2}k",
+         "-movflags", "+faststart", dst],
+        check=True, capture_output=True,
+    )
+
+
+def _ffmpeg_thumbnail(src: str, dst: str):
+    # Превью Telegram: JPEG до 320×320 и до 200 КБ
+    vf = "scale=320:320:force_original_aspect_ratio=decrease"
+    for seek in (["-ss", "0.5"], []):
+        subprocess.run(
+            ["ffmpeg", "-y", "-v", "error", *seek, "-i", src, "-frames:v", "1",
+             "-vf", vf, "-q:v", "5", dst],
+            capture_output=True,
+        )
+        if os.path.exists(dst) and os.path.getsize(dst) > 0:
+            return
+    raise RuntimeError("не удалось снять кадр для превью")
+
+
+def _subprocess_error(e: Exception) -> str:
+    if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+        err = e.stderr.decode(errors="replace") if isinstance(e.stderr, bytes) else e.stderr
+        return err.strip()[-300:]
+    return str(e)
+
+
+# Файлы оптимизатора: <имя>.<8 символов хэша исходника>.mp4/.jpg
+_OPTIMIZED_NAME_RE = re.compile(r"\.[0-9a-f]{8}\.(mp4|jpg)$")
+
+
+def optimize_media(force: bool = False) -> int:
+    """Прогоняет все клипы техники через ffmpeg, пишет manifest.json. Код возврата для CLI."""
+    for tool in ("ffmpeg", "ffprobe"):
+        if not shutil.which(tool):
+            print(f"❌ {tool} не найден в PATH")
+            return 1
+    os.makedirs(MEDIA_OPTIMIZED_DIR, exist_ok=True)
+    try:
+        with open(MEDIA_MANIFEST_PATH, encoding="utf-8") as f:
+            old_items = json.load(f).get("items") or {}
+    except (FileNotFoundError, ValueError):
+        old_items = {}
+
+    keys = sorted(set(TECH) | set(TECH_VIDEOS) | set(TECH_GIFS))
+    items: Dict[str, dict] = {}
+    by_source: Dict[str, dict] = {}  # один исходник на несколько ключей кодируем один раз
+    failed = 0
+    for key in keys:
+        src = tech_clip_source(key)
+        if not src:
+            continue
+        if src in by_source:
+            items[key] = by_source[src]
+            continue
+        src_hash = MediaRegistry._hash_file(src)
+        old = old_items.get(key)
+        if (not force and old and old.get("source") == src and old.get("source_hash") == src_hash
+                and old.get("max_fps") == MEDIA_MAX_FPS
+                and os.path.exists(old.get("video", "")) and os.path.exists(old.get("thumb", ""))):
+            items[key] = by_source[src] = old
+            print(f"= {key}: без изменений")
+            continue
+
+        stem = f"{os.path.splitext(os.path.basename(src))[0]}.{src_hash[:8]}"
+        video = os.path.join(MEDIA_OPTIMIZED_DIR, stem + ".mp4")
+        thumb = os.path.join(MEDIA_OPTIMIZED_DIR, stem + ".jpg")
+        try:
+            probe = _ffprobe(src)
+            kbps = MEDIA_VIDEO_KBPS
+            _ffmpeg_encode(src, video, kbps, probe["fps"])
+            budget = MEDIA_MAX_KB * 1024
+            if os.path.getsize(video) > budget and probe["duration"] > 0:
+                # Не влезли в бюджет — второй проход с битрейтом из длительности
+                kbps = max(100, int(budget * 8 / 1000 / probe["duration"] * 0.9))
+                _ffmpeg_encode(src, video, kbps, probe["fps"])
+            _ffmpeg_thumbnail(video, thumb)
+            out = _ffprobe(video)
+        except Exception as e:
+            failed += 1
+            print(f"❌ {key}: {src}: {_subprocess_error(e)}")
+            continue
+
+        entry = {
+            "source": src,
+            "source_hash": src_hash,
+            "source_size": os.path.getsize(src),
+            "video": video,
+            "thumb": thumb,
+            "size": os.path.getsize(video),
+            "kbps": kbps,
+            "max_fps": MEDIA_MAX_FPS,
+            **out,
+        }
+        items[key] = by_source[src] = entry
+        print(f"✅ {key}: {entry['source_size'] // 1024} КБ → {entry['size'] // 1024} КБ "
+              f"({out['width']}×{out['height']}, {out['duration']} с)")
+
+    # Удаляем свои же файлы, на которые больше не ссылается манифест
+    keep = {os.path.abspath(p) for e in items.values() for p in (e["video"], e["thumb"])}
+    for name in os.listdir(MEDIA_OPTIMIZED_DIR):
+        path = os.path.join(MEDIA_OPTIMIZED_DIR, name)
+        if _OPTIMIZED_NAME_RE.search(name) and os.path.abspath(path) not in keep:
+            os.remove(path)
+
+    tmp = MEDIA_MANIFEST_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": 1, "generated_at": datetime.utcnow().isoformat(), "items": items},
+                  f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp, MEDIA_MANIFEST_PATH)
+
+    unique = list(by_source.values())
+    before = sum(e["source_size"] for e in unique)
+    after = sum(e["size"] for e in unique)
+    print(f"\nКлипов: {len(unique)} (ключей: {len(items)}), ошибок: {failed}")
+    print(f"Размер отправки: {before / 1048576:.1f} МБ → {after / 1048576:.1f} МБ "
+          f"(исходники остаются в репозитории)")
+    print(f"Манифест: {MEDIA_MANIFEST_PATH}")
+    return 1 if failed else 0
+
+
+# =========================
+# МЕДИА: манифест
+# =========================
+MEDIA_MANIFEST_CHECK_SECONDS = float(os.getenv("MEDIA_MANIFEST_CHECK_SECONDS", "30"))
+
+
+class MediaManifest:
+    """
+    Готовые решения «что и как отправлять», чтобы не ходить на диск при каждом экране:
+    1. files — путь → {kind, path, size, hash} для каждого существующего файла из словарей
+       (и оптимизированных клипов); отсутствующие файлы — в missing.
+    2. tech — ключ техники → варианты отправки в порядке приоритета send_tech
+       (оптимизированный клип → видео → картинка → gif/mp4); обычно хватает первого.
+    Собирается при старте и заново — когда меняется mtime одной из папок с медиа
+    (файл добавили/удалили/переименовали) или (mtime, size) одного из файлов
+    (перезаписали на месте — mtime папки при этом не меняется). Проверяет
+    media_manifest_watch_loop. Сборка и changed() синхронные: звать через to_thread.
+    """
+    def __init__(self):
+        self.files: Dict[str, dict] = {}
+        self.tech: Dict[str, List[dict]] = {}
+        self.known: set = set()
+        self.missing: List[str] = []
+        self._dir_mtimes: Dict[str, int] = {}
+        self.builds = 0
+
+    @staticmethod
+    def _media_dirs() -> set:
+        dirs = {os.path.dirname(path) or "." for _, _, path in iter_media_sources() if path}
+        dirs.add(MEDIA_OPTIMIZED_DIR)
+        return dirs
+
+    def _current_mtimes(self) -> Dict[str, int]:
+        mtimes = {}
+        for d in self._media_dirs():
+            try:
+                mtimes[d] = os.stat(d).st_mtime_ns
+            except OSError:
+                mtimes[d] = 0
+        return mtimes
+
+    def changed(self) -> bool:
+        if self._current_mtimes() != self._dir_mtimes:
+            return True
+        for path, a in self.files.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                return True
+            if st.st_mtime_ns != a["mtime_ns"] or st.st_size != a["size"]:
+                return True
+        return False
+
+    def build(self):
+        mtimes = self._current_mtimes()  # до чтения файлов: изменения во время сборки поймаем следующей
+        load_optimized_media()
+        old_files = self.files
+        files: Dict[str, dict] = {}
+        known: set = set()
+        missing: List[str] = []
+
+        def asset(path: str) -> Optional[dict]:
+            if not path:
+                return None
+            known.add(path)
+            if path in files:
+                return files[path]
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            prev = old_files.get(path)
+            if prev and prev["mtime_ns"] == st.st_mtime_ns and prev["size"] == st.st_size:
+                file_hash = prev["hash"]
+            else:
+                file_hash = MediaRegistry._hash_file(path)
+            files[path] = {"kind": media_kind(path), "path": path, "size": st.st_size,
+                           "hash": file_hash, "mtime_ns": st.st_mtime_ns}
+            return files[path]
+
+        for source, key, path in iter_media_sources():
+            if path and asset(path) is None:
+                missing.append(f"{source}[{key}]: {path}")
+
+        tech: Dict[str, List[dict]] = {}
+        for key in set(TECH) | set(TECH_VIDEOS) | set(TECH_IMAGES) | set(TECH_GIFS):
+            item = TECH.get(key, {})
+            options: List[dict] = []
+            opt = _optimized_media.get(key)
+            if opt and asset(opt["video"]):
+                thumb = opt.get("thumb") if opt.get("thumb") and os.path.exists(opt["thumb"]) else None
+                files[opt["video"]]["thumb"] = thumb
+                options.append({**files[opt["video"]], "kind": "video", "thumb": thumb, "send_kwargs": {
+                    "width": opt.get("width") or None,
+                    "height": opt.get("height") or None,
+                    "duration": int(opt.get("duration") or 0) or None,
+                    "supports_streaming": True,
+                }})
+            gif = TECH_GIFS.get(key) or ""
+            for path, kind in (
+                (TECH_VIDEOS.get(key) or item.get("mp4"), "video"),
+                (TECH_IMAGES.get(key) or item.get("img"), "photo"),
+                # mp4 в TECH_GIFS отправляется как видео, остальное — как анимация
+                (gif, "video" if gif.lower().endswith(".mp4") else "animation"),
+            ):
+                a = asset(path)
+                if a and all(o["path"] != path for o in options):
+                    options.append({**a, "kind": kind})
+            if options:
+                tech[key] = options
+
+        self.files, self.tech, self.known, self.missing = files, tech, known, missing
+        self._dir_mtimes = mtimes
+        self.builds += 1
+        logger.info(f"Media manifest: {len(files)} files, {len(tech)} tech keys, {len(missing)} missing")
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self.files),
+            "tech": len(self.tech),
+            "missing": len(self.missing),
+            "bytes": sum(a["size"] for a in self.files.values()),
+            "builds": self.builds,
+        }
+
+
+_media_manifest = MediaManifest()
+
+
+def media_file(path: str) -> Optional[dict]:
+    """Файл из манифеста (None — его нет). Пути вне словарей медиа проверяются по диску."""
+    if not path:
+        return None
+    asset = _media_manifest.files.get(path)
+    if asset is None and path not in _media_manifest.known and os.path.exists(path):
+        return {"kind": media_kind(path), "path": path, "hash": None}
+    return asset
+
+
+async def media_manifest_watch_loop():
+    """Пересобирает манифест, если в папках с медиа что-то добавили/удалили/переименовали
+    или перезаписали файл."""
+    while True:
+        await asyncio.sleep(MEDIA_MANIFEST_CHECK_SECONDS)
+        try:
+            if await asyncio.to_thread(_media_manifest.changed):
+                logger.info("Media directories changed, rebuilding manifest")
+                await asyncio.to_thread(_media_manifest.build)
+        except Exception as e:
+            logger.warning(f"Media manifest refresh failed: {e}")
+
+
+# =========================
+# ЭКРАНЫ: единый рендер
+# =========================
+# Telegram: caption у фото/видео — максимум 1024 символа, оставляем запас.
+CAPTION_LIMIT = 1020
+
+# Последний экран чата: chat_id -> (message_id, path медиа, хэш экрана, id фото над текстом).
+# path — чтобы при том же файле править только подпись (edit_message_caption),
+# хэш — чтобы не слать в Telegram правку, которая ничего не меняет,
+# id фото — у длинного экрана (фото отдельным сообщением над текстом), чтобы
+# оставить его при правке текста и удалить, когда экран сменится.
+_screens: "OrderedDict[int, Tuple[int, Optional[str], str, Optional[int]]]" = OrderedDict()
+_SCREENS_MAX = 20000
+
+_render_stats = {
+    "edit_text": 0, "edit_caption": 0, "edit_media": 0, "resend": 0,
+    "edit_failed": 0, "unchanged": 0, "superseded": 0,
+}
+
+
+def message_kind(m) -> Optional[str]:
+    """Что в сообщении бота: photo / video / animation / text.
+    None — неизвестно (сообщение недоступно, документ и т.п.) — его не правим."""
+    if m is None:
+        return None
+    if getattr(m, "photo", None):
+        return "photo"
+    if getattr(m, "animation", None):
+        return "animation"
+    if getattr(m, "video", None):
+        return "video"
+    if getattr(m, "text", None) is not None:
+        return "text"
+    return None
+
+
+def _screen_digest(text: str, reply_markup, asset: Optional[dict]) -> str:
+    """Хэш того, что видит пользователь: текст/подпись, клавиатура, файл."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(text.encode("utf-8", "surrogatepass"))
+    h.update(b"\0")
+    if reply_markup is not None:
+        h.update(reply_markup.model_dump_json(exclude_none=True).encode())
+    h.update(b"\0")
+    if asset:
+        h.update(f"{asset['kind']}:{asset['path']}:{asset.get('hash') or ''}".encode())
+    return h.hexdigest()
+
+
+def _is_not_modified(e: Exception) -> bool:
+    return isinstance(e, TelegramBadRequest) and "message is not modified" in str(e).lower()
+
+
+async def _screen_shown(user_id: int, chat_id: int, message_id: int,
+                        path: Optional[str], digest: str, photo_id: Optional[int] = None) -> int:
+    _screens[chat_id] = (message_id, path, digest, photo_id)
+    _screens.move_to_end(chat_id)
+    while len(_screens) > _SCREENS_MAX:
+        _screens.popitem(last=False)
+    await set_last_bot_msg_id(user_id, message_id)
+    return message_id
 
-    # ── Вариант 4: только текст ───────────────────────────────────────────────
+
+async def render_screen(
+    bot: Bot,
+    chat_id: int,
+    user_id: int,
+    text: str,
+    reply_markup=None,
+    media: Sequence[dict] = (),
+    caption: Optional[str] = None,
+    current: Optional[Message] = None,
+) -> int:
+    """Показывает экран: текст или медиа с подписью. Возвращает message_id.
+
+    current — сообщение, на котором нажали кнопку (callback.message).
+    Оно правится на месте, если Telegram это позволяет:
+      текст → текст            — edit_message_text
+      медиа → тот же файл      — edit_message_caption
+      медиа → другое медиа     — edit_message_media (фото ↔ видео тоже можно)
+    Текст ↔ медиа поменять нельзя — тогда (и без current) предыдущее главное
+    сообщение удаляется и отправляется новое.
+    Если current показывает ровно этот экран (тот же хэш текста, клавиатуры
+    и медиа) — запроса в Telegram нет вовсе; ответ «message is not modified»
+    тоже считается успехом, а не поводом слать сообщение заново.
+
+    media — варианты файла по приоритету (ассеты манифеста: kind/path/hash/...);
+    при отправке пробуются по очереди, если все упали — уходит только текст.
+    caption — подпись к медиа. Если не задана, подпись = text, а текст длиннее
+    CAPTION_LIMIT не влезает в подпись: тогда экран — фото без подписи и под ним
+    текст с клавиатурой. Такой экран правится на месте только текстом (если фото
+    над ним то же), иначе — delete + send; фото удаляется вместе с экраном.
+    Если за этим нажатием на current уже ждёт следующее (render_superseded) —
+    не рисуем ничего: итоговое состояние покажет последнее нажатие.
+    """
+    if current is not None and render_superseded(chat_id, current.message_id):
+        _render_stats["superseded"] += 1
+        return current.message_id
+    media = [a for a in media if a]
+    split = caption is None and len(text) > CAPTION_LIMIT and bool(media)
+    if caption is None:
+        caption = text
+    shown = _screens.get(chat_id)
+    kind = message_kind(current)
+
+    if split:
+        # На месте — только текст под тем же фото
+        keep = kind == "text" and shown and shown[0] == current.message_id and shown[3]
+        asset = next((a for a in media if keep and a["path"] == shown[1]), None)
+        editable, photo_id = asset is not None, shown[3] if asset else None
+    else:
+        asset = media[0] if media else None
+        editable, photo_id = bool(kind) and (kind == "text") == (not media), None
+
+    if editable:
+        msg_id = current.message_id
+        path = asset["path"] if asset else None
+        digest = _screen_digest(caption if asset and not split else text, reply_markup, asset)
+        if shown == (msg_id, path, digest, photo_id):
+            _render_stats["unchanged"] += 1
+            await set_last_bot_msg_id(user_id, msg_id)
+            return msg_id
+        try:
+            try:
+                if split or not asset:
+                    await bot.edit_message_text(
+                        text=text, chat_id=chat_id, message_id=msg_id, reply_markup=reply_markup
+                    )
+                    _render_stats["edit_text"] += 1
+                elif shown and shown[:2] == (msg_id, path):
+                    await bot.edit_message_caption(
+                        chat_id=chat_id, message_id=msg_id, caption=caption, reply_markup=reply_markup
+                    )
+                    _render_stats["edit_caption"] += 1
+                else:
+                    await edit_media(bot, chat_id, msg_id, asset, caption, reply_markup)
+                    _render_stats["edit_media"] += 1
+            except Exception as e:
+                if not _is_not_modified(e):
+                    raise
+                _render_stats["unchanged"] += 1
+            if shown and shown[3] and shown[3] != photo_id:
+                await _delete_quietly(bot, chat_id, shown[3])  # фото длинного экрана больше не нужно
+            return await _screen_shown(user_id, chat_id, msg_id, path, digest, photo_id)
+        except Exception as e:
+            _render_stats["edit_failed"] += 1
+            logger.warning(f"render_screen: не удалось изменить сообщение {msg_id}: {e}")
+
+    # ── delete + send ───────────────────────────────────────────────────────
+    _render_stats["resend"] += 1
+    last_id = await get_last_bot_msg_id(user_id)
+    if last_id:
+        await _delete_quietly(bot, chat_id, last_id)
+    if shown and shown[3]:
+        await _delete_quietly(bot, chat_id, shown[3])
+    for asset in media:
+        try:
+            m = await send_media(
+                bot, asset["kind"], asset["path"],
+                thumbnail=asset.get("thumb"), file_hash=asset["hash"], chat_id=chat_id,
+                **({} if split else {"caption": caption, "reply_markup": reply_markup}),
+                **asset.get("send_kwargs", {}),
+            )
+        except Exception as e:
+            logger.warning(f"render_screen: send_{asset['kind']} {asset['path']} не удалось: {e}")
+            continue
+        if not split:
+            return await _screen_shown(
+                user_id, chat_id, m.message_id, asset["path"],
+                _screen_digest(caption, reply_markup, asset),
+            )
+        t = await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+        return await _screen_shown(
+            user_id, chat_id, t.message_id, asset["path"],
+            _screen_digest(text, reply_markup, asset), m.message_id,
+        )
     m = await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-    await set_last_bot_msg_id(user_id, m.message_id)
+    return await _screen_shown(
+        user_id, chat_id, m.message_id, None, _screen_digest(text, reply_markup, None)
+    )
+
+
+async def _delete_quietly(bot: Bot, chat_id: int, message_id: int):
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except Exception:
+        pass
+
+
+def _image_asset(path: str) -> Optional[dict]:
+    """Картинка раздела как ассет для render_screen (None — файла нет)."""
+    image = media_file(path)
+    return {**image, "kind": "photo"} if image else None
+
+
+async def _send_with_image(
+    bot: Bot, chat_id: int, user_id: int,
+    text: str, image_key: str, reply_markup=None,
+    callback: Optional[CallbackQuery] = None,
+):
+    """Экран с фото из IMAGE_PATHS[image_key].
+    Если файл не найден — обычный текст.
+    С callback — текущее сообщение правится на месте, иначе предыдущее
+    главное сообщение бота удаляется (чистый чат)."""
+    return await render_screen(
+        bot, chat_id, user_id, text, reply_markup=reply_markup,
+        media=[_image_asset(IMAGE_PATHS.get(image_key, ""))],
+        current=callback.message if callback else None,
+    )
+
+
+async def send_section(
+    bot: Bot,
+    chat_id: int,
+    user_id: int,
+    image_path: str,
+    text: str,
+    reply_markup=None,
+    callback: Optional[CallbackQuery] = None,
+):
+    """Универсальная отправка раздела с картинкой из локального файла.
+
+    Логика (см. render_screen):
+    - Если callback передан — текущее сообщение правится на месте
+      (фото меняется через edit_message_media, текст — edit_message_text).
+    - Без callback — предыдущее сообщение удаляется, отправляется новое.
+    - Текст > CAPTION_LIMIT символов → фото без подписи, под ним текст с кнопками.
+    - Если файла нет (или ошибка) → обычный текст.
+    - Бот никогда не падает: все ошибки обёрнуты в try/except + warning-лог.
+    """
+    await render_screen(
+        bot, chat_id, user_id, text, reply_markup=reply_markup,
+        media=[_image_asset(image_path)],
+        current=callback.message if callback else None,
+    )
+
+
+async def send_screen(
+    message: Message,
+    text: str,
+    image_key: Optional[str] = None,
+    reply_markup=None,
+    edit: bool = False,
+):
+    """Универсальная функция отправки экрана с опциональным изображением.
+    Если edit=True — message (сообщение бота) правится на месте, иначе отправляем новое.
+    Если image_key указан и файл существует — экран с фото."""
+    path = IMAGE_PATHS.get(image_key or "", "") if image_key else ""
+    await render_screen(
+        message.bot, message.chat.id, message.from_user.id if message.from_user else 0,
+        text, reply_markup=reply_markup,
+        media=[_image_asset(path)],
+        current=message if edit else None,
+    )
+
+
+async def send_tech(
+    bot: Bot, chat_id: int, user_id: int,
+    tech_key: str, text: str, reply_markup=None,
+    callback: Optional[CallbackQuery] = None,
+):
+    """Универсальная отправка техники упражнения.
+
+    Приоритет медиа:
+      0. Оптимизированный клип из media/optimized/manifest.json
+         (python bot.py optimize-media) — send_video с превью
+      1. TECH_VIDEOS[key]  или  TECH[key]["mp4"]  — send_video (mp4)
+      2. TECH_IMAGES[key]  или  TECH[key]["img"]  — send_photo (jpg/png)
+      3. TECH_GIFS[key]
+           • путь .mp4  → send_video
+           • путь .gif  → send_animation
+      4. только текст — send_message (graceful fallback)
+
+    Текст всегда в одном сообщении с медиа — caption обрезается умно по \n.
+    Какие файлы есть и в каком порядке их пробовать, заранее знает
+    MediaManifest (_media_manifest.tech[key]) — на диск при отправке не ходим.
+
+    Как добавить видео к упражнению (3 способа):
+      А) Положи файл media/tech/<key>.mp4, пропиши в TECH_VIDEOS[key] — приоритет 1.
+      Б) Пропиши путь прямо в TECH[key]["mp4"] = "media/tech/..." — приоритет 1.
+      В) Пропиши в TECH_GIFS[key] = "media/tech/<key>.mp4" — приоритет 3
+         (если нет TECH_VIDEOS и нет TECH_IMAGES для данного ключа).
+      Хендлеры менять не нужно — заработает автоматически.
+
+    callback — если передан, экран техники заменяет текущее сообщение на месте
+    (edit_message_media), иначе предыдущее главное сообщение удаляется."""
+
+    # ── Умная обрезка caption ────────────────────────────────────────────────
+    # Обрезаем по последнему переносу строки перед лимитом.
+    def make_caption(t: str) -> str:
+        if len(t) <= CAPTION_LIMIT:
+            return t
+        cut = t[:CAPTION_LIMIT]
+        last_nl = cut.rfind("\n")
+        if last_nl > CAPTION_LIMIT // 2:
+            return cut[:last_nl] + "\n…"
+        return cut + "…"
+
+    # Варианты медиа: порядок приоритетов уже разрешён в манифесте.
+    # Обычно срабатывает первый; следующий — только если отправка упала;
+    # если не сработал ни один — только текст.
+    await render_screen(
+        bot, chat_id, user_id, text, reply_markup=reply_markup,
+        media=_media_manifest.tech.get(tech_key, ()),
+        caption=make_caption(text),
+        current=callback.message if callback else None,
+    )
 
 
 # Обратная совместимость — старое имя перенаправляет на новое
@@ -3277,17 +4419,274 @@ _send_tech_with_gif = send_tech
 # =========================
 # DB
 # =========================
-@asynccontextmanager
-async def db():
-    conn = await aiosqlite.connect(DB_PATH)
-    try:
-        await conn.execute("PRAGMA journal_mode=WAL;")
-        await conn.execute("PRAGMA synchronous=NORMAL;")
-        await conn.execute("PRAGMA foreign_keys=ON;")
-        await conn.execute("PRAGMA busy_timeout=5000;")
-        yield conn
-    finally:
-        await conn.close()
+# Сколько соединений-читателей держать открытыми (писатель всегда один).
+DB_READERS = max(1, int(os.getenv("DB_READERS", "4")))
+
+_DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA foreign_keys=ON;",
+    "PRAGMA busy_timeout=5000;",
+)
+
+
+class DbPool:
+    """
+    Пул долгоживущих соединений SQLite:
+    1. Один писатель — под asyncio.Lock, транзакции не перемешиваются.
+    2. Несколько читателей — в WAL читают параллельно с писателем.
+    PRAGMA выполняются один раз при открытии соединения.
+    Ведёт статистику: сколько раз брали соединение и сколько ждали.
+    """
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.readers_total = readers
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock = asyncio.Lock()
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._all: List[aiosqlite.Connection] = []
+        self._open_lock = asyncio.Lock()
+        self.opened_at: Optional[float] = None
+        self.acquired = {"read": 0, "write": 0}
+        self.wait_total = {"read": 0.0, "write": 0.0}
+        self.wait_max = {"read": 0.0, "write": 0.0}
+        self.in_use = {"read": 0, "write": 0}
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path)
+        for pragma in _DB_PRAGMAS:
+            await conn.execute(pragma)
+        self._all.append(conn)
+        return conn
+
+    async def open(self):
+        if self.opened_at is not None:
+            return
+        async with self._open_lock:
+            if self.opened_at is not None:
+                return
+            # Писатель первым: он переводит файл в WAL до открытия читателей
+            self._writer = await self._connect()
+            for _ in range(self.readers_total):
+                self._readers.put_nowait(await self._connect())
+            self.opened_at = _time.monotonic()
+            logger.info(f"DB pool opened: path={self.path} readers={self.readers_total}")
+
+    async def close(self):
+        if self.opened_at is None:
+            return
+        async with self._writer_lock:
+            for conn in self._all:
+                try:
+                    await conn.close()
+                except Exception:
+                    pass
+            self._all.clear()
+            self._writer = None
+            self._readers = asyncio.Queue()
+            self.opened_at = None
+        logger.info("DB pool closed")
+
+    @asynccontextmanager
+    async def connection(self, readonly: bool = False):
+        await self.open()
+        kind = "read" if readonly else "write"
+        t0 = _time.monotonic()
+        if readonly:
+            conn = await self._readers.get()
+        else:
+            await self._writer_lock.acquire()
+            conn = self._writer
+        waited = _time.monotonic() - t0
+        self.acquired[kind] += 1
+        self.wait_total[kind] += waited
+        self.wait_max[kind] = max(self.wait_max[kind], waited)
+        self.in_use[kind] += 1
+        try:
+            yield conn
+        finally:
+            try:
+                if conn.in_transaction:
+                    # Как и при прежнем close(): незакоммиченное откатываем,
+                    # чтобы следующий владелец не закоммитил чужие изменения.
+                    await conn.rollback()
+            except Exception:
+                logger.exception("DB pool: rollback failed")
+            finally:
+                self.in_use[kind] -= 1
+                if readonly:
+                    self._readers.put_nowait(conn)
+                else:
+                    self._writer_lock.release()
+
+    def stats(self) -> dict:
+        def avg_ms(kind: str) -> float:
+            n = self.acquired[kind]
+            return (self.wait_total[kind] / n * 1000) if n else 0.0
+        return {
+            "readers_total": self.readers_total,
+            "readers_idle": self._readers.qsize(),
+            "writer_busy": self._writer_lock.locked(),
+            "acquired_read": self.acquired["read"],
+            "acquired_write": self.acquired["write"],
+            "wait_avg_ms_read": round(avg_ms("read"), 2),
+            "wait_avg_ms_write": round(avg_ms("write"), 2),
+            "wait_max_ms_read": round(self.wait_max["read"] * 1000, 2),
+            "wait_max_ms_write": round(self.wait_max["write"] * 1000, 2),
+        }
+
+
+_db_pool = DbPool(DB_PATH, DB_READERS)
+
+
+def db(readonly: bool = False):
+    """Соединение из пула. readonly=True — читатель, иначе — писатель.
+    Использование не изменилось: `async with db() as conn: ...`."""
+    return _db_pool.connection(readonly)
+
+
+# Group commit: пачка закрывается по времени или по размеру — что наступит раньше.
+DB_COMMIT_WINDOW_MS = max(0, int(os.getenv("DB_COMMIT_WINDOW_MS", "10")))
+DB_COMMIT_BATCH = max(1, int(os.getenv("DB_COMMIT_BATCH", "64")))
+
+SqlStatement = Tuple[str, tuple]
+
+
+class WriteQueue:
+    """
+    Очередь мелких записей с group commit:
+    1. Хендлеры кладут задания (одно или несколько SQL-выражений).
+    2. Одна фоновая задача собирает их в пачку и коммитит одной транзакцией —
+       один fsync на пачку вместо одного на каждую запись.
+    3. Каждое задание выполняется в своём SAVEPOINT: ошибка в одном
+       не откатывает остальные задания пачки.
+    """
+    def __init__(self, window_ms: int, batch_size: int):
+        self.window = window_ms / 1000
+        self.batch_size = batch_size
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self.jobs = 0
+        self.batches = 0
+        self.failed = 0
+        self.max_batch = 0
+
+    def submit(self, statements: List[SqlStatement]) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((statements, fut))
+        if self._task is None or self._task.done():
+            # Свежий контекст: фоновая задача живёт дольше апдейта,
+            # в котором её запустили, и не должна держать его снимок.
+            self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+        return fut
+
+    async def _collect(self, first) -> list:
+        batch = [first]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+        while len(batch) < self.batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            batch = await self._collect(first)
+            stop = None in batch
+            await self._commit([job for job in batch if job is not None])
+            if stop:
+                return
+
+    async def _commit(self, batch: list):
+        results = []
+        try:
+            async with db() as conn:
+                await conn.execute("BEGIN")
+                for statements, fut in batch:
+                    rowcount = 0
+                    try:
+                        await conn.execute("SAVEPOINT wq_job")
+                        for sql, params in statements:
+                            cur = await conn.execute(sql, params)
+                            rowcount += max(cur.rowcount, 0)
+                        await conn.execute("RELEASE wq_job")
+                        results.append((fut, rowcount, None))
+                    except Exception as e:
+                        await conn.execute("ROLLBACK TO wq_job")
+                        await conn.execute("RELEASE wq_job")
+                        results.append((fut, 0, e))
+                await conn.commit()
+        except Exception as e:
+            logger.exception("WriteQueue: batch commit failed")
+            results = [(fut, 0, e) for _, fut in batch]
+
+        self.batches += 1
+        self.jobs += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        for fut, rowcount, err in results:
+            if err is not None:
+                self.failed += 1
+            if fut.done():
+                continue
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(rowcount)
+
+    async def stop(self):
+        """Дописывает всё, что уже в очереди, и останавливает фоновую задачу."""
+        if self._task is None or self._task.done():
+            return
+        self._queue.put_nowait(None)
+        await self._task
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "jobs": self.jobs,
+            "batches": self.batches,
+            "avg_batch": round(self.jobs / self.batches, 2) if self.batches else 0.0,
+            "max_batch": self.max_batch,
+            "failed": self.failed,
+        }
+
+
+_write_queue = WriteQueue(DB_COMMIT_WINDOW_MS, DB_COMMIT_BATCH)
+
+
+async def db_write(*statements: SqlStatement) -> int:
+    """Запись через group commit. Возвращает управление после коммита
+    (запись надёжна), результат — суммарный rowcount выражений."""
+    return await _write_queue.submit(list(statements))
+
+
+def _log_write_error(fut: asyncio.Future):
+    if not fut.cancelled() and fut.exception() is not None:
+        logger.warning(f"db_write_nowait failed: {fut.exception()}")
+
+
+def db_write_nowait(*statements: SqlStatement):
+    """Запись через group commit без ожидания коммита (fire-and-forget).
+    Ошибки только логируются."""
+    _write_queue.submit(list(statements)).add_done_callback(_log_write_error)
+
+
+async def close_db():
+    # Отложенные id сообщений сбрасываем до остановки очереди записи
+    await _bot_state_cache.close()
+    await _write_queue.stop()
+    await _db_pool.close()
 
 
 async def init_db():
@@ -3311,18 +4710,6 @@ async def init_db():
         )
         """)
 
-        for col, typ in [
-            ("limits", "TEXT"),
-            ("state", "TEXT"),
-            ("meals", "INTEGER"),
-            ("activity", "INTEGER"),
-            ("activity_factor", "REAL"),
-        ]:
-            try:
-                await conn.execute(f"ALTER TABLE users ADD COLUMN {col} {typ}")
-            except Exception:
-                pass
-
         await conn.execute("""
         CREATE TABLE IF NOT EXISTS access (
             user_id INTEGER PRIMARY KEY,
@@ -3335,15 +4722,6 @@ async def init_db():
             remind_stage INTEGER NOT NULL DEFAULT -1
         )
         """)
-        for _col, _typ in [
-            ("plan_regens_left", "INTEGER DEFAULT NULL"),
-            ("tariff_name",      "TEXT NOT NULL DEFAULT 'Нет'"),
-            ("remind_stage",     "INTEGER NOT NULL DEFAULT -1"),
-        ]:
-            try:
-                await conn.execute(f"ALTER TABLE access ADD COLUMN {_col} {_typ}")
-            except Exception:
-                pass
 
         await conn.execute("""
         CREATE TABLE IF NOT EXISTS payments (
@@ -3367,10 +4745,6 @@ async def init_db():
             updated_at TEXT
         )
         """)
-        try:
-            await conn.execute("ALTER TABLE workout_plans ADD COLUMN plan_json TEXT")
-        except Exception:
-            pass
 
         await conn.execute("""
         CREATE TABLE IF NOT EXISTS nutrition_plans (
@@ -3415,13 +4789,6 @@ async def init_db():
             diary_prompt_msg_id INTEGER
         )
         """)
-        for col, typ in [
-            ("diary_prompt_msg_id", "INTEGER"),
-        ]:
-            try:
-                await conn.execute(f"ALTER TABLE bot_state ADD COLUMN {col} {typ}")
-            except Exception:
-                pass
 
         await conn.execute("""
         CREATE TABLE IF NOT EXISTS posts (
@@ -3493,41 +4860,647 @@ async def init_db():
         """)
         await conn.commit()
 
+    await run_migrations()
 
-async def ensure_user(user_id: int, username: str):
-    now = datetime.utcnow().isoformat()
+
+# =========================
+# МИГРАЦИИ СХЕМЫ
+# =========================
+# Базовые таблицы создаёт init_db (CREATE TABLE IF NOT EXISTS), всё, что
+# менялось после, — пронумерованные шаги ниже. Применённые версии пишутся
+# в schema_version, поэтому каждый шаг выполняется ровно один раз.
+# Шаги идемпотентны: если упасть посередине, повторный запуск безопасен.
+#
+# Как добавить миграцию: напиши async-функцию без аргументов и добавь
+# (следующий_номер, "описание", функция) в конец SCHEMA_MIGRATIONS.
+# Номера не переиспользуются и не меняются.
+
+MIGRATION_CHUNK = max(1, int(os.getenv("MIGRATION_CHUNK", "500")))
+
+
+async def _table_columns(conn, table: str) -> List[str]:
+    async with conn.execute(f"PRAGMA table_info({table})") as cur:
+        return [r[1] for r in await cur.fetchall()]
+
+
+def _add_columns(table: str, columns: List[Tuple[str, str]]):
+    """Шаг миграции: ADD COLUMN только для отсутствующих колонок."""
+    async def step():
+        async with db() as conn:
+            existing = await _table_columns(conn, table)
+            for col, typ in columns:
+                if col not in existing:
+                    await conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {typ}")
+            await conn.commit()
+    return step
+
+
+def _create_indexes(indexes: List[str]):
+    """Шаг миграции: CREATE INDEX IF NOT EXISTS ... по одному на транзакцию,
+    чтобы не держать блокировку записи на все индексы сразу."""
+    async def step():
+        for ddl in indexes:
+            async with db() as conn:
+                await conn.execute(ddl)
+                await conn.commit()
+            await asyncio.sleep(0)
+    return step
+
+
+async def _backfill_in_chunks(version: int, table: str, set_sql: str,
+                              where_sql: str = "1=1", params: tuple = (),
+                              or_ignore: bool = False):
+    """UPDATE большой таблицы порциями по MIGRATION_CHUNK строк (по rowid).
+    Каждая порция — своя короткая транзакция, в ней же сохраняется прогресс
+    в schema_backfill. После рестарта продолжаем с последней порции.
+    or_ignore — UPDATE OR IGNORE: строки, нарушающие уникальный индекс, пропускаются."""
+    async with db(readonly=True) as conn:
+        async with conn.execute(
+            "SELECT last_rowid FROM schema_backfill WHERE version=?", (version,)
+        ) as cur:
+            row = await cur.fetchone()
+        async with conn.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}") as cur:
+            max_rowid = (await cur.fetchone())[0]
+    last = row[0] if row else 0
+
+    while last < max_rowid:
+        hi = last + MIGRATION_CHUNK
+        async with db() as conn:
+            verb = "UPDATE OR IGNORE" if or_ignore else "UPDATE"
+            await conn.execute(
+                f"{verb} {table} SET {set_sql} WHERE rowid > ? AND rowid <= ? AND ({where_sql})",
+                params + (last, hi)
+            )
+            await conn.execute("""
+                INSERT INTO schema_backfill (version, last_rowid, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(version) DO UPDATE SET
+                    last_rowid=excluded.last_rowid, updated_at=excluded.updated_at
+            """, (version, hi, datetime.utcnow().isoformat()))
+            await conn.commit()
+        last = hi
+        await asyncio.sleep(0)  # даём поработать остальным задачам
+
+
+async def _m6_backfill_tariff_name():
+    # Оплаченные до появления tariff_name строки остались с 'Нет'
+    cases = " ".join("WHEN ? THEN ?" for _ in TARIFFS)
+    params = tuple(x for code, t in TARIFFS.items() for x in (code, t["title"]))
+    await _backfill_in_chunks(
+        6, "access",
+        f"tariff_name = CASE tariff {cases} ELSE tariff_name END",
+        "paid=1 AND tariff IS NOT NULL AND tariff_name='Нет'",
+        params,
+    )
+
+
+async def _m9_media_file_ids():
     async with db() as conn:
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS media_file_ids (
+            path TEXT PRIMARY KEY,
+            file_hash TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at TEXT
+        )
+        """)
+        await conn.commit()
+
+
+async def _m10_resumable_broadcasts():
+    await _add_columns("users", [("blocked_at", "TEXT")])()
+    await _add_columns("posts", [("progress_msg_id", "INTEGER")])()
+    async with db() as conn:
+        # Раньше в post_sends писались только ошибки, и при повторной отправке
+        # могли появиться дубли — оставляем последнюю запись на пару.
+        await conn.execute("""
+            DELETE FROM post_sends WHERE id NOT IN (
+                SELECT MAX(id) FROM post_sends GROUP BY post_id, user_id
+            )
+        """)
         await conn.execute(
-            "INSERT OR IGNORE INTO users (user_id, username, created_at) VALUES (?, ?, ?)",
-            (user_id, username or "", now)
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_post_sends_post_user ON post_sends(post_id, user_id)"
         )
+        await conn.commit()
+
+
+async def _m11_payment_reconcile():
+    # Расписание фоновой сверки pending-платежей хранится в самой строке платежа
+    await _add_columns("payments", [
+        ("next_check_at", "TEXT"),
+        ("check_attempts", "INTEGER NOT NULL DEFAULT 0"),
+    ])()
+    await _create_indexes([
+        "CREATE INDEX IF NOT EXISTS idx_payments_status_next_check ON payments(status, next_check_at)",
+    ])()
+
+
+async def _m12_provider_payment_id():
+    await _add_columns("payments", [("provider_payment_id", "TEXT")])()
+    async with db() as conn:
+        # Индекс — до заполнения: дубли (если вдруг есть) не пройдут в колонку,
+        # вместо того чтобы сломать создание индекса
         await conn.execute(
-            "INSERT OR IGNORE INTO access (user_id, paid, tariff, expires_at, paid_at) VALUES (?, 0, NULL, NULL, NULL)",
-            (user_id,)
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_provider_id "
+            "ON payments(provider_payment_id) WHERE provider_payment_id IS NOT NULL"
+        )
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS payment_status_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payment_id INTEGER NOT NULL,
+            old_status TEXT,
+            new_status TEXT NOT NULL,
+            source TEXT,
+            created_at TEXT
         )
+        """)
         await conn.execute(
-            "INSERT OR IGNORE INTO bot_state (user_id, last_bot_msg_id, diary_prompt_msg_id) VALUES (?, NULL, NULL)",
-            (user_id,)
+            "CREATE INDEX IF NOT EXISTS idx_payment_status_log_payment ON payment_status_log(payment_id)"
         )
         await conn.commit()
+    # Платежи ЮКассы хранили её id в receipt_file_id; pending из них — сразу в сверку
+    await _backfill_in_chunks(
+        12, "payments",
+        "provider_payment_id = receipt_file_id, "
+        "next_check_at = CASE WHEN status='pending' THEN created_at ELSE next_check_at END",
+        "last4='yukassa' AND provider_payment_id IS NULL AND receipt_file_id IS NOT NULL "
+        "AND receipt_file_id != ''",
+        or_ignore=True,
+    )
 
 
-async def get_user(user_id: int):
+SCHEMA_MIGRATIONS = [
+    (1, "users: limits/state/meals/activity/activity_factor", _add_columns("users", [
+        ("limits", "TEXT"),
+        ("state", "TEXT"),
+        ("meals", "INTEGER"),
+        ("activity", "INTEGER"),
+        ("activity_factor", "REAL"),
+    ])),
+    (2, "access: plan_regens_left/tariff_name/remind_stage", _add_columns("access", [
+        ("plan_regens_left", "INTEGER DEFAULT NULL"),
+        ("tariff_name",      "TEXT NOT NULL DEFAULT 'Нет'"),
+        ("remind_stage",     "INTEGER NOT NULL DEFAULT -1"),
+    ])),
+    (3, "workout_plans: plan_json", _add_columns("workout_plans", [
+        ("plan_json", "TEXT"),
+    ])),
+    (4, "bot_state: diary_prompt_msg_id", _add_columns("bot_state", [
+        ("diary_prompt_msg_id", "INTEGER"),
+    ])),
+    (5, "workout_completions: day_title", _add_columns("workout_completions", [
+        ("day_title", "TEXT DEFAULT ''"),
+    ])),
+    (6, "access: backfill tariff_name", _m6_backfill_tariff_name),
+    (7, "indexes for hot queries", _create_indexes([
+        "CREATE INDEX IF NOT EXISTS idx_workout_completions_user_date "
+        "ON workout_completions(user_id, completed_date, day_num)",
+        "CREATE INDEX IF NOT EXISTS idx_measurements_user_type ON measurements(user_id, mtype)",
+        "CREATE INDEX IF NOT EXISTS idx_diary_sessions_user_date ON diary_sessions(user_id, session_date)",
+        "CREATE INDEX IF NOT EXISTS idx_diary_sets_session ON diary_sets(session_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_receipt ON payments(receipt_file_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_status_created "
+        "ON payments(user_id, status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_access_paid_expires ON access(paid, expires_at)",
+    ])),
+    (8, "diary_sessions: keyset index for history pages", _create_indexes([
+        "CREATE INDEX IF NOT EXISTS idx_diary_sessions_user_id ON diary_sessions(user_id, id)",
+    ])),
+    (9, "media_file_ids: Telegram file_id registry", _m9_media_file_ids),
+    (10, "broadcasts: users.blocked_at, posts.progress_msg_id, unique post_sends",
+     _m10_resumable_broadcasts),
+    (11, "payments: next_check_at/check_attempts for pending reconciliation", _m11_payment_reconcile),
+    (12, "payments: provider_payment_id (unique) + payment_status_log", _m12_provider_payment_id),
+    (13, "posts: index by status for resuming broadcasts", _create_indexes([
+        "CREATE INDEX IF NOT EXISTS idx_posts_status ON posts(status)",
+    ])),
+]
+
+
+async def run_migrations():
     async with db() as conn:
-        async with conn.execute("""
-            SELECT user_id, username, goal, sex, age, height, weight, place, exp, freq, meals, limits, state, activity, activity_factor
-            FROM users WHERE user_id=?
-        """, (user_id,)) as cur:
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TEXT
+        )
+        """)
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_backfill (
+            version INTEGER PRIMARY KEY,
+            last_rowid INTEGER,
+            updated_at TEXT
+        )
+        """)
+        await conn.commit()
+        async with conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version") as cur:
+            current = (await cur.fetchone())[0]
+
+    for version, name, step in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info(f"Migration {version}: {name}")
+        t0 = _time.monotonic()
+        await step()
+        async with db() as conn:
+            await conn.execute(
+                "INSERT OR IGNORE INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, datetime.utcnow().isoformat())
+            )
+            await conn.commit()
+        logger.info(f"Migration {version} done in {_time.monotonic() - t0:.2f}s")
+
+
+# =========================
+# АУДИТ ПЛАНОВ ЗАПРОСОВ
+# =========================
+# Берёт все SQL-литералы из этого файла, прогоняет их через
+# EXPLAIN QUERY PLAN на текущей базе и помечает полные сканы таблиц.
+# Запуск: /dbaudit (админ) или `python bot.py audit-queries`.
+# SQL, собранный через f-строки, проверить нельзя — он попадает в skipped.
+_SQL_LITERAL_RE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b")
+
+# Полные сканы, которые сделаны так намеренно: начало SQL (без лишних пробелов) → почему.
+# Всё остальное, что аудит находит, — повод добавить индекс.
+_AUDIT_ALLOWED_SCANS = {
+    "SELECT path, file_hash, file_id FROM media_file_ids":
+        "реестр file_id целиком читается в память один раз при старте",
+    "DELETE FROM post_sends WHERE id NOT IN":
+        "разовая дедупликация в миграции 10",
+}
+_SQL_BODY_RE = re.compile(r"\b(FROM|INTO|SET)\b")
+
+
+def _collect_sql_statements() -> Tuple[List[Tuple[int, str]], List[int]]:
+    """Возвращает ([(номер строки, sql)], [номера строк динамического SQL])."""
+    import ast
+    with open(__file__, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+
+    def is_sql(text: str) -> bool:
+        return bool(_SQL_LITERAL_RE.match(text) and _SQL_BODY_RE.search(text))
+
+    def flatten(node) -> str:
+        # f-строки и конкатенация: подставляем заглушку вместо выражений
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return node.value
+        if isinstance(node, ast.JoinedStr):
+            return "".join(flatten(v) for v in node.values)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return flatten(node.left) + flatten(node.right)
+        return " x "
+
+    static, dynamic, parts = [], [], set()
+    for node in ast.walk(tree):
+        # Ключи _AUDIT_ALLOWED_SCANS похожи на SQL, но это не запросы
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1
+                and getattr(node.targets[0], "id", None) == "_AUDIT_ALLOWED_SCANS"):
+            parts.update(id(n) for n in ast.walk(node.value))
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.JoinedStr, ast.BinOp)) and id(node) not in parts:
+            if is_sql(flatten(node)):
+                dynamic.append(node.lineno)
+                parts.update(id(n) for n in ast.walk(node))
+            continue
+        if (isinstance(node, ast.Constant) and isinstance(node.value, str)
+                and id(node) not in parts and is_sql(node.value)):
+            static.append((node.lineno, node.value))
+    return sorted(static), sorted(set(dynamic))
+
+
+async def audit_query_plans() -> dict:
+    statements, dynamic = _collect_sql_statements()
+    results = []
+    async with db(readonly=True) as conn:
+        async with conn.execute("SELECT name FROM sqlite_master WHERE type='table'") as cur:
+            tables = {r[0] for r in await cur.fetchall()}
+        for lineno, sql in statements:
+            params = (None,) * sql.count("?")
+            try:
+                async with conn.execute("EXPLAIN QUERY PLAN " + sql, params) as cur:
+                    plan = [r[3] for r in await cur.fetchall()]
+                error = None
+            except Exception as e:
+                plan, error = [], str(e)
+            scans = [
+                d for d in plan
+                if d.startswith("SCAN ") and d.split()[1] in tables
+            ]
+            flat = " ".join(sql.split())
+            allowed = next(
+                (why for prefix, why in _AUDIT_ALLOWED_SCANS.items() if flat.startswith(prefix)), None
+            ) if scans else None
+            results.append({
+                "line": lineno,
+                "sql": flat,
+                "plan": plan,
+                "full_scans": [] if allowed else scans,
+                "allowed": allowed,
+                "error": error,
+            })
+    return {"results": results, "dynamic_lines": dynamic}
+
+
+def format_query_audit(audit: dict) -> str:
+    results = audit["results"]
+    flagged = [r for r in results if r["full_scans"]]
+    allowed = [r for r in results if r["allowed"]]
+    errors = [r for r in results if r["error"]]
+    lines = [
+        "🔎 Аудит планов запросов\n",
+        f"Проверено: {len(results)} • полных сканов: {len(flagged)} • ошибок: {len(errors)}",
+        f"Намеренных сканов (_AUDIT_ALLOWED_SCANS): {len(allowed)}",
+        f"Динамический SQL (не проверен): строки {', '.join(map(str, audit['dynamic_lines'])) or '—'}",
+    ]
+    for r in flagged:
+        lines.append("")
+        lines.append(f"⚠️ bot.py:{r['line']}: {r['sql'][:200]}")
+        for d in r["full_scans"]:
+            lines.append(f"   {d}")
+    for r in errors:
+        lines.append("")
+        lines.append(f"❌ bot.py:{r['line']}: {r['error']}")
+    for r in allowed:
+        lines.append("")
+        lines.append(f"☑️ bot.py:{r['line']}: {r['sql'][:80]} — {r['allowed']}")
+    return "\n".join(lines)
+
+
+# =========================
+# СНИМОК ПОЛЬЗОВАТЕЛЯ НА АПДЕЙТ
+# =========================
+_USER_COLUMNS = (
+    "user_id", "username", "goal", "sex", "age", "height", "weight", "place",
+    "exp", "freq", "meals", "limits", "state", "activity", "activity_factor",
+)
+_ACCESS_COLUMNS = (
+    "paid", "tariff", "tariff_name", "expires_at", "paid_at", "remind_stage", "plan_regens_left",
+)
+
+# Одна строка на пользователя: users ⋈ access ⋈ bot_state ⋈ workout_plans.
+# Отсутствующая строка любой из таблиц даёт NULL-ы в своих колонках —
+# наличие определяем по её user_id.
+_SNAPSHOT_SQL = (
+    "SELECT "
+    + ", ".join(f"u.{c}" for c in _USER_COLUMNS) + ", "
+    + "a.user_id, " + ", ".join(f"a.{c}" for c in _ACCESS_COLUMNS) + ", "
+    + "b.user_id, b.last_bot_msg_id, b.diary_prompt_msg_id, "
+    + "w.user_id, w.plan_text, w.plan_json, w.updated_at "
+    + "FROM (SELECT ? AS uid) k "
+    + "LEFT JOIN users u ON u.user_id = k.uid "
+    + "LEFT JOIN access a ON a.user_id = k.uid "
+    + "LEFT JOIN bot_state b ON b.user_id = k.uid "
+    + "LEFT JOIN workout_plans w ON w.user_id = k.uid"
+)
+
+_user_snapshot: contextvars.ContextVar[Optional["UserSnapshot"]] = contextvars.ContextVar(
+    "user_snapshot", default=None
+)
+_snapshot_stats = {"loads": 0, "reloads": 0, "hits": 0, "misses": 0}
+
+
+def _user_dict(row) -> dict:
+    return dict(zip(_USER_COLUMNS, row)) if row else {}
+
+
+def _access_active_until(a: dict) -> float:
+    """До какого момента (unix time) доступ активен: 0 — не активен, inf — навсегда."""
+    if a.get("paid") != 1:
+        return 0.0
+    if a.get("tariff") == "life":
+        return float("inf")
+    if not a.get("expires_at"):
+        return 0.0
+    try:
+        exp = datetime.fromisoformat(a["expires_at"])
+    except Exception:
+        return 0.0
+    # expires_at хранится как naive UTC
+    return exp.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _access_dict(row) -> Optional[dict]:
+    if not row:
+        return None
+    a = dict(zip(_ACCESS_COLUMNS, row))
+    a["active_until"] = _access_active_until(a)
+    return a
+
+
+# =========================
+# КЭШ ПОДПИСОК
+# =========================
+# Строка access на процесс: запись живёт ACCESS_CACHE_TTL секунд, но не дольше
+# самой подписки — в момент истечения запись протухает и перечитывается.
+# Все записи в access обязаны звать invalidate_access_cache().
+ACCESS_CACHE_TTL = int(os.getenv("ACCESS_CACHE_TTL", "300"))
+ACCESS_CACHE_MAX = int(os.getenv("ACCESS_CACHE_MAX", "20000"))  # потолок записей
+
+
+class AccessCache:
+    """
+    LRU-кэш строк access: OrderedDict в порядке обращений.
+    При каждой записи из головы срезаются протухшие записи, сверх max_size —
+    самые давние: память не растёт с числом пользователей, которых бот видел.
+
+    Поколения: каждый сброс (invalidate) получает номер из общего счётчика.
+    Читатель берёт generation(user_id) до чтения БД/снимка и отдаёт его в put():
+    если за время чтения был сброс (оплата из webhook/сверки), прочитанная
+    строка уже устарела и в кэш не попадает. Номера хранятся для последних
+    max_size сбросов; для остальных generation() — номер последнего выброшенного
+    (gen_floor), так что выброс во время чтения тоже не даёт закэшировать старое.
+    """
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data: "OrderedDict[int, Tuple[float, Optional[dict]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.expired = 0   # выброшено по TTL / окончанию подписки
+        self.evicted = 0   # выброшено по потолку
+        self.stale_puts = 0  # не закэшировано: строку прочитали до сброса
+        self._gens: "OrderedDict[int, int]" = OrderedDict()  # user → номер последнего сброса
+        self._gen = 0
+        self._gen_floor = 0
+
+    def generation(self, user_id: int) -> int:
+        return self._gens.get(user_id, self._gen_floor)
+
+    def _expire(self, now: float):
+        while self._data:
+            if next(iter(self._data.values()))[0] > now:
+                break
+            self._data.popitem(last=False)
+            self.expired += 1
+
+    def get(self, user_id: int) -> Tuple[bool, Optional[dict]]:
+        """(True, строка) при живой записи в кэше, иначе (False, None)."""
+        entry = self._data.get(user_id)
+        if entry is not None and _time.time() < entry[0]:
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return True, entry[1]
+        if entry is not None:
+            del self._data[user_id]
+            self.expired += 1
+        self.misses += 1
+        return False, None
+
+    def put(self, user_id: int, a: Optional[dict], gen: int):
+        """Кэширует строку, прочитанную при поколении gen (см. generation)."""
+        if gen != self.generation(user_id):
+            self.stale_puts += 1
+            return
+        now = _time.time()
+        valid_until = now + self.ttl
+        # Запись живёт не дольше самой подписки — в момент истечения перечитается
+        if a is not None and now < a["active_until"]:
+            valid_until = min(valid_until, a["active_until"])
+        self._expire(now)
+        self._data[user_id] = (valid_until, a)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evicted += 1
+
+    def invalidate(self, user_id: int):
+        self._gen += 1
+        self._gens[user_id] = self._gen
+        self._gens.move_to_end(user_id)
+        if len(self._gens) > self.max_size:
+            self._gen_floor = self._gens.popitem(last=False)[1]
+        if self._data.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        self._expire(_time.time())
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "stale_puts": self.stale_puts,
+        }
+
+
+_access_cache = AccessCache(ACCESS_CACHE_TTL, ACCESS_CACHE_MAX)
+
+
+def invalidate_access_cache(user_id: int):
+    _access_cache.invalidate(user_id)
+
+
+class UserSnapshot:
+    """
+    Всё, что хендлеры читают о пользователе за один апдейт, — одним запросом.
+    Хелперы get_user/get_access/get_workout_plan/... берут данные отсюда,
+    а после записи помечают снимок устаревшим (stale): следующее чтение
+    перечитает его целиком, снова одним запросом.
+    """
+    __slots__ = ("user_id", "user", "access", "access_gen", "bot_state", "plan", "stale")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.user: dict = {}
+        self.access: Optional[dict] = None
+        self.access_gen = 0  # поколение кэша подписок на момент загрузки
+        self.bot_state: Optional[dict] = None
+        self.plan: Optional[tuple] = None  # (plan_text, plan_json, updated_at)
+        self.stale = True
+
+    async def load(self):
+        gen = _access_cache.generation(self.user_id)
+        async with db(readonly=True) as conn:
+            async with conn.execute(_SNAPSHOT_SQL, (self.user_id,)) as cur:
+                row = await cur.fetchone()
+        n_user, n_access = len(_USER_COLUMNS), len(_ACCESS_COLUMNS)
+        u = row[:n_user]
+        a = row[n_user:n_user + 1 + n_access]
+        b = row[n_user + 1 + n_access:n_user + 4 + n_access]
+        w = row[n_user + 4 + n_access:]
+        self.user = _user_dict(u) if u[0] is not None else {}
+        self.access = _access_dict(a[1:]) if a[0] is not None else None
+        self.bot_state = {"last_bot_msg_id": b[1], "diary_prompt_msg_id": b[2]} if b[0] is not None else None
+        self.plan = (w[1], w[2], w[3]) if w[0] is not None else None
+        self.stale = False
+        self.access_gen = gen
+        _access_cache.put(self.user_id, self.access, gen)
+
+
+async def current_snapshot(user_id: int) -> Optional[UserSnapshot]:
+    """Снимок текущего апдейта, если он про этого пользователя (перечитывается, если устарел)."""
+    snap = _user_snapshot.get()
+    if snap is None or snap.user_id != user_id:
+        _snapshot_stats["misses"] += 1
+        return None
+    if snap.stale:
+        await snap.load()
+        _snapshot_stats["reloads"] += 1
+    else:
+        _snapshot_stats["hits"] += 1
+    return snap
+
+
+def invalidate_user_snapshot(user_id: int):
+    snap = _user_snapshot.get()
+    if snap is not None and snap.user_id == user_id:
+        snap.stale = True
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """
+    Загружает снимок пользователя одним JOIN-запросом в начале апдейта
+    и кладёт его в contextvar на время обработки.
+    """
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        user_id = _event_user_id(event)
+        if user_id is None:
+            return await handler(event, data)
+        snap = UserSnapshot(user_id)
+        try:
+            await snap.load()
+            _snapshot_stats["loads"] += 1
+        except Exception:
+            logger.warning("user snapshot load failed for %s", user_id, exc_info=True)
+        token = _user_snapshot.set(snap)
+        try:
+            return await handler(event, data)
+        finally:
+            _user_snapshot.reset(token)
+
+
+async def ensure_user(user_id: int, username: str):
+    snap = await current_snapshot(user_id)
+    if snap is not None and snap.user and snap.access is not None and snap.bot_state is not None:
+        return
+    now = datetime.utcnow().isoformat()
+    await db_write(
+        ("INSERT OR IGNORE INTO users (user_id, username, created_at) VALUES (?, ?, ?)",
+         (user_id, username or "", now)),
+        ("INSERT OR IGNORE INTO access (user_id, paid, tariff, expires_at, paid_at) VALUES (?, 0, NULL, NULL, NULL)",
+         (user_id,)),
+        ("INSERT OR IGNORE INTO bot_state (user_id, last_bot_msg_id, diary_prompt_msg_id) VALUES (?, NULL, NULL)",
+         (user_id,)),
+    )
+    invalidate_access_cache(user_id)
+    invalidate_user_snapshot(user_id)
+
+
+async def get_user(user_id: int):
+    snap = await current_snapshot(user_id)
+    if snap is not None:
+        return dict(snap.user)
+    async with db(readonly=True) as conn:
+        async with conn.execute(
+            f"SELECT {', '.join(_USER_COLUMNS)} FROM users WHERE user_id=?", (user_id,)
+        ) as cur:
             row = await cur.fetchone()
-
-    if not row:
-        return {}
-    return {
-        "user_id": row[0], "username": row[1], "goal": row[2], "sex": row[3],
-        "age": row[4], "height": row[5], "weight": row[6], "place": row[7],
-        "exp": row[8], "freq": row[9], "meals": row[10], "limits": row[11],
-        "state": row[12], "activity": row[13], "activity_factor": row[14]
-    }
+    return _user_dict(row)
 
 
 async def update_user(user_id: int, **fields):
@@ -3539,50 +5512,56 @@ async def update_user(user_id: int, **fields):
         vals.append(v)
     vals.append(user_id)
     q = "UPDATE users SET " + ", ".join(keys) + " WHERE user_id=?"
-    async with db() as conn:
-        await conn.execute(q, tuple(vals))
-        await conn.commit()
+    await db_write((q, tuple(vals)))
+    invalidate_user_snapshot(user_id)
+
+
+async def load_access_row(user_id: int) -> Optional[dict]:
+    """Строка access целиком (None — строки нет). Источник для get_access/get_subscription/get_plan_regens.
+    Порядок: кэш подписок → снимок апдейта → БД."""
+    found, a = _access_cache.get(user_id)
+    if found:
+        return a
+    snap = await current_snapshot(user_id)
+    if snap is not None and snap.access_gen != _access_cache.generation(user_id):
+        # Снимок загружен до сброса (например, оплату применил webhook
+        # в другом апдейте) — его строка access устарела
+        await snap.load()
+        _snapshot_stats["reloads"] += 1
+    if snap is not None:
+        a = snap.access
+    else:
+        gen = _access_cache.generation(user_id)
+        async with db(readonly=True) as conn:
+            async with conn.execute(
+                f"SELECT {', '.join(_ACCESS_COLUMNS)} FROM access WHERE user_id=?", (user_id,)
+            ) as cur:
+                row = await cur.fetchone()
+        a = _access_dict(row)
+        _access_cache.put(user_id, a, gen)
+    return a
 
 
 async def get_access(user_id: int):
-    async with db() as conn:
-        async with conn.execute(
-            "SELECT paid, tariff, expires_at, paid_at FROM access WHERE user_id=?",
-            (user_id,)
-        ) as cur:
-            row = await cur.fetchone()
-    if not row:
+    a = await load_access_row(user_id)
+    if not a:
         return {"paid": 0, "tariff": None, "expires_at": None, "paid_at": None}
-    return {"paid": row[0], "tariff": row[1], "expires_at": row[2], "paid_at": row[3]}
+    return {"paid": a["paid"], "tariff": a["tariff"], "expires_at": a["expires_at"], "paid_at": a["paid_at"]}
 
 
 async def is_access_active(user_id: int) -> bool:
-    a = await get_access(user_id)
-    if a["paid"] != 1:
-        return False
-    if a["tariff"] == "life":
-        return True
-    if not a["expires_at"]:
-        return False
-    try:
-        exp = datetime.fromisoformat(a["expires_at"])
-    except Exception:
-        return False
-    return datetime.utcnow() < exp
+    a = await load_access_row(user_id)
+    return bool(a) and _time.time() < a["active_until"]
 
 
 async def get_plan_regens(user_id: int):
     """Возвращает (regens_left, is_unlimited).
     regens_left=None => безлимит. regens_left=0 => исчерпан."""
-    async with db() as conn:
-        async with conn.execute(
-            "SELECT plan_regens_left, tariff FROM access WHERE user_id=?", (user_id,)
-        ) as cur:
-            row = await cur.fetchone()
-    if not row:
+    a = await load_access_row(user_id)
+    if not a:
         return (0, False)
-    regens_left = row[0]
-    tariff_code = row[1] or ""
+    regens_left = a["plan_regens_left"]
+    tariff_code = a["tariff"] or ""
     t = TARIFFS.get(tariff_code, {})
     base_regens = t.get("plan_regens")
     if base_regens is None:
@@ -3601,6 +5580,8 @@ async def decrement_plan_regens(user_id: int):
             (user_id,)
         )
         await conn.commit()
+    invalidate_access_cache(user_id)
+    invalidate_user_snapshot(user_id)
 
 
 
@@ -3609,29 +5590,15 @@ async def decrement_plan_regens(user_id: int):
 # =========================
 async def get_subscription(user_id: int) -> dict:
     """Единый источник правды о подписке пользователя."""
-    async with db() as conn:
-        async with conn.execute(
-            """SELECT paid, tariff, tariff_name, expires_at, paid_at, remind_stage
-               FROM access WHERE user_id=?""",
-            (user_id,)
-        ) as cur:
-            row = await cur.fetchone()
-    if not row:
+    a = await load_access_row(user_id)
+    if not a:
         return {
             "tariff": "none", "tariff_name": "Нет",
             "expires_at": None, "is_active": 0, "remind_stage": -1
         }
-    paid, tariff, tariff_name, expires_at, paid_at, remind_stage = row
-    is_active = 0
-    if paid == 1:
-        if tariff == "life":
-            is_active = 1
-        elif expires_at:
-            try:
-                if datetime.utcnow() < datetime.fromisoformat(expires_at):
-                    is_active = 1
-            except Exception:
-                pass
+    tariff, tariff_name = a["tariff"], a["tariff_name"]
+    expires_at, remind_stage = a["expires_at"], a["remind_stage"]
+    is_active = 1 if _time.time() < a["active_until"] else 0
     return {
         "tariff": tariff or "none",
         "tariff_name": tariff_name or "Нет",
@@ -3665,15 +5632,15 @@ def format_tariff_line(sub: dict) -> str:
 
 async def is_full_access_active(user_id: int) -> bool:
     """Полный доступ: тренировки + питание (только платные тарифы, не пробный)."""
-    a = await get_access(user_id)
-    if a["paid"] != 1:
-        return False
-    if not await is_access_active(user_id):
+    a = await load_access_row(user_id)
+    if not a or _time.time() >= a["active_until"]:
         return False
     return a.get("tariff") in FULL_ACCESS_TARIFFS
 
 
-async def set_paid_tariff(user_id: int, tariff_code: str):
+def _paid_tariff_update(user_id: int, tariff_code: str) -> Tuple[str, tuple]:
+    """UPDATE access, выдающий тариф (без commit) — для set_paid_tariff и для
+    атомарного применения платежа вместе со сменой его статуса (transition_payment)."""
     t = TARIFFS.get(tariff_code)
     if not t:
         raise ValueError("Unknown tariff")
@@ -3682,16 +5649,22 @@ async def set_paid_tariff(user_id: int, tariff_code: str):
     expires_at = None if t["days"] is None else (now + timedelta(days=int(t["days"]))).isoformat()
     regens = t.get("plan_regens")  # None = безлимит, 0 = нельзя, N = лимит
     tariff_name = t.get("title", tariff_code)
+    return (
+        """UPDATE access
+           SET paid=1, tariff=?, tariff_name=?, expires_at=?, paid_at=?,
+               plan_regens_left=?, remind_stage=-1
+           WHERE user_id=?""",
+        (tariff_code, tariff_name, expires_at, now_iso, regens, user_id),
+    )
 
+
+async def set_paid_tariff(user_id: int, tariff_code: str):
+    sql, params = _paid_tariff_update(user_id, tariff_code)
     async with db() as conn:
-        await conn.execute(
-            """UPDATE access
-               SET paid=1, tariff=?, tariff_name=?, expires_at=?, paid_at=?,
-                   plan_regens_left=?, remind_stage=-1
-               WHERE user_id=?""",
-            (tariff_code, tariff_name, expires_at, now_iso, regens, user_id)
-        )
+        await conn.execute(sql, params)
         await conn.commit()
+    invalidate_access_cache(user_id)
+    invalidate_user_snapshot(user_id)
 
 
 async def save_workout_plan(user_id: int, text: str, plan_json: Optional[str] = None):
@@ -3706,6 +5679,8 @@ async def save_workout_plan(user_id: int, text: str, plan_json: Optional[str] =
                 updated_at=excluded.updated_at
         """, (user_id, text, plan_json or "", now))
         await conn.commit()
+    _plan_cache.invalidate(user_id)
+    invalidate_user_snapshot(user_id)
 
 
 async def save_nutrition_plan(user_id: int, text: str):
@@ -3719,17 +5694,102 @@ async def save_nutrition_plan(user_id: int, text: str):
         await conn.commit()
 
 
+# =========================
+# КЭШ РАЗОБРАННЫХ ПЛАНОВ
+# =========================
+PLAN_CACHE_MAX_BYTES = int(os.getenv("PLAN_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+
+class PlanCache:
+    """
+    LRU разобранных plan_json по ключу (user_id, updated_at):
+    смена updated_at при сохранении сама делает старую запись недействительной,
+    save_workout_plan дополнительно удаляет её явно.
+    Лимит — по суммарному размеру исходного JSON (приблизительная оценка памяти).
+    Отдаваемый план общий для всех читателей: менять его можно только в копии.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[int, Tuple[str, dict, int]]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get(self, user_id: int, updated_at: str) -> Optional[dict]:
+        entry = self._data.get(user_id)
+        if entry is None or entry[0] != updated_at:
+            self.misses += 1
+            return None
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id: int, updated_at: str, plan: dict, size: int):
+        self.invalidate(user_id)
+        if size > self.max_bytes:
+            return
+        self._data[user_id] = (updated_at, plan, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, _, old_size) = self._data.popitem(last=False)
+            self.bytes -= old_size
+            self.evicted += 1
+
+    def invalidate(self, user_id: int):
+        entry = self._data.pop(user_id, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total * 100, 1) if total else 0.0,
+            "evicted": self.evicted,
+        }
+
+
+_plan_cache = PlanCache(PLAN_CACHE_MAX_BYTES)
+
+
 async def get_workout_plan(user_id: int):
-    async with db() as conn:
-        async with conn.execute("SELECT plan_text, plan_json FROM workout_plans WHERE user_id=?", (user_id,)) as cur:
-            row = await cur.fetchone()
+    snap = await current_snapshot(user_id)
+    if snap is not None:
+        row = snap.plan
+    else:
+        async with db(readonly=True) as conn:
+            async with conn.execute(
+                "SELECT plan_text, plan_json, updated_at FROM workout_plans WHERE user_id=?", (user_id,)
+            ) as cur:
+                row = await cur.fetchone()
     if not row:
         return None, {}
-    return (row[0] or ""), loads_plan(row[1] or "")
+    plan_text, plan_json, updated_at = row
+    plan = _plan_cache.get(user_id, updated_at or "")
+    if plan is not None:
+        return (plan_text or ""), plan
+    plan = loads_plan(plan_json or "")
+    _plan_cache.put(user_id, updated_at or "", plan, len(plan_json or ""))
+    if ensure_plan_v2(plan):
+        # Ленивая миграция старого plan_json: дописываем v2 без смены updated_at
+        # (это тот же план) и только если его не успели перезаписать.
+        new_json = dumps_plan(plan)
+        db_write_nowait((
+            "UPDATE workout_plans SET plan_json=? WHERE user_id=? AND plan_json=?",
+            (new_json, user_id, plan_json),
+        ))
+        if snap is not None:
+            snap.plan = (plan_text, new_json, updated_at)
+    return (plan_text or ""), plan
 
 
 async def get_nutrition_plan(user_id: int):
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute("SELECT plan_text FROM nutrition_plans WHERE user_id=?", (user_id,)) as cur:
             row = await cur.fetchone()
     return row[0] if row else None
@@ -3746,30 +5806,72 @@ async def create_payment(user_id: int, tariff: str, amount: int, last4: str, cod
         return cur.lastrowid
 
 
-async def get_payment(payment_id: int):
-    async with db() as conn:
-        async with conn.execute("""
-            SELECT id, user_id, tariff, amount, last4, code, status, receipt_file_id, created_at
-            FROM payments WHERE id=?
-        """, (payment_id,)) as cur:
-            row = await cur.fetchone()
+def _payment_dict(row) -> dict:
     if not row:
         return {}
     return {
         "id": row[0], "user_id": row[1], "tariff": row[2], "amount": row[3],
-        "last4": row[4], "code": row[5], "status": row[6], "receipt_file_id": row[7], "created_at": row[8]
+        "last4": row[4], "code": row[5], "status": row[6], "receipt_file_id": row[7], "created_at": row[8],
+        "provider_payment_id": row[9],
     }
 
 
-async def set_payment_status(payment_id: int, status: str):
-    async with db() as conn:
-        await conn.execute("UPDATE payments SET status=? WHERE id=?", (status, payment_id))
-        await conn.commit()
+async def get_payment(payment_id: int):
+    async with db(readonly=True) as conn:
+        async with conn.execute("""
+            SELECT id, user_id, tariff, amount, last4, code, status, receipt_file_id, created_at,
+                   provider_payment_id
+            FROM payments WHERE id=?
+        """, (payment_id,)) as cur:
+            row = await cur.fetchone()
+    return _payment_dict(row)
+
+
+async def get_payment_by_provider_id(provider_payment_id: str) -> dict:
+    """Локальная запись платежа по id у платёжного провайдера (уникальный индекс)."""
+    async with db(readonly=True) as conn:
+        async with conn.execute("""
+            SELECT id, user_id, tariff, amount, last4, code, status, receipt_file_id, created_at,
+                   provider_payment_id
+            FROM payments WHERE provider_payment_id=?
+        """, (provider_payment_id,)) as cur:
+            row = await cur.fetchone()
+    return _payment_dict(row)
+
+
+async def transition_payment(p: dict, new_status: str, source: str, grant: bool = False) -> bool:
+    """Переводит платёж из прочитанного статуса p["status"] в new_status — ровно
+    один раз, сколько бы обработчиков (webhook, кнопка, сверка, админ) ни пришло
+    одновременно: UPDATE ... WHERE status=<прочитанный> + запись в payment_status_log.
+    Какие переходы допустимы, решает вызывающий (обычно из pending).
+    grant=True — в той же транзакции выдаёт тариф платежа.
+    True — статус поменяли именно сейчас."""
+    now = datetime.utcnow().isoformat()
+    old_status = p["status"]
+    statements = []
+    if grant:
+        access_sql, access_params = _paid_tariff_update(p["user_id"], p["tariff"])
+        statements.append((
+            access_sql + " AND EXISTS (SELECT 1 FROM payments WHERE id=? AND status=?)",
+            access_params + (p["id"], old_status),
+        ))
+    statements += [
+        ("UPDATE payments SET status=? WHERE id=? AND status=?", (new_status, p["id"], old_status)),
+        ("""
+            INSERT INTO payment_status_log (payment_id, old_status, new_status, source, created_at)
+            SELECT ?, ?, ?, ?, ? WHERE changes() > 0
+        """, (p["id"], old_status, new_status, source, now)),
+    ]
+    changed = await db_write(*statements)
+    if grant:
+        invalidate_access_cache(p["user_id"])
+        invalidate_user_snapshot(p["user_id"])
+    return bool(changed)
 
 
 async def has_recent_pending_payment(user_id: int) -> bool:
     since = (datetime.utcnow() - timedelta(hours=2)).isoformat()
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute("""
             SELECT COUNT(*) FROM payments
             WHERE user_id=? AND status='pending' AND created_at>=?
@@ -3810,51 +5912,65 @@ async def get_or_create_today_session(user_id: int) -> int:
         return int(cur2.lastrowid)
 
 
+_ADD_SET_SQL = """
+    INSERT INTO diary_sets (session_id, exercise, set_no, weight, reps)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
 async def add_set(session_id: int, exercise: str, set_no: int, weight: float, reps: int):
-    async with db() as conn:
-        await conn.execute("""
-            INSERT INTO diary_sets (session_id, exercise, set_no, weight, reps)
-            VALUES (?, ?, ?, ?, ?)
-        """, (session_id, exercise, set_no, weight, reps))
-        await conn.commit()
+    await db_write((_ADD_SET_SQL, (session_id, exercise, set_no, weight, reps)))
 
 
-async def get_diary_history(user_id: int, limit_sessions: int = 10):
-    async with db() as conn:
+async def add_sets(session_id: int, exercise: str, sets: List[Tuple[float, int]]):
+    """Все подходы одного ввода — одним заданием (и одним коммитом)."""
+    await db_write(*[
+        (_ADD_SET_SQL, (session_id, exercise, i, w, r))
+        for i, (w, r) in enumerate(sets, start=1)
+    ])
+
+
+async def get_diary_history(user_id: int, limit_sessions: int = 10, before_id: Optional[int] = None):
+    """Сессии дневника (новые сверху) вместе с подходами — одним запросом.
+    Строки группируются по сессиям по мере чтения курсора.
+    Пагинация по ключу: before_id — id самой старой сессии предыдущей страницы.
+    Возвращает (история, before_id для следующей страницы или None)."""
+    out = []
+    async with db(readonly=True) as conn:
         async with conn.execute("""
-            SELECT id, session_date, title
-            FROM diary_sessions
-            WHERE user_id=?
-            ORDER BY id DESC LIMIT ?
-        """, (user_id, limit_sessions)) as cur:
-            sessions = await cur.fetchall()
-
-        out = []
-        for s in sessions:
-            sid = s[0]
-            async with conn.execute("""
-                SELECT exercise, set_no, weight, reps
-                FROM diary_sets
-                WHERE session_id=?
-                ORDER BY id ASC
-            """, (sid,)) as cur2:
-                sets = await cur2.fetchall()
-            out.append((s, sets))
-    return out
+            WITH s AS (
+                SELECT id, session_date, title
+                FROM diary_sessions
+                WHERE user_id=? AND id < ?
+                ORDER BY id DESC LIMIT ?
+            )
+            SELECT s.id, s.session_date, s.title, d.exercise, d.set_no, d.weight, d.reps
+            FROM s LEFT JOIN diary_sets d ON d.session_id = s.id
+            ORDER BY s.id DESC, d.id ASC
+        """, (user_id, before_id or sys.maxsize, limit_sessions + 1)) as cur:
+            async for row in cur:
+                if not out or out[-1][0][0] != row[0]:
+                    out.append((tuple(row[:3]), []))
+                if row[3] is not None:
+                    out[-1][1].append(tuple(row[3:]))
+
+    next_before = None
+    if len(out) > limit_sessions:
+        out.pop()
+        next_before = out[-1][0][0]
+    return out, next_before
 
 
 async def add_measure(user_id: int, mtype: str, value: float):
     now = datetime.utcnow().isoformat()
-    async with db() as conn:
-        await conn.execute(
-            "INSERT INTO measurements (user_id, mtype, value, created_at) VALUES (?, ?, ?, ?)",
-            (user_id, mtype, value, now)
-        )
-        await conn.commit()
+    await db_write((
+        "INSERT INTO measurements (user_id, mtype, value, created_at) VALUES (?, ?, ?, ?)",
+        (user_id, mtype, value, now)
+    ))
 
 
 async def get_last_measures(user_id: int, mtype: str, limit: int = 8):
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute("""
             SELECT value, created_at
             FROM measurements
@@ -3866,7 +5982,7 @@ async def get_last_measures(user_id: int, mtype: str, limit: int = 8):
 
 
 async def get_last_measures_any(user_id: int, limit: int = 30):
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute("""
             SELECT mtype, value, created_at
             FROM measurements
@@ -3889,9 +6005,10 @@ async def create_post_draft(admin_id: int, media_type: str, media_file_id: Optio
 
 
 async def get_post(post_id: int):
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute("""
-            SELECT id, admin_id, post_media_type, post_media_file_id, post_text, status, created_at
+            SELECT id, admin_id, post_media_type, post_media_file_id, post_text, status, created_at,
+                   progress_msg_id
             FROM posts WHERE id=?
         """, (post_id,)) as cur:
             row = await cur.fetchone()
@@ -3899,7 +6016,8 @@ async def get_post(post_id: int):
         return {}
     return {
         "id": row[0], "admin_id": row[1], "media_type": row[2],
-        "media_file_id": row[3], "text": row[4], "status": row[5], "created_at": row[6]
+        "media_file_id": row[3], "text": row[4], "status": row[5], "created_at": row[6],
+        "progress_msg_id": row[7],
     }
 
 
@@ -3909,11 +6027,61 @@ async def set_post_status(post_id: int, status: str):
         await conn.commit()
 
 
-async def get_all_user_ids():
-    async with db() as conn:
-        async with conn.execute("SELECT user_id FROM users") as cur:
+async def set_post_progress_msg(post_id: int, msg_id: int):
+    await db_write(("UPDATE posts SET progress_msg_id=? WHERE id=?", (msg_id, post_id)))
+
+
+async def get_unfinished_post_ids() -> List[int]:
+    """Рассылки, прерванные рестартом (идут или на паузе)."""
+    async with db(readonly=True) as conn:
+        async with conn.execute(
+            "SELECT id FROM posts WHERE status IN ('sending', 'paused') ORDER BY id"
+        ) as cur:
+            rows = await cur.fetchall()
+    return [r[0] for r in rows]
+
+
+async def get_broadcast_recipients(post_id: int, after_user_id: int, limit: int) -> List[int]:
+    """Следующая страница получателей (keyset по user_id): активные
+    пользователи, которым этот пост ещё не отправлялся."""
+    async with db(readonly=True) as conn:
+        async with conn.execute("""
+            SELECT u.user_id FROM users u
+            WHERE u.user_id > ? AND u.blocked_at IS NULL
+              AND NOT EXISTS (
+                  SELECT 1 FROM post_sends s WHERE s.post_id=? AND s.user_id=u.user_id
+              )
+            ORDER BY u.user_id
+            LIMIT ?
+        """, (after_user_id, post_id, limit)) as cur:
             rows = await cur.fetchall()
-    return [r[0] for r in rows] if rows else []
+    return [r[0] for r in rows]
+
+
+async def get_broadcast_counts(post_id: int) -> Tuple[Dict[str, int], int]:
+    """({status: сколько уже обработано}, сколько получателей осталось)."""
+    async with db(readonly=True) as conn:
+        async with conn.execute(
+            "SELECT status, COUNT(*) FROM post_sends WHERE post_id=? GROUP BY status", (post_id,)
+        ) as cur:
+            done = {r[0]: r[1] for r in await cur.fetchall()}
+        async with conn.execute("""
+            SELECT COUNT(*) FROM users u
+            WHERE u.blocked_at IS NULL
+              AND NOT EXISTS (
+                  SELECT 1 FROM post_sends s WHERE s.post_id=? AND s.user_id=u.user_id
+              )
+        """, (post_id,)) as cur:
+            left = (await cur.fetchone())[0]
+    return done, left
+
+
+async def set_user_blocked(user_id: int, blocked: bool):
+    """blocked_at — пользователь заблокировал бота; рассылки его пропускают."""
+    await db_write((
+        "UPDATE users SET blocked_at=? WHERE user_id=?",
+        (datetime.utcnow().isoformat() if blocked else None, user_id),
+    ))
 
 
 # =========================
@@ -4257,7 +6425,7 @@ def parse_exercises_full(day_text: str) -> List[Tuple[str, str]]:
 
 
 async def get_day_done_exercises(user_id: int, day_num: int) -> List[int]:
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute(
             "SELECT done_exercises FROM workout_day_progress WHERE user_id=? AND day_num=?",
             (user_id, day_num)
@@ -4272,33 +6440,24 @@ async def get_day_done_exercises(user_id: int, day_num: int) -> List[int]:
 
 
 async def set_day_done_exercises(user_id: int, day_num: int, done: List[int]):
-    async with db() as conn:
-        await conn.execute("""
-            INSERT INTO workout_day_progress (user_id, day_num, done_exercises)
-            VALUES (?, ?, ?)
-            ON CONFLICT(user_id, day_num) DO UPDATE SET done_exercises=excluded.done_exercises
-        """, (user_id, day_num, json.dumps(done)))
-        await conn.commit()
+    await db_write(("""
+        INSERT INTO workout_day_progress (user_id, day_num, done_exercises)
+        VALUES (?, ?, ?)
+        ON CONFLICT(user_id, day_num) DO UPDATE SET done_exercises=excluded.done_exercises
+    """, (user_id, day_num, json.dumps(done))))
 
 
 async def clear_day_progress(user_id: int, day_num: int):
-    async with db() as conn:
-        await conn.execute(
-            "DELETE FROM workout_day_progress WHERE user_id=? AND day_num=?",
-            (user_id, day_num)
-        )
-        await conn.commit()
+    await db_write((
+        "DELETE FROM workout_day_progress WHERE user_id=? AND day_num=?",
+        (user_id, day_num)
+    ))
 
 
 async def mark_day_completed(user_id: int, day_num: int, day_title: str = ""):
     today = datetime.now().strftime("%Y-%m-%d")
     now = datetime.utcnow().isoformat()
     async with db() as conn:
-        # Добавляем поле day_title если его нет (миграция)
-        try:
-            await conn.execute("ALTER TABLE workout_completions ADD COLUMN day_title TEXT DEFAULT ''")
-        except Exception:
-            pass
         await conn.execute("""
             INSERT INTO workout_completions (user_id, day_num, completed_date, created_at, day_title)
             VALUES (?, ?, ?, ?, ?)
@@ -4308,7 +6467,7 @@ async def mark_day_completed(user_id: int, day_num: int, day_title: str = ""):
 
 async def is_day_completed_today(user_id: int, day_num: int) -> bool:
     today = datetime.now().strftime("%Y-%m-%d")
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute("""
             SELECT COUNT(*) FROM workout_completions
             WHERE user_id=? AND day_num=? AND completed_date=?
@@ -4331,60 +6490,123 @@ def workout_progress_bar(done: int, total: int, width: int = 10) -> str:
     return f"{bar} {pct}%"
 
 
-def build_day_display_text(day_num: int, day_text: str, exercises: List[str],
+def build_day_display_text(day_num: int, day_text: str, exercises: List[dict],
                             done: List[int], all_done: bool = False,
-                            goal: str = "") -> str:
-    """Строит текст дня тренировки с заголовком типа дня."""
+                            goal: str = "", info: Optional[dict] = None) -> str:
+    """Строит текст дня тренировки с заголовком типа дня (exercises — записи плана v2)."""
     total = len(exercises)
     done_count = len(done)
+    info = info or day_header_info(day_num, day_text)
 
-    # ── Интервалы отдыха по цели и типу упражнения ──────────────────────────
-    g = (goal or "").lower()
-    is_strength_goal = "сил" in g
-    is_cut_goal = "суш" in g
-
-    # Тяжёлая база: присед, становая, жим штанги, жим стоя, подтягивания
-    _BASE_KEYWORDS = ["присед", "станов", "жим штанг", "жим ног", "подтяг", "deadlift", "squat", "bench",
-                      "жим лёжа", "жим стоя", "жим под угл"]
-    # Средние: тяги, гантельные жимы, блок
-    _MID_KEYWORDS = ["гантел", "выпад", "болгар", "goblet", "lunge", "dumbbell",
-                     "тяга", "тяг блока", "тяг в наклон", "тяг верхн"]
-    # Изоляция на малые мышцы (бицепс, трицепс, икры)
-    _SMALL_ISO_KEYWORDS = ["бицепс", "трицепс", "hammer", "concentration", "bicep",
-                           "french", "трице", "сгибани", "разгибани", "икр", "носки"]
-
-    def _rest_for(ex_name: str) -> str:
-        n = ex_name.lower()
-        is_base = any(k in n for k in _BASE_KEYWORDS)
-        is_mid  = any(k in n for k in _MID_KEYWORDS)
-        is_small_iso = any(k in n for k in _SMALL_ISO_KEYWORDS)
-
-        if is_strength_goal:
-            # Для силы: база 3–5 мин, средние 2–3 мин, изоляция 2–3 мин
-            if is_base:
-                return "3–5 мин"
-            elif is_mid:
-                return "2–3 мин"
-            else:
-                return "2–3 мин"
-        elif is_cut_goal:
-            # Для сушки: база 2–3 мин, средние 1.5–2 мин, изоляция 1.5 мин
-            if is_base:
-                return "2–3 мин"
-            elif is_mid:
-                return "1.5–2 мин"
-            else:
-                return "1.5 мин"
+    lines = []
+    # Заголовок строго: 🏋️ День N: фокус (или 🏋️ Фулбади для fullbody)
+    if info["fullbody"]:
+        lines.append("🏋️ Фулбади")
+        lines.append("📌 всё тело")
+    else:
+        lines.append(f"🏋️ День {day_num}: {info['type']}")
+        if info["note"]:
+            lines.append(f"📌 {info['note']}")
+    lines.append("")
+    lines.append("⚠️ Перед тренировкой разомнись 5–10 минут")
+    lines.append("📚 — техника выполнения упражнения")
+    lines.append("🔄 — заменить упражнение под себя")
+    lines.append("")
+
+    for idx, ex in enumerate(exercises):
+        is_done = idx in done
+        mark = "✅" if is_done else "🔸"
+        rest = rest_interval(ex["rest_class"], goal)
+        sets_reps = format_sets_reps(ex)
+        if sets_reps:
+            lines.append(f"{mark} {ex['name']} {sets_reps}  ⏱ {rest}")
         else:
-            # Для массы: база 2–3 мин, средние 1.5–2 мин, малая изоляция 1.5 мин, крупная изоляция 1.5 мин
-            if is_base:
-                return "2–3 мин"
-            elif is_mid:
-                return "1.5–2 мин"
-            else:
-                return "1.5 мин"
+            lines.append(f"{mark} {ex['name']}  ⏱ {rest}")
+
+    lines.append("")
+    lines.append("🏁 После тренировки — заминка и растяжка 5–10 минут")
+    lines.append("")
+
+    bar = workout_progress_bar(done_count, total)
+    if all_done:
+        lines.append(f"{bar}")
+        lines.append(f"✅ {done_count}/{total} упражнений выполнено")
+        lines.append("")
+        lines.append("🎉 ОТЛИЧНО! День засчитан!")
+    else:
+        lines.append(f"{bar}")
+        lines.append(f"✅ {done_count}/{total} упражнений выполнено")
+
+    return "\n".join(lines)
+
+
+# =========================
+# ПЛАН v2: структурированные дни
+# =========================
+# plan_json v2 хранит рядом с текстом дней готовые записи упражнений и шапку дня:
+#   "exercises": {"1": [{"name", "tech_key", "sets", "reps", "rest_class"}, ...]}
+#   "day_info":  {"1": {"type", "note", "fullbody", "title"}}
+# Тап по дню/упражнению — только поиск по словарю, без разбора текста.
+# Старые планы (без "version") дополняются при первом чтении — ensure_plan_v2().
+PLAN_VERSION = 2
+
+# Тяжёлая база: присед, становая, жим штанги, жим стоя, подтягивания
+_REST_BASE_KEYWORDS = ["присед", "станов", "жим штанг", "жим ног", "подтяг", "deadlift", "squat", "bench",
+                       "жим лёжа", "жим стоя", "жим под угл"]
+# Средние: тяги, гантельные жимы, блок
+_REST_MID_KEYWORDS = ["гантел", "выпад", "болгар", "goblet", "lunge", "dumbbell",
+                      "тяга", "тяг блока", "тяг в наклон", "тяг верхн"]
+
+# Интервалы отдыха по цели и классу упражнения (база / средние / изоляция)
+REST_INTERVALS = {
+    "strength": {"base": "3–5 мин", "mid": "2–3 мин", "iso": "2–3 мин"},
+    "cut": {"base": "2–3 мин", "mid": "1.5–2 мин", "iso": "1.5 мин"},
+    "mass": {"base": "2–3 мин", "mid": "1.5–2 мин", "iso": "1.5 мин"},
+}
 
-    # Определяем тип дня из текста плана
+
+def exercise_rest_class(name: str) -> str:
+    n = name.lower()
+    if any(k in n for k in _REST_BASE_KEYWORDS):
+        return "base"
+    if any(k in n for k in _REST_MID_KEYWORDS):
+        return "mid"
+    return "iso"
+
+
+def rest_interval(rest_class: str, goal: str) -> str:
+    g = (goal or "").lower()
+    if "сил" in g:
+        table = REST_INTERVALS["strength"]
+    elif "суш" in g:
+        table = REST_INTERVALS["cut"]
+    else:
+        table = REST_INTERVALS["mass"]
+    return table.get(rest_class, table["iso"])
+
+
+def exercise_record(name: str, sets_reps: str = "") -> dict:
+    """Запись упражнения плана v2 из названия и строки 'подходы×повторы'."""
+    sets, sep, reps = sets_reps.partition("×")
+    if not sep:
+        sets, reps = "", sets_reps
+    return {
+        "name": name,
+        "tech_key": get_tech_key_for_exercise(name),
+        "sets": sets.strip(),
+        "reps": reps.strip(),
+        "rest_class": exercise_rest_class(name),
+    }
+
+
+def format_sets_reps(ex: dict) -> str:
+    if ex.get("sets") and ex.get("reps"):
+        return f"{ex['sets']}×{ex['reps']}"
+    return ex.get("reps") or ex.get("sets") or ""
+
+
+def day_header_info(day_num: int, day_text: str) -> dict:
+    """Тип дня и подпись для шапки экрана дня (из текста плана)."""
     t = day_text.lower()
     # Верх тела (включая А/Б варианты для обратной совместимости)
     if "верх тела" in t or "верх а" in t or "верх б" in t or (
@@ -4414,47 +6636,48 @@ def build_day_display_text(day_num: int, day_text: str, exercises: List[str],
     else:
         day_type = get_day_display_name(day_num, day_text) or "Тренировка"
         day_note = ""
+    return {
+        "type": day_type,
+        "note": day_note,
+        "fullbody": "фулбади" in t or "fullbody" in t,
+        "title": get_day_display_name(day_num, day_text),
+    }
 
-    lines = []
-    # Заголовок строго: 🏋️ День N: фокус (или 🏋️ Фулбади для fullbody)
-    is_fullbody = ("фулбади" in t or "fullbody" in t)
-    if is_fullbody:
-        lines.append("🏋️ Фулбади")
-        lines.append("📌 всё тело")
-    else:
-        lines.append(f"🏋️ День {day_num}: {day_type}")
-        if day_note:
-            lines.append(f"📌 {day_note}")
-    lines.append("")
-    lines.append("⚠️ Перед тренировкой разомнись 5–10 минут")
-    lines.append("📚 — техника выполнения упражнения")
-    lines.append("🔄 — заменить упражнение под себя")
-    lines.append("")
 
-    ex_full = parse_exercises_full(day_text)
-    for idx, (name, sets_reps) in enumerate(ex_full):
-        is_done = idx in done
-        mark = "✅" if is_done else "🔸"
-        rest = _rest_for(name)
-        if sets_reps:
-            lines.append(f"{mark} {name} {sets_reps}  ⏱ {rest}")
-        else:
-            lines.append(f"{mark} {name}  ⏱ {rest}")
+def ensure_plan_v2(plan: dict) -> bool:
+    """Дополняет план до v2 на месте. True — план изменился (стоит сохранить)."""
+    if not plan or plan.get("version") == PLAN_VERSION:
+        return False
+    days = plan.get("days") or {}
+    plan["exercises"] = {
+        d: [exercise_record(name, sets_reps) for name, sets_reps in parse_exercises_full(text)]
+        for d, text in days.items()
+    }
+    plan["day_info"] = {d: day_header_info(int(d), text) for d, text in days.items() if d.isdigit()}
+    plan["version"] = PLAN_VERSION
+    return True
 
-    lines.append("")
-    lines.append("🏁 После тренировки — заминка и растяжка 5–10 минут")
-    lines.append("")
 
-    bar = workout_progress_bar(done_count, total)
-    if all_done:
-        lines.append(f"{bar}")
-        lines.append(f"✅ {done_count}/{total} упражнений выполнено")
-        lines.append("")
-        lines.append("🎉 ОТЛИЧНО! День засчитан!")
-    else:
-        lines.append(f"{bar}")
-        lines.append(f"✅ {done_count}/{total} упражнений выполнено")
+def plan_day(plan: dict, day_num: int) -> Tuple[Optional[str], List[dict], dict]:
+    """(текст дня, записи упражнений, шапка) — None вместо текста, если дня нет."""
+    key = str(day_num)
+    day_text = (plan.get("days") or {}).get(key)
+    if not day_text:
+        return None, [], {}
+    return day_text, (plan.get("exercises") or {}).get(key) or [], (plan.get("day_info") or {}).get(key) or {}
 
+
+def render_day_text(day_text: str, exercises: List[dict]) -> str:
+    """Перерисовывает строки «• ...» текста дня по записям (шапка и подписи не трогаются)."""
+    it = iter(exercises)
+    lines = []
+    for line in day_text.splitlines():
+        if line.strip().startswith("•"):
+            ex = next(it, None)
+            if ex is not None:
+                sets_reps = format_sets_reps(ex)
+                line = f"• {ex['name']} — {sets_reps}" if sets_reps else f"• {ex['name']}"
+        lines.append(line)
     return "\n".join(lines)
 
 
@@ -4964,6 +7187,7 @@ def generate_workout_plan(goal: str, place: str, exp: str, freq: int, limits: st
         "days": days,
         "updated_at": datetime.utcnow().isoformat(),
     }
+    ensure_plan_v2(plan_struct)
     return intro, plan_struct
 
 
@@ -5764,7 +7988,7 @@ async def cb_faq_question(callback: CallbackQuery, bot: Bot):
     await callback.answer()
 
 
-async def show_main_menu(bot: Bot, chat_id: int, user_id: int):
+async def show_main_menu(bot: Bot, chat_id: int, user_id: int, callback: Optional[CallbackQuery] = None):
     u = await get_user(user_id)
     sub = await get_subscription(user_id)
     tariff_line = format_tariff_line(sub)
@@ -5796,7 +8020,7 @@ async def show_main_menu(bot: Bot, chat_id: int, user_id: int):
         f"{tariff_line}\n\n"
         f"Неделя тренировок закрыта на {w_pct}%."
     )
-    await _send_with_image(bot, chat_id, user_id, text, "menu", reply_markup=menu_main_inline_kb())
+    await _send_with_image(bot, chat_id, user_id, text, "menu", reply_markup=menu_main_inline_kb(), callback=callback)
 
 
 def welcome_kb():
@@ -5962,7 +8186,7 @@ async def cb_nav(callback: CallbackQuery, state: FSMContext, bot: Bot):
             return
 
     if key == "menu":
-        await show_main_menu(bot, chat_id, uid)
+        await show_main_menu(bot, chat_id, uid, callback=callback)
     elif key == "workouts":
         await open_workouts(user_id=uid, chat_id=chat_id, bot=bot, callback=callback)
     elif key == "nutrition":
@@ -6091,7 +8315,7 @@ async def cb_nav(callback: CallbackQuery, state: FSMContext, bot: Bot):
         # Возврат на экран «Профиль готов!» из тарифов или пробного
         await _show_profile_done_screen(callback, uid)
     else:
-        await show_main_menu(bot, chat_id, uid)
+        await show_main_menu(bot, chat_id, uid, callback=callback)
 
     await callback.answer()
 
@@ -6920,11 +9144,11 @@ async def profile_limits_text(message: Message, state: FSMContext, bot: Bot):
             pass
 
     # ── Отправляем видео с caption, либо текст если файл отсутствует ─────────
-    video_path = "media2/tech/profile_success.mp4"
-    if os.path.exists(video_path):
-        m = await bot.send_video(
+    video = media_file(PROFILE_SUCCESS_VIDEO)
+    if video:
+        m = await send_media(
+            bot, "video", video["path"], file_hash=video["hash"],
             chat_id=message.chat.id,
-            video=FSInputFile(video_path),
             caption=summary,
             reply_markup=kb,
             parse_mode=ParseMode.HTML,
@@ -6937,20 +9161,133 @@ async def profile_limits_text(message: Message, state: FSMContext, bot: Bot):
             parse_mode=ParseMode.HTML,
         )
 
-    await set_last_bot_msg_id(message.from_user.id, m.message_id)
-    await try_delete_user_message(bot, message)
+    await set_last_bot_msg_id(message.from_user.id, m.message_id)
+    await try_delete_user_message(bot, message)
+
+
+# =========================
+# ✅ ОПЛАТА ЧЕРЕЗ ЮКАССА REST API
+# =========================
+def access_status_str(a: dict) -> str:
+    if not a or a.get("paid") != 1:
+        return "Статус: ❌ доступа нет"
+    if a.get("tariff") == "life":
+        return "Статус: ✅ доступ навсегда"
+    exp = a.get("expires_at")
+    return f"Статус: ✅ до {exp[:10]}" if exp else "Статус: ✅ активен"
+
+
+# =========================
+# ЮКасса: HTTP-клиент
+# =========================
+# Один клиент на процесс (создаётся в main()): пул соединений с keep-alive —
+# без нового TLS-рукопожатия на каждый запрос; заголовок авторизации
+# собирается один раз; у создания платежа и проверки статуса свои таймауты.
+# GET-запросы идемпотентны — при сетевой ошибке, 429 и 5xx повторяются
+# с экспоненциальной задержкой и jitter.
+YUKASSA_POOL_SIZE = int(os.getenv("YUKASSA_POOL_SIZE", "20"))
+YUKASSA_GET_RETRIES = 3
+_YUKASSA_TIMEOUTS = {
+    "create": aiohttp.ClientTimeout(total=20, connect=5),
+    "get": aiohttp.ClientTimeout(total=10, connect=3),
+}
+
+
+class YooKassaClient:
+    def __init__(self, shop_id: str, secret: str, base_url: str = YUKASSA_API_URL):
+        self.base_url = base_url.rstrip("/")
+        self._auth = "Basic " + base64.b64encode(f"{shop_id}:{secret}".encode()).decode()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._latency: Dict[str, deque] = {}  # endpoint -> последние задержки, мс
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=YUKASSA_POOL_SIZE, keepalive_timeout=60, ttl_dns_cache=300
+                ),
+                headers={"Authorization": self._auth},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _request(self, endpoint: str, method: str, path: str,
+                       retries: int = 0, **kwargs) -> Tuple[int, dict]:
+        """(HTTP-статус, JSON-ответ). Сетевые ошибки после всех попыток — исключение."""
+        session = self._get_session()
+        attempt = 0
+        while True:
+            self.requests += 1
+            t0 = _time.monotonic()
+            try:
+                async with session.request(
+                    method, self.base_url + path, timeout=_YUKASSA_TIMEOUTS[endpoint], **kwargs
+                ) as resp:
+                    try:
+                        data = await resp.json(content_type=None)
+                    except ValueError:
+                        data = {}
+                    status = resp.status
+                error = None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, data, error = 0, {}, e
+            self._latency.setdefault(endpoint, deque(maxlen=200)).append(
+                (_time.monotonic() - t0) * 1000
+            )
+            retryable = error is not None or status == 429 or status >= 500
+            if not retryable or attempt >= retries:
+                if retryable:
+                    self.errors += 1
+                if error is not None:
+                    raise error
+                return status, data or {}
+            self.retries += 1
+            await asyncio.sleep(random.uniform(0, 0.3 * 2 ** attempt))
+            attempt += 1
+
+    async def create_payment(self, payload: dict, idempotence_key: str) -> Tuple[int, dict]:
+        return await self._request(
+            "create", "POST", "/payments", json=payload,
+            headers={"Idempotence-Key": idempotence_key},
+        )
+
+    async def get_payment(self, payment_id: str) -> Tuple[int, dict]:
+        return await self._request(
+            "get", "GET", f"/payments/{payment_id}", retries=YUKASSA_GET_RETRIES
+        )
+
+    def stats(self) -> dict:
+        latency = {}
+        for endpoint, values in self._latency.items():
+            ordered = sorted(values)
+            latency[endpoint] = {
+                "n": len(ordered),
+                "p50": round(ordered[len(ordered) // 2]),
+                "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]),
+            }
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "latency": latency,
+        }
+
 
+_yookassa: Optional[YooKassaClient] = None
 
-# =========================
-# ✅ ОПЛАТА ЧЕРЕЗ ЮКАССА REST API
-# =========================
-def access_status_str(a: dict) -> str:
-    if not a or a.get("paid") != 1:
-        return "Статус: ❌ доступа нет"
-    if a.get("tariff") == "life":
-        return "Статус: ✅ доступ навсегда"
-    exp = a.get("expires_at")
-    return f"Статус: ✅ до {exp[:10]}" if exp else "Статус: ✅ активен"
+
+def yookassa_client() -> YooKassaClient:
+    """Клиент ЮКассы; вне main() (например, в командах CLI) создаётся при первом вызове."""
+    global _yookassa
+    if _yookassa is None:
+        _yookassa = YooKassaClient(YUKASSA_SHOP_ID, YUKASSA_SECRET)
+    return _yookassa
 
 
 async def yukassa_create_payment(tariff_code: str, user_id: int):
@@ -6958,18 +9295,10 @@ async def yukassa_create_payment(tariff_code: str, user_id: int):
     Создаём платёж через ЮКасса REST API.
     Возвращает (data_dict, error_str). При успехе error_str == None.
     """
-    import uuid
-    import base64
-    import aiohttp
-
     t = TARIFFS[tariff_code]
     amount_str = f"{t['price']:.2f}"
     idempotence_key = str(uuid.uuid4())
 
-    credentials = base64.b64encode(
-        f"{YUKASSA_SHOP_ID}:{YUKASSA_SECRET}".encode()
-    ).decode()
-
     return_url = BOT_PUBLIC_URL if BOT_PUBLIC_URL else "https://t.me/"
 
     payload = {
@@ -6983,27 +9312,15 @@ async def yukassa_create_payment(tariff_code: str, user_id: int):
     try:
         logger.info(f"YooKassa: creating payment user={user_id} tariff={tariff_code} amount={amount_str}")
         logger.info(f"YooKassa: shop_id={YUKASSA_SHOP_ID[:4]}**** return_url={return_url}")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.yookassa.ru/v3/payments",
-                json=payload,
-                headers={
-                    "Authorization": f"Basic {credentials}",
-                    "Idempotence-Key": idempotence_key,
-                    "Content-Type": "application/json",
-                },
-                timeout=aiohttp.ClientTimeout(total=20),
-            ) as resp:
-                data = await resp.json()
-                if resp.status == 200:
-                    logger.info(f"YooKassa: payment created id={data.get('id')}")
-                    return data, None
-                else:
-                    err_code = data.get("code", "?")
-                    err_desc = data.get("description", "?")
-                    err_msg = f"HTTP {resp.status} | code={err_code} | {err_desc}"
-                    logger.error(f"YooKassa API error: {err_msg} | full={data}")
-                    return None, err_msg
+        status, data = await yookassa_client().create_payment(payload, idempotence_key)
+        if status == 200:
+            logger.info(f"YooKassa: payment created id={data.get('id')}")
+            return data, None
+        err_code = data.get("code", "?")
+        err_desc = data.get("description", "?")
+        err_msg = f"HTTP {status} | code={err_code} | {err_desc}"
+        logger.error(f"YooKassa API error: {err_msg} | full={data}")
+        return None, err_msg
     except Exception as e:
         err_msg = f"{type(e).__name__}: {e}"
         logger.error(f"YooKassa request failed: {err_msg}")
@@ -7012,38 +9329,164 @@ async def yukassa_create_payment(tariff_code: str, user_id: int):
 
 async def yukassa_get_payment(payment_id: str) -> Optional[dict]:
     """Получаем статус платежа из ЮКасса."""
-    import base64
-    import aiohttp
-
-    credentials = base64.b64encode(
-        f"{YUKASSA_SHOP_ID}:{YUKASSA_SECRET}".encode()
-    ).decode()
-
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"https://api.yookassa.ru/v3/payments/{payment_id}",
-                headers={"Authorization": f"Basic {credentials}"},
-                timeout=aiohttp.ClientTimeout(total=10),
-            ) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                return None
+        status, data = await yookassa_client().get_payment(payment_id)
+        return data if status == 200 else None
     except Exception as e:
         logger.error(f"YooKassa get_payment failed: {e}")
         return None
 
 
 async def save_yukassa_payment_id(payment_db_id: int, yukassa_id: str):
-    """Сохраняем ЮКасса payment_id в колонку receipt_file_id."""
+    """Сохраняем ЮКасса payment_id в колонку provider_payment_id (и ставим в сверку)."""
     async with db() as conn:
         await conn.execute(
-            "UPDATE payments SET receipt_file_id=? WHERE id=?",
+            "UPDATE payments SET provider_payment_id=?, next_check_at=COALESCE(next_check_at, created_at) "
+            "WHERE id=?",
             (yukassa_id, payment_db_id)
         )
         await conn.commit()
 
 
+# =========================
+# ЮКасса: применение статуса платежа и уведомления (webhook)
+# =========================
+# Финальный статус платежа применяется в одном месте — _apply_yookassa_status.
+# Его вызывают webhook ЮКассы, кнопка «Я оплатил» и фоновые проверки;
+# переход делает transition_payment (в одной транзакции с выдачей тарифа),
+# поэтому доступ выдаётся и уведомления уходят ровно один раз,
+# кто бы ни пришёл первым.
+# Телу уведомления не доверяем (оно не подписано): берём из него только id
+# платежа и перечитываем статус через API.
+YUKASSA_WEBHOOK_PATH = os.getenv("YUKASSA_WEBHOOK_PATH", "/yookassa/webhook")
+# «Я оплатил» при pending ходит в API не чаще раза в N секунд на платёж
+YUKASSA_CHECK_COOLDOWN = 30
+# Из каких локальных статусов можно перейти в финальный статус ЮКассы
+_YUKASSA_OPEN_STATUSES = {"approved": ("pending", "expired"), "canceled": ("pending",)}
+_YUKASSA_FINAL_STATUS = {"succeeded": "approved", "canceled": "canceled"}
+_yukassa_checked_at: Dict[str, float] = {}
+_yookassa_webhook_stats = {"received": 0, "applied": 0, "ignored": 0, "failed": 0}
+
+
+def payment_approved_text(tariff_code: str, a: dict) -> str:
+    t = TARIFFS[tariff_code]
+    return (
+        f"✅ Оплата подтверждена!\n"
+        f"Тариф: {t['title']}\n"
+        f"{access_status_str(a)}\n\n"
+        "Теперь иди тренироваться 💪"
+    )
+
+
+async def _notify_admin_payment(bot: Bot, p: dict, yk_payment_id: str):
+    if not ADMIN_ID:
+        return
+    u = await get_user(p["user_id"])
+    raw_username = u.get("username") if u else None
+    username_str = f"@{raw_username}" if raw_username else "отсутствует"
+    t = TARIFFS.get(p["tariff"], {})
+    await bot.send_message(
+        chat_id=ADMIN_ID,
+        text=(
+            f"💰 Оплата подтверждена (ЮКасса)\n"
+            f"user_id: {p['user_id']}\n"
+            f"username: {username_str}\n"
+            f"tariff: {p['tariff']} ({t.get('title', '?')})\n"
+            f"amount: {t.get('price', p.get('amount'))}₽\n"
+            f"yukassa_id: {yk_payment_id}"
+        )
+    )
+
+
+async def _apply_yookassa_status(bot: Bot, yk_data: dict, source: str) -> Tuple[dict, bool]:
+    """Применяет статус из ЮКассы к локальному платежу.
+    source — кто применяет (webhook / check / reconcile) — пишется в payment_status_log.
+    Возвращает (платёж с актуальным status, изменили ли его именно сейчас).
+    Пустой dict — такого платежа у нас нет."""
+    yk_id = yk_data.get("id") or ""
+    p = await get_payment_by_provider_id(yk_id)
+    if not p:
+        logger.warning(f"YooKassa: unknown payment {yk_id}")
+        return {}, False
+    new_status = _YUKASSA_FINAL_STATUS.get(yk_data.get("status", ""))
+    # expired ставит наша сверка, а не ЮКасса: если после этого деньги всё же
+    # списались — подтверждённый succeeded выдаёт доступ как обычно
+    if not new_status or p["status"] not in _YUKASSA_OPEN_STATUSES[new_status]:
+        return p, False
+
+    if new_status == "approved":
+        amount = (yk_data.get("amount") or {}).get("value")
+        try:
+            amount_ok = float(amount) == float(p["amount"])
+        except (TypeError, ValueError):
+            amount_ok = False
+        if not amount_ok or p["tariff"] not in TARIFFS:
+            logger.error(
+                f"YooKassa: payment {yk_id} amount={amount} tariff={p['tariff']!r} "
+                f"не совпадает с локальной записью (amount={p['amount']}) — доступ не выдан"
+            )
+            return p, False
+    if not await transition_payment(p, new_status, source, grant=new_status == "approved"):
+        return await get_payment_by_provider_id(yk_id), False
+
+    p["status"] = new_status
+    logger.info(f"YooKassa: payment {yk_id} user={p['user_id']} → {new_status}")
+    if new_status == "approved":
+        submit_outbound(_notify_admin_payment(bot, p, yk_id), PRIO_PAYMENT)
+    return p, True
+
+
+async def _push_payment_approved(bot: Bot, p: dict):
+    """Экран «Оплата подтверждена» — без действий пользователя (webhook/фоновая сверка).
+    Об отмене не пишем: это обычно брошенная страница оплаты."""
+    if p.get("status") != "approved" or p.get("tariff") not in TARIFFS:
+        return
+    uid = p["user_id"]
+    text = payment_approved_text(p["tariff"], await get_access(uid))
+    await render_screen(bot, uid, uid, text, reply_markup=menu_main_inline_kb())
+
+
+async def _yookassa_webhook(request: web.Request) -> web.Response:
+    """HTTP-уведомление ЮКассы (payment.succeeded / payment.canceled / ...)."""
+    _yookassa_webhook_stats["received"] += 1
+    try:
+        body = await request.json()
+        yk_id = str((body.get("object") or {}).get("id") or "")
+        event = str(body.get("event") or "")
+    except Exception:
+        body, yk_id, event = {}, "", ""
+    if body.get("type") != "notification" or not yk_id:
+        _yookassa_webhook_stats["ignored"] += 1
+        return web.Response(status=400)
+    if not event.startswith("payment."):
+        # refund.* и прочие события нам не нужны; не-200 ЮКасса
+        # считает недоставкой и повторяет сутки — отвечаем 200
+        _yookassa_webhook_stats["ignored"] += 1
+        return web.Response()
+
+    # Endpoint открытый: без локального платежа, ждущего статуса, в API не ходим —
+    # поддельные id не стоят нам ни одного исходящего запроса
+    p = await get_payment_by_provider_id(yk_id)
+    if not p or p["status"] not in ("pending", "expired"):
+        _yookassa_webhook_stats["ignored"] += 1
+        return web.Response()
+
+    yk_data = await yukassa_get_payment(yk_id)
+    if not yk_data or yk_data.get("id") != yk_id:
+        # Не смогли проверить — отвечаем ошибкой, ЮКасса пришлёт уведомление повторно
+        _yookassa_webhook_stats["failed"] += 1
+        return web.Response(status=503)
+
+    bot: Bot = request.app["bot"]
+    p, changed = await _apply_yookassa_status(bot, yk_data, "webhook")
+    if changed:
+        _yookassa_webhook_stats["applied"] += 1
+        submit_outbound(_push_payment_approved(bot, p), PRIO_PAYMENT)
+    else:
+        _yookassa_webhook_stats["ignored"] += 1
+    return web.Response()
+
+
 async def cb_tariff(callback: CallbackQuery, state: FSMContext, bot: Bot):
     """
     Создаём платёж через ЮКасса REST API и отправляем кнопку со ссылкой.
@@ -7111,12 +9554,16 @@ async def cb_tariff(callback: CallbackQuery, state: FSMContext, bot: Bot):
         return
 
     # Записываем в БД для последующей проверки
-    now = datetime.utcnow().isoformat()
+    now_dt = datetime.utcnow()
+    now = now_dt.isoformat()
+    # Первая фоновая сверка — не раньше PAYMENT_RECONCILE_MIN_AGE: сначала даём шанс webhook-у
+    next_check = (now_dt + timedelta(seconds=PAYMENT_RECONCILE_MIN_AGE)).isoformat()
     async with db() as conn:
         cur = await conn.execute("""
-            INSERT INTO payments (user_id, tariff, amount, last4, code, status, receipt_file_id, created_at)
-            VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)
-        """, (uid, tariff_code, t["price"], "yukassa", yk_payment_id, yk_payment_id, now))
+            INSERT INTO payments (user_id, tariff, amount, last4, code, status, provider_payment_id,
+                                  created_at, next_check_at)
+            VALUES (?, ?, ?, ?, ?, 'pending', ?, ?, ?)
+        """, (uid, tariff_code, t["price"], "yukassa", yk_payment_id, yk_payment_id, now, next_check))
         await conn.commit()
         payment_db_id = cur.lastrowid
 
@@ -7146,84 +9593,170 @@ async def cb_tariff(callback: CallbackQuery, state: FSMContext, bot: Bot):
     await clean_edit(callback, uid, text, reply_markup=pay_kb)
 
 
+# =========================
+# ЮКасса: фоновая сверка pending-платежей
+# =========================
+# Платёж, о котором не пришло уведомление (webhook не настроен, потерялся),
+# не должен висеть pending до нажатия «Я оплатил». Раз в
+# PAYMENT_RECONCILE_SECONDS берём pending-платежи ЮКассы, которым подошла
+# очередь (next_check_at, индекс по status + next_check_at), проверяем их
+# пачками через общий клиент и применяем финальный статус тем же
+# _apply_yookassa_status. Платёж, который всё ещё pending, повторно
+# проверяется всё реже (расписание хранится в payments, а не в памяти:
+# брошенные оплаты не загораживают новые и переживают рестарт); старше
+# PAYMENT_PENDING_EXPIRE_HOURS — помечается expired (после последней проверки)
+# и больше не проверяется; если ЮКасса всё же пришлёт succeeded (webhook или
+# «Я оплатил»), expired → approved и доступ выдаётся.
+PAYMENT_RECONCILE_SECONDS = int(os.getenv("PAYMENT_RECONCILE_SECONDS", "60"))
+PAYMENT_RECONCILE_MIN_AGE = 60           # сек: сначала даём шанс webhook-у
+PAYMENT_RECONCILE_CONCURRENCY = 10
+PAYMENT_RECONCILE_BATCH = 200
+PAYMENT_PENDING_EXPIRE_HOURS = int(os.getenv("PAYMENT_PENDING_EXPIRE_HOURS", "24"))
+# Старше PAYMENT_PENDING_EXPIRE_HOURS и столько проверок без финального ответа
+# (ошибки API, таймауты) — закрываем, не дожидаясь ответа ЮКассы
+PAYMENT_RECONCILE_MAX_CHECKS = 10
+
+_reconcile_stats = {"runs": 0, "checked": 0, "applied": 0, "expired": 0, "not_found": 0, "errors": 0}
+
+
+async def get_due_yukassa_payments(now: str, limit: int) -> List[dict]:
+    """pending-платежи ЮКассы, которым пора на проверку (самые просроченные первыми)."""
+    async with db(readonly=True) as conn:
+        async with conn.execute("""
+            SELECT id, user_id, tariff, amount, last4, code, status, receipt_file_id, created_at,
+                   provider_payment_id, check_attempts
+            FROM payments
+            WHERE status='pending' AND next_check_at <= ? AND provider_payment_id IS NOT NULL
+            ORDER BY next_check_at
+            LIMIT ?
+        """, (now, limit)) as cur:
+            rows = await cur.fetchall()
+    return [dict(_payment_dict(r), check_attempts=r[10]) for r in rows]
+
+
+async def _reconcile_payment(bot: Bot, p: dict, expire_before: str):
+    yk_id = p["provider_payment_id"]
+    try:
+        status, data = await yookassa_client().get_payment(yk_id)
+    except Exception as e:
+        logger.warning(f"YooKassa get_payment {yk_id} failed: {e}")
+        status, data = 0, {}
+    yk_data = data if status == 200 else None
+    _reconcile_stats["checked"] += 1
+    if status == 404:
+        # ЮКасса такого платежа не знает (например, платёж тестового магазина
+        # после перехода на боевой) — проверять дальше бессмысленно
+        _reconcile_stats["not_found"] += 1
+        if await transition_payment(p, "expired", "reconcile"):
+            _reconcile_stats["expired"] += 1
+        return
+    if yk_data:
+        p2, changed = await _apply_yookassa_status(bot, yk_data, "reconcile")
+        if changed:
+            _reconcile_stats["applied"] += 1
+            await _push_payment_approved(bot, p2)
+            return
+    else:
+        _reconcile_stats["errors"] += 1
+    if p["created_at"] < expire_before and (yk_data or p["check_attempts"] >= PAYMENT_RECONCILE_MAX_CHECKS):
+        # ЮКасса подтвердила, что всё ещё не оплачено (или давно не отвечает) — закрываем.
+        # Если деньги всё же придут, succeeded переведёт expired → approved
+        if await transition_payment(p, "expired", "reconcile"):
+            _reconcile_stats["expired"] += 1
+        return
+    # Ещё pending — следующая проверка позже: 1, 2, 4 … 60 минут
+    attempt = p["check_attempts"]
+    next_check = datetime.utcnow() + timedelta(seconds=min(60 * 2 ** min(attempt, 6), 3600))
+    await db_write((
+        "UPDATE payments SET next_check_at=?, check_attempts=? WHERE id=? AND status='pending'",
+        (next_check.isoformat(), attempt + 1, p["id"]),
+    ))
+
+
+async def reconcile_pending_payments(bot: Bot):
+    """Один проход сверки."""
+    _reconcile_stats["runs"] += 1
+    now_dt = datetime.utcnow()
+    expire_before = (now_dt - timedelta(hours=PAYMENT_PENDING_EXPIRE_HOURS)).isoformat()
+    due = await get_due_yukassa_payments(now_dt.isoformat(), PAYMENT_RECONCILE_BATCH)
+
+    sem = asyncio.Semaphore(PAYMENT_RECONCILE_CONCURRENCY)
+
+    async def one(p):
+        async with sem:
+            try:
+                await _reconcile_payment(bot, p, expire_before)
+            except Exception as e:
+                _reconcile_stats["errors"] += 1
+                logger.warning(f"Payment reconcile {p['id']} failed: {e}")
+
+    await asyncio.gather(*(one(p) for p in due))
+
+
+async def payment_reconcile_loop(bot: Bot):
+    """Фоновая задача: сверка pending-платежей ЮКассы."""
+    if not YUKASSA_SHOP_ID or not YUKASSA_SECRET:
+        return
+    _outbound_priority.set(PRIO_PAYMENT)
+    while True:
+        await asyncio.sleep(PAYMENT_RECONCILE_SECONDS)
+        try:
+            await reconcile_pending_payments(bot)
+        except Exception:
+            logger.exception("payment_reconcile_loop error")
+
+
 async def cb_check_payment(callback: CallbackQuery, bot: Bot):
     """
-    Пользователь нажал «Я оплатил» — проверяем статус в ЮКасса API.
+    Пользователь нажал «Я оплатил». Статус обычно уже пришёл webhook-ом —
+    читаем локальную запись; в API ЮКассы идём, только если платёж ещё pending
+    (или expired по нашей сверке), и не чаще раза в YUKASSA_CHECK_COOLDOWN секунд.
     """
     parts = callback.data.split(":")
     yk_payment_id = parts[1]
-    tariff_code = parts[2] if len(parts) > 2 else ""
     uid = callback.from_user.id
 
-    await callback.answer("🔍 Проверяю оплату…")
-
-    yk_data = await yukassa_get_payment(yk_payment_id)
-
-    if not yk_data:
+    p = await get_payment_by_provider_id(yk_payment_id)
+    if not p or p["user_id"] != uid:
+        await callback.answer()
         await callback.message.answer(
             "❌ Не удалось проверить статус.\nПопробуй через минуту или напиши в поддержку."
         )
         return
 
-    status = yk_data.get("status", "")
-    metadata = yk_data.get("metadata") or {}
-
-    if not tariff_code:
-        tariff_code = metadata.get("tariff", "")
-
-    if status == "succeeded":
-        # Оплата прошла — выдаём доступ
-        if tariff_code and tariff_code in TARIFFS:
-            await set_paid_tariff(uid, tariff_code)
-            # Обновляем статус в БД
-            async with db() as conn:
-                await conn.execute(
-                    "UPDATE payments SET status='approved' WHERE receipt_file_id=? AND user_id=?",
-                    (yk_payment_id, uid)
-                )
-                await conn.commit()
-
-            t = TARIFFS[tariff_code]
-            a = await get_access(uid)
+    if p["status"] in ("pending", "expired"):
+        now = _time.monotonic()
+        if now - _yukassa_checked_at.get(yk_payment_id, 0.0) >= YUKASSA_CHECK_COOLDOWN:
+            if len(_yukassa_checked_at) > 10000:
+                _yukassa_checked_at.clear()
+            _yukassa_checked_at[yk_payment_id] = now
+            await callback.answer("🔍 Проверяю оплату…")
+            yk_data = await yukassa_get_payment(yk_payment_id)
+            if yk_data:
+                p = (await _apply_yookassa_status(bot, yk_data, "check"))[0] or p
+        else:
+            await callback.answer()
+    else:
+        await callback.answer()
 
+    status = p["status"]
+    if status == "approved":
+        if p["tariff"] in TARIFFS:
             await clean_edit(callback, uid,
-                f"✅ Оплата подтверждена!\n"
-                f"Тариф: {t['title']}\n"
-                f"{access_status_str(a)}\n\n"
-                "Теперь иди тренироваться 💪",
+                payment_approved_text(p["tariff"], await get_access(uid)),
                 reply_markup=menu_main_inline_kb()
             )
-
-            # Уведомляем админа
-            if ADMIN_ID:
-                try:
-                    raw_username = callback.from_user.username
-                    username_str = f"@{raw_username}" if raw_username else "отсутствует"
-                    await bot.send_message(
-                        chat_id=ADMIN_ID,
-                        text=(
-                            f"💰 Оплата подтверждена (ЮКасса)\n"
-                            f"user_id: {uid}\n"
-                            f"username: {username_str}\n"
-                            f"tariff: {tariff_code} ({t['title']})\n"
-                            f"amount: {t['price']}₽\n"
-                            f"yukassa_id: {yk_payment_id}"
-                        )
-                    )
-                except Exception:
-                    pass
         else:
             await clean_edit(callback, uid,
                 "✅ Оплата прошла! Свяжитесь с поддержкой для активации.",
                 reply_markup=menu_main_inline_kb()
             )
-
     elif status == "pending":
         await callback.message.answer(
             "⏳ Платёж ещё обрабатывается.\n"
             "Подожди 1–2 минуты и нажми «Я оплатил» снова."
         )
-    elif status in ("canceled", "cancelled"):
+    elif status in ("canceled", "rejected"):
         await callback.message.answer(
             "❌ Платёж отменён.\n"
             "Нажми «⬅️ Назад» и попробуй снова."
@@ -7259,22 +9792,28 @@ async def admin_actions(callback: CallbackQuery, bot: Bot):
         if tariff not in TARIFFS:
             await callback.answer("У платежа нет тарифа", show_alert=True)
             return
-        await set_payment_status(pid, "approved")
-        await set_paid_tariff(user_id, tariff)
+        # Тариф выдаётся в одной транзакции со сменой статуса (и сбрасывает кэш подписки)
+        if not await transition_payment(p, "approved", "admin", grant=True):
+            await callback.answer("Уже обработано", show_alert=True)
+            return
 
         a = await get_access(user_id)
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"✅ Оплата подтверждена.\nТариф: {TARIFFS[tariff]['title']}\n{access_status_str(a)}",
-            reply_markup=menu_main_inline_kb()
-        )
+        with outbound_priority(PRIO_PAYMENT):
+            await bot.send_message(
+                chat_id=user_id,
+                text=f"✅ Оплата подтверждена.\nТариф: {TARIFFS[tariff]['title']}\n{access_status_str(a)}",
+                reply_markup=menu_main_inline_kb()
+            )
         await callback.answer("Подтверждено ✅")
     else:
-        await set_payment_status(pid, "rejected")
-        await bot.send_message(
-            chat_id=user_id,
-            text="❌ Отклонил. Проверь перевод/скрин и попробуй ещё раз (💳 Оплата/доступ)."
-        )
+        if not await transition_payment(p, "rejected", "admin"):
+            await callback.answer("Уже обработано", show_alert=True)
+            return
+        with outbound_priority(PRIO_PAYMENT):
+            await bot.send_message(
+                chat_id=user_id,
+                text="❌ Отклонил. Проверь перевод/скрин и попробуй ещё раз (💳 Оплата/доступ)."
+            )
         await callback.answer("Отклонено ❌")
 
 
@@ -7382,7 +9921,7 @@ async def get_workouts_done_last_7_days(user_id: int) -> int:
     """Считает уникальные дни тренировок за последние 7 дней (включая сегодня)."""
     since = (datetime.now() - timedelta(days=6)).strftime("%Y-%m-%d")
     today = datetime.now().strftime("%Y-%m-%d")
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute("""
             SELECT COUNT(DISTINCT completed_date) FROM workout_completions
             WHERE user_id=? AND completed_date >= ? AND completed_date <= ?
@@ -7410,7 +9949,7 @@ async def get_nutrition_done_last_7_days(user_id: int) -> int:
     """Считает закрытые дни питания за последние 7 дней."""
     since = (datetime.now() - timedelta(days=6)).strftime("%Y-%m-%d")
     today = datetime.now().strftime("%Y-%m-%d")
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute("""
             SELECT COUNT(DISTINCT completed_date) FROM nutrition_completions
             WHERE user_id=? AND completed_date >= ? AND completed_date <= ?
@@ -7421,7 +9960,7 @@ async def get_nutrition_done_last_7_days(user_id: int) -> int:
 
 async def get_latest_weight(user_id: int) -> Optional[float]:
     """Возвращает последнее значение веса тела из замеров."""
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute("""
             SELECT value FROM measurements
             WHERE user_id=? AND mtype='weight'
@@ -7462,7 +10001,7 @@ async def log_nutrition_day(user_id: int, target_kcal: int, actual_kcal: int):
 async def get_nutrition_today(user_id: int) -> Optional[dict]:
     """Возвращает запись питания за сегодня (или None)."""
     today = datetime.now().strftime("%Y-%m-%d")
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute(
             "SELECT target_kcal, actual_kcal FROM nutrition_daily WHERE user_id=? AND log_date=?",
             (user_id, today)
@@ -7480,7 +10019,7 @@ async def get_nutrition_week_stats(user_id: int) -> dict:
     """Возвращает статистику питания за последние 7 дней."""
     since = (datetime.now() - timedelta(days=6)).strftime("%Y-%m-%d")
     today = datetime.now().strftime("%Y-%m-%d")
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute("""
             SELECT target_kcal, actual_kcal FROM nutrition_daily
             WHERE user_id=? AND log_date >= ? AND log_date <= ?
@@ -7511,7 +10050,7 @@ async def save_nutrition_log(user_id: int, calories: int):
 async def get_nutrition_log_today(user_id: int) -> Optional[int]:
     """Возвращает калории из nutrition_logs за сегодня."""
     today = datetime.now().strftime("%Y-%m-%d")
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute(
             "SELECT calories FROM nutrition_logs WHERE user_id=? AND day_date=?",
             (user_id, today)
@@ -7535,7 +10074,7 @@ async def get_week_progress(user_id: int, freq: int) -> str:
     week_start = today - timedelta(days=today.weekday())
     week_end = week_start + timedelta(days=6)
 
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute("""
             SELECT completed_date FROM workout_completions
             WHERE user_id=? AND completed_date >= ? AND completed_date <= ?
@@ -7609,7 +10148,7 @@ async def open_workouts(user_id: int, chat_id: int, bot: Bot, callback: Optional
 # ✅ Клавиатура дня тренировки — только управление и техники
 # убраны кнопки «Статистика» и «Меню»
 # =========================
-def workout_day_exercises_kb(day: int, exercises: List[str], done: List[int]) -> InlineKeyboardMarkup:
+def workout_day_exercises_kb(day: int, exercises: List[dict], done: List[int]) -> InlineKeyboardMarkup:
     """Обёртка для обратной совместимости — делегирует в build_workout_keyboard."""
     return build_workout_keyboard(day, exercises, done)
 
@@ -7633,15 +10172,14 @@ async def cb_workout_day(callback: CallbackQuery, bot: Bot):
         plan_text, plan_struct = await get_workout_plan(callback.from_user.id)
 
     day = callback.data.split(":", 1)[1]
-    day_text = (plan_struct.get("days") or {}).get(str(day))
+    day_num = int(day) if day.isdigit() else 0
+    day_text, exercises, info = plan_day(plan_struct, day_num)
     if not day_text:
         await callback.answer("День не найден 😅", show_alert=True)
         return
 
-    day_num = int(day)
     uid = callback.from_user.id
 
-    exercises = parse_exercises_from_day_text(day_text)
     if not exercises:
         u = await get_user(uid)
         full_access = await is_full_access_active(uid)
@@ -7654,7 +10192,7 @@ async def cb_workout_day(callback: CallbackQuery, bot: Bot):
     already_done_today = await is_day_completed_today(uid, day_num)
 
     u = await get_user(uid)
-    text = build_day_display_text(day_num, day_text, exercises, done, goal=u.get("goal") or "")
+    text = build_day_display_text(day_num, day_text, exercises, done, goal=u.get("goal") or "", info=info)
     if already_done_today:
         text += "\n\n🎉 День уже засчитан сегодня! Можешь пройти снова."
     kb = workout_day_exercises_kb(day_num, exercises, done)
@@ -7678,12 +10216,11 @@ async def cb_workout_ex_done(callback: CallbackQuery, bot: Bot):
         await callback.answer("Нет плана 😅", show_alert=True)
         return
 
-    day_text = (plan_struct.get("days") or {}).get(str(day_num))
+    day_text, exercises, info = plan_day(plan_struct, day_num)
     if not day_text:
         await callback.answer("День не найден", show_alert=True)
         return
 
-    exercises = parse_exercises_from_day_text(day_text)
     done = await get_day_done_exercises(uid, day_num)
 
     if ex_idx in done:
@@ -7701,15 +10238,15 @@ async def cb_workout_ex_done(callback: CallbackQuery, bot: Bot):
     user_goal = u.get("goal") or ""
 
     if all_done:
-        day_title = get_day_display_name(day_num, day_text)
+        day_title = info.get("title") or get_day_display_name(day_num, day_text)
         await mark_day_completed(uid, day_num, day_title)
         await clear_day_progress(uid, day_num)
-        text = build_day_display_text(day_num, day_text, exercises, list(range(total)), all_done=True, goal=user_goal)
+        text = build_day_display_text(day_num, day_text, exercises, list(range(total)), all_done=True, goal=user_goal, info=info)
         kb = workout_day_exercises_kb(day_num, exercises, list(range(total)))
         await clean_edit(callback, uid, text, reply_markup=kb)
         await callback.answer("🎉 День завершён!", show_alert=True)
     else:
-        text = build_day_display_text(day_num, day_text, exercises, done, goal=user_goal)
+        text = build_day_display_text(day_num, day_text, exercises, done, goal=user_goal, info=info)
         kb = workout_day_exercises_kb(day_num, exercises, done)
         await clean_edit(callback, uid, text, reply_markup=kb)
         await callback.answer(f"{'✅' if ex_idx in done else '↩️'} {done_count}/{total}")
@@ -7732,19 +10269,18 @@ async def cb_workout_ex_alt(callback: CallbackQuery, bot: Bot):
         await callback.answer("Нет плана", show_alert=True)
         return
 
-    day_text = (plan_struct.get("days") or {}).get(str(day_num))
-    exercises = parse_exercises_from_day_text(day_text or "")
+    _, exercises, _ = plan_day(plan_struct, day_num)
     if ex_idx >= len(exercises):
         await callback.answer("Упражнение не найдено", show_alert=True)
         return
 
-    ex_name  = exercises[ex_idx]
-    tech_key = get_tech_key_for_exercise(ex_name) or ""
+    ex_name  = exercises[ex_idx]["name"]
+    tech_key = exercises[ex_idx].get("tech_key") or ""
     u = await get_user(uid)
     alts = get_alternatives(tech_key, u.get("place") or "зал")
 
     # Убираем уже присутствующие в этом дне упражнения
-    present = set(exercises)
+    present = {ex["name"] for ex in exercises}
     alts = [a for a in alts if a[1] not in present] or alts
 
     if not alts:
@@ -7778,27 +10314,27 @@ async def cb_workout_ex_apply(callback: CallbackQuery, bot: Bot):
     if not plan_struct:
         await callback.answer("Нет плана", show_alert=True)
         return
+    plan_struct = copy.deepcopy(plan_struct)  # план из кэша общий — правим копию
 
-    day_text = (plan_struct.get("days") or {}).get(str(day_num))
-    exercises = parse_exercises_from_day_text(day_text or "")
+    _, exercises, info = plan_day(plan_struct, day_num)
     if ex_idx >= len(exercises):
         await callback.answer("Упражнение не найдено", show_alert=True)
         return
 
-    old_name = exercises[ex_idx]
-    old_prefix = f"• {old_name}"
-    if old_prefix not in day_text:
-        await callback.answer("Не удалось найти упражнение в тексте", show_alert=True)
-        return
-
-    new_prefix = f"• {new_name}"
+    old_name = exercises[ex_idx]["name"]
     days = plan_struct.get("days") or {}
     synced_days: List[int] = []  # дни, где была произведена замена (кроме текущего)
 
-    # Заменяем во ВСЕХ днях программы, где встречается старое упражнение
-    for d_key, d_text in days.items():
-        if old_prefix in d_text:
-            days[d_key] = d_text.replace(old_prefix, new_prefix)
+    # Заменяем во ВСЕХ днях программы, где встречается старое упражнение:
+    # правим записи и перерисовываем из них строки «•» текста дня
+    for d_key, d_exercises in (plan_struct.get("exercises") or {}).items():
+        changed = False
+        for i, ex in enumerate(d_exercises):
+            if ex["name"] == old_name:
+                d_exercises[i] = {**exercise_record(new_name), "sets": ex["sets"], "reps": ex["reps"]}
+                changed = True
+        if changed:
+            days[d_key] = render_day_text(days.get(d_key, ""), d_exercises)
             d_num = int(d_key)
             if d_num != day_num:
                 synced_days.append(d_num)
@@ -7812,11 +10348,10 @@ async def cb_workout_ex_apply(callback: CallbackQuery, bot: Bot):
         done.remove(ex_idx)
         await set_day_done_exercises(uid, day_num, done)
 
-    new_day_text = days[str(day_num)]
-    new_exercises = parse_exercises_from_day_text(new_day_text)
+    new_day_text, new_exercises, info = plan_day(plan_struct, day_num)
     done = await get_day_done_exercises(uid, day_num)
     u = await get_user(uid)
-    text = build_day_display_text(day_num, new_day_text, new_exercises, done, goal=u.get("goal") or "")
+    text = build_day_display_text(day_num, new_day_text, new_exercises, done, goal=u.get("goal") or "", info=info)
     kb   = build_workout_keyboard(day_num, new_exercises, done)
     await clean_edit(callback, uid, text, reply_markup=kb)
 
@@ -7831,26 +10366,15 @@ async def cb_workout_ex_apply(callback: CallbackQuery, bot: Bot):
 async def cb_workout_stats(callback: CallbackQuery, bot: Bot):
     """Статистика тренировок: дни по порядку + закрытие недели."""
     uid = callback.from_user.id
-    async with db() as conn:
-        try:
-            async with conn.execute("""
-                SELECT day_num, completed_date, created_at, day_title
-                FROM workout_completions
-                WHERE user_id=?
-                ORDER BY completed_date ASC, day_num ASC, id ASC
-                LIMIT 60
-            """, (uid,)) as cur:
-                rows = await cur.fetchall()
-        except Exception:
-            async with conn.execute("""
-                SELECT day_num, completed_date, created_at
-                FROM workout_completions
-                WHERE user_id=?
-                ORDER BY completed_date ASC, day_num ASC, id ASC
-                LIMIT 60
-            """, (uid,)) as cur:
-                raw = await cur.fetchall()
-            rows = [(r[0], r[1], r[2], "") for r in raw]
+    async with db(readonly=True) as conn:
+        async with conn.execute("""
+            SELECT day_num, completed_date, created_at, day_title
+            FROM workout_completions
+            WHERE user_id=?
+            ORDER BY completed_date ASC, day_num ASC, id ASC
+            LIMIT 60
+        """, (uid,)) as cur:
+            rows = await cur.fetchall()
 
     if not rows:
         await callback.answer("Пока нет завершённых тренировок 💪", show_alert=True)
@@ -7874,8 +10398,8 @@ async def cb_workout_stats(callback: CallbackQuery, bot: Bot):
         if saved_title:
             day_label = f"День {day_num} • {saved_title}"
         elif plan_struct:
-            day_text_str = (plan_struct.get("days") or {}).get(str(day_num), "")
-            day_name = get_day_display_name(day_num, day_text_str)
+            info = (plan_struct.get("day_info") or {}).get(str(day_num)) or {}
+            day_name = info.get("title") or get_day_display_name(day_num, "")
             day_label = f"День {day_num} • {day_name}"
         else:
             day_label = f"День {day_num}"
@@ -7958,7 +10482,7 @@ async def cb_workout_ex_tech(callback: CallbackQuery, bot: Bot):
     # Используем GIF (не картинку)
     await _send_tech_with_gif(
         bot, callback.message.chat.id, callback.from_user.id,
-        tech_key, text, reply_markup=back_kb
+        tech_key, text, reply_markup=back_kb, callback=callback,
     )
     await callback.answer()
 
@@ -8139,8 +10663,7 @@ async def diary_enter_sets(message: Message, state: FSMContext, bot: Bot):
         r = int(m.group(3))
         parsed.append((w, r))
 
-    for i, (w, r) in enumerate(parsed, start=1):
-        await add_set(session_id, exercise, i, w, r)
+    await add_sets(session_id, exercise, parsed)
 
     await try_delete_user_message(bot, message)
 
@@ -8152,10 +10675,19 @@ async def diary_enter_sets(message: Message, state: FSMContext, bot: Bot):
 
 
 async def diary_history(callback: CallbackQuery):
-    back_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:diary")]
-    ])
-    history = await get_diary_history(callback.from_user.id, 10)
+    """callback_data: d:history (последние) или d:history:{before_id} (более ранние)."""
+    parts = callback.data.split(":")
+    before_id = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else None
+    history, next_before = await get_diary_history(callback.from_user.id, 10, before_id=before_id)
+
+    rows = []
+    if next_before:
+        rows.append([InlineKeyboardButton(text="⏪ Более ранние", callback_data=f"d:history:{next_before}")])
+    if before_id:
+        rows.append([InlineKeyboardButton(text="⏩ К последним", callback_data="d:history")])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="nav:diary")])
+    back_kb = InlineKeyboardMarkup(inline_keyboard=rows)
+
     if not history:
         await clean_edit(callback, callback.from_user.id,
                          "Истории пока нет 🙂",
@@ -8163,7 +10695,7 @@ async def diary_history(callback: CallbackQuery):
         await callback.answer()
         return
 
-    msg = "📜 Последние тренировки:\n\n"
+    msg = "📜 Последние тренировки:\n\n" if not before_id else "📜 Более ранние тренировки:\n\n"
     for (s, sets) in history:
         sid, session_date, title = s
         msg += f"🗓 {session_date}\n"
@@ -8653,7 +11185,7 @@ async def cb_tech_show(callback: CallbackQuery, bot: Bot):
     text = item["text"]
     await _send_tech_with_gif(
         bot, callback.message.chat.id, callback.from_user.id,
-        key, text, reply_markup=tech_back_kb()
+        key, text, reply_markup=tech_back_kb(), callback=callback,
     )
     await callback.answer()
 
@@ -8778,44 +11310,264 @@ async def cb_post_send(callback: CallbackQuery, bot: Bot, state: FSMContext):
     if post.get("status") == "sent":
         await callback.answer("Уже отправлен", show_alert=True)
         return
+    if post_id in _broadcasts:
+        await callback.answer("Рассылка уже идёт", show_alert=True)
+        return
 
-    await callback.message.answer("📤 Рассылаю…")
+    m = await callback.message.answer("📤 Рассылка запускается…")
     await callback.answer()
+    await set_post_progress_msg(post_id, m.message_id)
+    post["progress_msg_id"] = m.message_id
+    await start_broadcast(bot, post)
+    await state.clear()
 
-    user_ids = await get_all_user_ids()
-    ok = 0
-    fail = 0
 
-    caption = (post.get("text") or "").strip()
-    if len(caption) > 1024:
-        caption = caption[:1020] + "…"
+async def cb_post_control(callback: CallbackQuery):
+    """Кнопки под прогрессом рассылки: post:pause / post:resume / post:stop."""
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+    _, action, post_id = callback.data.split(":")
+    job = _broadcasts.get(int(post_id))
+    if not job:
+        await callback.answer("Рассылка не идёт", show_alert=True)
+        return
+    if action == "pause":
+        await job.pause()
+        await callback.answer("⏸ Пауза")
+    elif action == "resume":
+        await job.resume()
+        await callback.answer("▶️ Продолжаю")
+    else:
+        await job.cancel()
+        await callback.answer("⛔ Останавливаю")
+
+
+# =========================
+# РАССЫЛКА ПОСТОВ: фоновые задачи
+# =========================
+# Рассылка — фоновая задача, а не цикл внутри хендлера админа:
+# 1. Получатели читаются из БД страницами (keyset по user_id).
+# 2. До BROADCAST_CONCURRENCY отправок одновременно; темп задаёт планировщик
+#    исходящих (приоритет «рассылки» — ответы на кнопки не ждут).
+# 3. Каждая доставка пишется в post_sends (уникально по post_id + user_id),
+#    поэтому после рестарта рассылка продолжается с того же места.
+# 4. Заблокировавшие бота получают users.blocked_at и дальше пропускаются.
+# 5. Прогресс — в одном сообщении админу, с кнопками паузы и отмены.
+BROADCAST_CONCURRENCY = max(1, int(os.getenv("BROADCAST_CONCURRENCY", "20")))
+BROADCAST_PAGE_SIZE = 500
+BROADCAST_PROGRESS_SECONDS = 3.0
+BROADCAST_STOP_TIMEOUT = 10.0  # сек: сколько ждём отправки «в полёте» при остановке бота
+
+# Ошибки Telegram, после которых писать пользователю бессмысленно
+_BLOCKED_ERRORS = ("blocked", "deactivated", "chat not found", "user not found", "kicked")
+
+_broadcasts: Dict[int, "BroadcastJob"] = {}
+
+
+def broadcast_progress_kb(post_id: int, paused: bool):
+    toggle = (
+        InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"post:resume:{post_id}")
+        if paused else
+        InlineKeyboardButton(text="⏸ Пауза", callback_data=f"post:pause:{post_id}")
+    )
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [toggle, InlineKeyboardButton(text="⛔ Отменить", callback_data=f"post:stop:{post_id}")],
+    ])
 
-    for uid in user_ids:
+
+class BroadcastJob:
+    def __init__(self, bot: Bot, post: dict, paused: bool = False):
+        self.bot = bot
+        self.post = post
+        self.post_id = post["id"]
+        self.counts = {"ok": 0, "fail": 0, "blocked": 0}
+        self.total = 0
+        self.cancelled = False
+        self.stopping = False  # бот останавливается: статус поста не трогаем
+        self._running = asyncio.Event()
+        if not paused:
+            self._running.set()
+        self._last_report = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def paused(self) -> bool:
+        return not self._running.is_set()
+
+    def start(self):
+        # Свой пустой контекст: задача не наследует снимок пользователя из хендлера
+        self._task = asyncio.create_task(self._run(), context=contextvars.Context())
+
+    async def pause(self):
+        self._running.clear()
+        await set_post_status(self.post_id, "paused")
+        await self.report(force=True)
+
+    async def resume(self):
+        await set_post_status(self.post_id, "sending")
+        self._running.set()
+        await self.report(force=True)
+
+    async def cancel(self):
+        self.cancelled = True
+        self._running.set()  # разбудить ждущих на паузе, чтобы они вышли
+        await self.report(force=True)
+
+    async def stop(self, timeout: float):
+        """Остановка бота: новых отправок не начинаем, уже начатые дописываем
+        в post_sends. Статус поста остаётся sending/paused — после рестарта
+        рассылка продолжится с того же места."""
+        self.stopping = True
+        self._running.set()
+        if self._task is None:
+            return
         try:
-            if post["media_type"] == "photo":
-                await bot.send_photo(chat_id=uid, photo=post["media_file_id"], caption=caption if caption else None)
-            elif post["media_type"] == "video":
-                await bot.send_video(chat_id=uid, video=post["media_file_id"], caption=caption if caption else None)
-            else:
-                await bot.send_message(chat_id=uid, text=post.get("text") or "")
-            ok += 1
-        except Exception as e:
-            fail += 1
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Broadcast post_id={self.post_id}: не остановилась за {timeout} с")
+            self._task.cancel()
+
+    async def _send(self, uid: int):
+        post = self.post
+        caption = (post.get("text") or "").strip()
+        if len(caption) > 1024:
+            caption = caption[:1020] + "…"
+        if post["media_type"] == "photo":
+            await self.bot.send_photo(chat_id=uid, photo=post["media_file_id"], caption=caption or None)
+        elif post["media_type"] == "video":
+            await self.bot.send_video(chat_id=uid, video=post["media_file_id"], caption=caption or None)
+        else:
+            await self.bot.send_message(chat_id=uid, text=post.get("text") or "")
+
+    async def _deliver(self, uid: int, sem: asyncio.Semaphore):
+        async with sem:
+            await self._running.wait()
+            if self.cancelled or self.stopping:
+                return
+            status, error = "ok", None
             try:
-                async with db() as conn:
-                    await conn.execute("""
-                        INSERT INTO post_sends (post_id, user_id, status, error, created_at)
-                        VALUES (?, ?, 'fail', ?, ?)
-                    """, (post_id, uid, str(e)[:500], datetime.utcnow().isoformat()))
-                    await conn.commit()
-            except Exception:
-                pass
+                await self._send(uid)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                blocked = any(k in str(e).lower() for k in _BLOCKED_ERRORS)
+                status, error = ("blocked" if blocked else "fail"), str(e)[:500]
+            except Exception as e:
+                status, error = "fail", str(e)[:500]
+            self.counts[status] += 1
+            now = datetime.utcnow().isoformat()
+            statements = [("""
+                INSERT OR IGNORE INTO post_sends (post_id, user_id, status, error, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (self.post_id, uid, status, error, now))]
+            if status == "blocked":
+                statements.append(("UPDATE users SET blocked_at=? WHERE user_id=?", (now, uid)))
+            await db_write(*statements)
+        await self.report()
+
+    async def _run(self):
+        _outbound_priority.set(PRIO_BROADCAST)
+        try:
+            done, left = await get_broadcast_counts(self.post_id)
+            for k in self.counts:
+                self.counts[k] = done.get(k, 0)
+            self.total = sum(done.values()) + left
+            await self.report(force=True)
+
+            sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+            after = 0
+            while not (self.cancelled or self.stopping):
+                await self._running.wait()
+                if self.stopping:
+                    break
+                page = await get_broadcast_recipients(self.post_id, after, BROADCAST_PAGE_SIZE)
+                if not page:
+                    break
+                after = page[-1]
+                await asyncio.gather(*(self._deliver(uid, sem) for uid in page))
+
+            if self.stopping:
+                return
+            await set_post_status(self.post_id, "cancelled" if self.cancelled else "sent")
+            await self.report(final=True)
+        except Exception:
+            # Статус остаётся sending — после рестарта рассылка продолжится
+            logger.exception(f"Broadcast post_id={self.post_id} crashed")
+        finally:
+            _broadcasts.pop(self.post_id, None)
+
+    def _text(self, final: bool) -> str:
+        c = self.counts
+        done = sum(c.values())
+        if final:
+            title = "⛔ Рассылка отменена" if self.cancelled else "✅ Готово"
+        elif self.cancelled:
+            title = "⛔ Останавливаю рассылку…"
+        else:
+            title = "⏸ Рассылка на паузе" if self.paused else "📤 Рассылаю…"
+        return (
+            f"{title} (пост id={self.post_id})\n\n"
+            f"Обработано: {done} / {self.total}\n"
+            f"Отправлено: {c['ok']} • Ошибок: {c['fail']} • Заблокировали бота: {c['blocked']}"
+        )
+
+    async def report(self, force: bool = False, final: bool = False):
+        """Правит сообщение с прогрессом (не чаще раза в BROADCAST_PROGRESS_SECONDS)."""
+        now = _time.monotonic()
+        if not (force or final) and now - self._last_report < BROADCAST_PROGRESS_SECONDS:
+            return
+        self._last_report = now
+        kb = admin_posts_kb() if final else broadcast_progress_kb(self.post_id, self.paused)
+        chat_id = self.post.get("admin_id") or ADMIN_ID
+        msg_id = self.post.get("progress_msg_id")
+        with outbound_priority(PRIO_INTERACTIVE):
+            if msg_id:
+                try:
+                    await self.bot.edit_message_text(
+                        self._text(final), chat_id=chat_id, message_id=msg_id, reply_markup=kb
+                    )
+                    return
+                except Exception as e:
+                    if _is_not_modified(e):
+                        return
+                    logger.warning(f"Broadcast {self.post_id}: progress edit failed: {e}")
+            try:
+                m = await self.bot.send_message(chat_id, self._text(final), reply_markup=kb)
+                self.post["progress_msg_id"] = m.message_id
+                await set_post_progress_msg(self.post_id, m.message_id)
+            except Exception as e:
+                logger.warning(f"Broadcast {self.post_id}: progress message failed: {e}")
 
-        await asyncio.sleep(0.03)
 
-    await set_post_status(post_id, "sent")
-    await callback.message.answer(f"✅ Готово. Отправлено: {ok} • Ошибок: {fail}", reply_markup=admin_posts_kb())
-    await state.clear()
+async def start_broadcast(bot: Bot, post: dict, paused: bool = False) -> BroadcastJob:
+    await set_post_status(post["id"], "paused" if paused else "sending")
+    job = _broadcasts[post["id"]] = BroadcastJob(bot, post, paused=paused)
+    job.start()
+    return job
+
+
+async def resume_broadcasts(bot: Bot):
+    """При старте продолжает рассылки, прерванные рестартом (паузы остаются паузами)."""
+    for post_id in await get_unfinished_post_ids():
+        post = await get_post(post_id)
+        if post and post_id not in _broadcasts:
+            logger.info(f"Resuming broadcast post_id={post_id} ({post['status']})")
+            await start_broadcast(bot, post, paused=post["status"] == "paused")
+
+
+async def stop_broadcasts(timeout: float = BROADCAST_STOP_TIMEOUT):
+    """Перед close_db(): дожидаемся записи уже отправленных сообщений,
+    иначе после рестарта они уйдут повторно."""
+    jobs = list(_broadcasts.values())
+    if jobs:
+        await asyncio.gather(*(job.stop(timeout) for job in jobs))
+
+
+async def on_my_chat_member(event: ChatMemberUpdated):
+    """Пользователь заблокировал или разблокировал бота в личке."""
+    if event.chat.type != "private":
+        return
+    status = event.new_chat_member.status
+    await set_user_blocked(event.chat.id, blocked=status in ("kicked", "left"))
 
 
 # =========================
@@ -8920,6 +11672,130 @@ async def cmd_testpay(message: Message, bot: Bot):
         )
 
 
+# =========================
+# МЕТРИКИ (АДМИН)
+# =========================
+async def cmd_stats(message: Message):
+    """Команда /stats — внутренние метрики бота (только для админа)."""
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    p = _db_pool.stats()
+    lines = [
+        "📊 Метрики\n",
+        "🗄 Пул SQLite",
+        f"Читатели: {p['readers_idle']}/{p['readers_total']} свободны",
+        f"Писатель: {'занят' if p['writer_busy'] else 'свободен'}",
+        f"Взято: чтение {p['acquired_read']} • запись {p['acquired_write']}",
+        f"Ожидание чтения: ср {p['wait_avg_ms_read']} мс • макс {p['wait_max_ms_read']} мс",
+        f"Ожидание записи: ср {p['wait_avg_ms_write']} мс • макс {p['wait_max_ms_write']} мс",
+    ]
+    w = _write_queue.stats()
+    lines += [
+        "",
+        "✍️ Group commit",
+        f"Заданий: {w['jobs']} • пачек: {w['batches']} • в очереди: {w['queued']}",
+        f"Размер пачки: ср {w['avg_batch']} • макс {w['max_batch']}",
+        f"Ошибок: {w['failed']}",
+    ]
+    sn = _snapshot_stats
+    lines += [
+        "",
+        "👤 Снимок пользователя",
+        f"Загрузок: {sn['loads']} • перечитываний: {sn['reloads']}",
+        f"Чтений из снимка: {sn['hits']} • мимо снимка: {sn['misses']}",
+    ]
+    ac = _access_cache.stats()
+    lines += [
+        "",
+        "💳 Кэш подписок",
+        f"Записей: {ac['size']} / {ac['max_size']} • TTL {ACCESS_CACHE_TTL} с",
+        f"Попаданий: {ac['hits']} • промахов: {ac['misses']} • сбросов: {ac['invalidations']}",
+        f"Вытеснено: протухших {ac['expired']} • по потолку {ac['evicted']} • "
+        f"не закэшировано (сброс во время чтения): {ac['stale_puts']}",
+    ]
+    bs = _bot_state_cache.stats()
+    lines += [
+        "",
+        "🧹 id сообщений (write-behind)",
+        f"В памяти: {bs['size']} • ждут записи: {bs['dirty']} • вытеснено: {bs['evicted']}",
+        f"Изменений: {bs['writes']} → строк записано: {bs['flushed_rows']} за {bs['flushes']} сбросов",
+    ]
+    pc = _plan_cache.stats()
+    lines += [
+        "",
+        "🏋️ Кэш планов",
+        f"Планов: {pc['size']} • {pc['bytes'] // 1024} / {pc['max_bytes'] // 1024} КБ • вытеснено: {pc['evicted']}",
+        f"Попаданий: {pc['hits']} • промахов: {pc['misses']} • hit rate {pc['hit_rate']}%",
+    ]
+    ms = _media_registry.stats()
+    lines += [
+        "",
+        "🎞 Медиа file_id",
+        f"Известно: {ms['known']} • по file_id: {ms['reused']} • загрузок: {ms['uploaded']} • протухших: {ms['stale']}",
+    ]
+    mm = _media_manifest.stats()
+    lines += [
+        f"Манифест: {mm['files']} файлов ({mm['bytes'] // 1048576} МБ) • техник: {mm['tech']} • "
+        f"нет файлов: {mm['missing']} • сборок: {mm['builds']}",
+    ]
+    ob = _outbound.stats()
+    lines += [
+        "",
+        "📨 Исходящие",
+        f"В очереди: {ob['queued']} • чатов с лимитом: {ob['chats']} • 429: {ob['retry_after']}",
+    ] + [
+        f"{name}: {n} • ожидание {w} мс"
+        for name, n, w in zip(_PRIO_NAMES, ob["sent"], ob["avg_wait_ms"])
+    ]
+    if _yookassa:
+        yk = _yookassa.stats()
+        lines += [
+            "",
+            "💳 ЮКасса API",
+            f"Запросов: {yk['requests']} • повторов: {yk['retries']} • ошибок: {yk['errors']}",
+            "Уведомления: {received} • применено: {applied} • без изменений: {ignored} • "
+            "не проверено: {failed}".format(**_yookassa_webhook_stats),
+            "Сверка: проходов {runs} • проверено {checked} • применено {applied} • "
+            "просрочено {expired} (нет в ЮКассе {not_found}) • ошибок {errors}".format(**_reconcile_stats),
+        ] + [
+            f"{endpoint}: p50 {v['p50']} мс • p95 {v['p95']} мс (n={v['n']})"
+            for endpoint, v in yk["latency"].items()
+        ]
+    if _webhook:
+        wh = _webhook.stats()
+        lines += [
+            "",
+            "🔗 Webhook",
+            f"Апдейтов: {wh['received']} • в работе: {wh['inflight']} / {wh['max_inflight']}",
+            f"Отклонено: {wh['rejected']} • ошибок обработки: {wh['failed']}",
+        ]
+    th = _throttle.stats()
+    lines += [
+        "",
+        "🚦 Троттлинг",
+        f"Пользователей: {th['size']} / {th['max_size']} • апдейтов в очереди: {th['queued']}",
+        f"Ждали токен: {th['delayed']} • отброшено: {th['throttled']}",
+        f"Вытеснено: простаивающих {th['expired']} • по потолку {th['evicted']}",
+    ]
+    rs = _render_stats
+    lines += [
+        "",
+        "🖼 Экраны",
+        f"Правок: текст {rs['edit_text']} • подпись {rs['edit_caption']} • медиа {rs['edit_media']}",
+        f"Без изменений (запрос не нужен): {rs['unchanged']} • перекрыто следующим нажатием: {rs['superseded']}",
+        f"Удалить+отправить: {rs['resend']} • неудачных правок: {rs['edit_failed']}",
+    ]
+    await message.answer("\n".join(lines))
+
+
+async def cmd_dbaudit(message: Message):
+    """Команда /dbaudit — EXPLAIN QUERY PLAN по всем SQL бота (только для админа)."""
+    if message.from_user.id != ADMIN_ID:
+        return
+    await safe_send(message, format_query_audit(await audit_query_plans()))
+
+
 # =========================
 # РЕГИСТРАЦИЯ ХЕНДЛЕРОВ
 # =========================
@@ -8967,7 +11843,7 @@ def setup_handlers(dp: Dispatcher):
     dp.message.register(measure_value, MeasureFlow.enter_value)
 
     dp.callback_query.register(diary_pick_ex, F.data.startswith("d:ex:"))
-    dp.callback_query.register(diary_history, F.data == "d:history")
+    dp.callback_query.register(diary_history, F.data.startswith("d:history"))
     dp.message.register(diary_enter_sets, DiaryFlow.enter_sets)
 
     dp.callback_query.register(cb_tech_list, F.data == "tech:list")
@@ -8990,10 +11866,17 @@ def setup_handlers(dp: Dispatcher):
     dp.callback_query.register(cb_workout_rebuild, F.data == "workout:rebuild")
 
     dp.message.register(cmd_testpay, Command("testpay"))
+    dp.message.register(cmd_stats, Command("stats"))
+    dp.message.register(cmd_dbaudit, Command("dbaudit"))
     dp.message.register(cmd_posts, Command("posts"))
     dp.callback_query.register(cb_post_new, F.data == "post:new")
     dp.callback_query.register(cb_post_cancel, F.data == "post:cancel")
     dp.callback_query.register(cb_post_send, F.data.startswith("post:send:"))
+    dp.callback_query.register(
+        cb_post_control,
+        F.data.startswith("post:pause:") | F.data.startswith("post:resume:") | F.data.startswith("post:stop:"),
+    )
+    dp.my_chat_member.register(on_my_chat_member)
     dp.message.register(post_waiting_content, PostFlow.waiting_content)
 
     dp.message.register(open_support_from_reply, F.text == "🆘 Поддержка")
@@ -9003,16 +11886,124 @@ def setup_handlers(dp: Dispatcher):
     dp.message.register(forward_to_admin)
 
 
+# =========================
+# WEBHOOK (опционально вместо long polling)
+# =========================
+# Включается переменной WEBHOOK_URL (публичный https-адрес сервиса, без пути).
+# Telegram шлёт апдейты POST-запросами на WEBHOOK_URL + WEBHOOK_PATH того же
+# aiohttp-сервера, что отдаёт health-check. Запрос без правильного заголовка
+# X-Telegram-Bot-Api-Secret-Token отклоняется (секрет — WEBHOOK_SECRET, если не
+# задан — случайный на каждый запуск, set_webhook всё равно вызывается при старте).
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Сколько апдейтов обрабатывается одновременно; сверх этого ответ Telegram
+# задерживается, и он сам сбавляет темп (max_connections у set_webhook).
+WEBHOOK_MAX_INFLIGHT = max(1, int(os.getenv("WEBHOOK_MAX_INFLIGHT", "100")))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+
+class WebhookIngress:
+    """Приём апдейтов из webhook: проверка секрета, разбор, передача в dispatcher.
+    Telegram получает 200 сразу, обработка идёт в фоне, но не больше
+    WEBHOOK_MAX_INFLIGHT апдейтов одновременно."""
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str, max_inflight: int = WEBHOOK_MAX_INFLIGHT):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.max_inflight = max_inflight
+        self._sem = asyncio.Semaphore(max_inflight)
+        self._tasks: set = set()
+        self.received = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def inflight(self) -> int:
+        return len(self._tasks)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            self.rejected += 1
+            return web.Response(status=401)
+        try:
+            update = TgUpdate.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            self.rejected += 1
+            logger.warning(f"Webhook: bad update payload: {e}")
+            return web.Response(status=400)
+        await self._sem.acquire()
+        self.received += 1
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            self.failed += 1
+            logger.exception(f"Webhook: update {update.update_id} failed")
+        finally:
+            self._sem.release()
+
+    async def close(self, timeout: float = 10.0):
+        """Дать доработать принятым апдейтам перед остановкой."""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+        }
+
+
+_webhook: Optional[WebhookIngress] = None
+
+
+async def setup_webhook(dp: Dispatcher, bot: Bot) -> WebhookIngress:
+    """Регистрирует webhook в Telegram и возвращает приёмник для aiohttp."""
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET не задан — используем случайный секрет на этот запуск.")
+    await bot.set_webhook(
+        url=WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+    )
+    logger.info(f"Webhook set: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    return WebhookIngress(dp, bot, secret)
+
+
 # =========================
 # WEB SERVER (Render/health)
 # =========================
-async def run_web_server():
+def build_web_app(webhook: Optional[WebhookIngress] = None, bot: Optional[Bot] = None) -> web.Application:
     app = web.Application()
 
     async def health(request):
         return web.Response(text="ok")
 
     app.router.add_get("/", health)
+    if webhook is not None:
+        app.router.add_post(WEBHOOK_PATH, webhook.handle)
+    if bot is not None:
+        # Уведомления ЮКассы об оплате/отмене
+        app["bot"] = bot
+        app.router.add_post(YUKASSA_WEBHOOK_PATH, _yookassa_webhook)
+    return app
+
+
+async def run_web_server(app: Optional[web.Application] = None):
+    app = app or build_web_app()
 
     runner = web.AppRunner(app)
     await runner.setup()
@@ -9037,7 +12028,7 @@ async def run_web_server():
 async def _check_and_remind_subscriptions(bot: Bot):
     """Проверяем подписки и рассылаем уведомления при необходимости."""
     today = datetime.utcnow().date()
-    async with db() as conn:
+    async with db(readonly=True) as conn:
         async with conn.execute(
             """SELECT user_id, tariff, tariff_name, expires_at, remind_stage
                FROM access WHERE paid=1 AND expires_at IS NOT NULL"""
@@ -9062,6 +12053,7 @@ async def _check_and_remind_subscriptions(bot: Bot):
                     "UPDATE access SET paid=0 WHERE user_id=?", (user_id,)
                 )
                 await conn.commit()
+            invalidate_access_cache(user_id)
             continue
 
         # Определяем нужную стадию напоминания
@@ -9101,6 +12093,7 @@ async def _check_and_remind_subscriptions(bot: Bot):
                     (send_stage, user_id)
                 )
                 await conn.commit()
+            invalidate_access_cache(user_id)
         except Exception:
             pass  # пользователь заблокировал бота
 
@@ -9108,6 +12101,7 @@ async def _check_and_remind_subscriptions(bot: Bot):
 async def subscription_reminder_loop(bot: Bot):
     """Фоновая задача: раз в 12 часов проверяет подписки и шлёт уведомления."""
     logger.info("subscription_reminder_loop started")
+    _outbound_priority.set(PRIO_REMINDER)
     while True:
         try:
             await _check_and_remind_subscriptions(bot)
@@ -9127,19 +12121,34 @@ async def main():
         logger.warning("YUKASSA_SHOP_ID или YUKASSA_SECRET не заданы. Оплата через ЮКасса не будет работать.")
 
     await init_db()
+    await asyncio.to_thread(_media_manifest.build)
+
+    # Один HTTP-клиент ЮКассы на весь процесс (пул соединений)
+    global _yookassa
+    _yookassa = YooKassaClient(YUKASSA_SHOP_ID, YUKASSA_SECRET)
 
     bot = Bot(
     token=BOT_TOKEN,
     parse_mode=ParseMode.HTML
 )
-    await bot.delete_webhook(drop_pending_updates=True)
-    logger.info("Webhook cleared, starting polling...")
-
+    # Все исходящие сообщения — через планировщик (лимиты Telegram + приоритеты)
+    bot.session.middleware(_outbound)
+    # Рассылки, прерванные рестартом, продолжаются с места остановки
+    await resume_broadcasts(bot)
     dp = Dispatcher()
     # Подключаем middleware защиты от перегрузки
     dp.update.middleware(LoadProtectionMiddleware())
+    # Снимок пользователя: один запрос к БД на апдейт вместо десятка
+    dp.update.middleware(UserContextMiddleware())
     setup_handlers(dp)
 
+    global _webhook
+    if WEBHOOK_URL:
+        _webhook = await setup_webhook(dp, bot)
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        logger.info("Webhook cleared, starting polling...")
+
     async def bot_loop():
         backoff = 2
         while True:
@@ -9154,13 +12163,36 @@ async def main():
                 backoff = 2
                 await asyncio.sleep(2)
 
-    await asyncio.gather(
-        bot_loop(),
-        run_web_server(),
-        subscription_reminder_loop(bot),
-    )
+    try:
+        await asyncio.gather(
+            *([] if _webhook else [bot_loop()]),
+            run_web_server(build_web_app(_webhook, bot)),
+            subscription_reminder_loop(bot),
+            warm_up_media(bot),
+            media_manifest_watch_loop(),
+            payment_reconcile_loop(bot),
+        )
+    finally:
+        if _webhook:
+            await _webhook.close()
+        await stop_broadcasts()
+        await _yookassa.close()
+        await close_db()
+
+async def _cli_audit_queries():
+    await init_db()
+    try:
+        print(format_query_audit(await audit_query_plans()))
+    finally:
+        await close_db()
+
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["audit-queries"]:
+        asyncio.run(_cli_audit_queries())
+        sys.exit(0)
+    if sys.argv[1:2] == ["optimize-media"]:
+        sys.exit(optimize_media(force="--force" in sys.argv[2:]))
     try:
         asyncio.run(main())
     except KeyboardInterrupt: